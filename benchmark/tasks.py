@@ -0,0 +1,355 @@
+"""
+Offline benchmark of the orchestration of the import.
+
+The real tasks of `tasks.py` and `download/tasks.py` are run against
+generated fixtures served by a local HTTP server. docker is replaced by a
+fake `docker-compose`, which runs the commands of the download image in
+process and records the commands of the other images (see
+`RecordingExecutor`). The timings of each stage are reported, to compare the
+changes made to these code paths.
+
+It needs the dependencies of the download image (invoke and requests), and
+pytest for the helpers shared with the tests (`conftest.py`).
+"""
+import contextlib
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import random
+import re
+import shlex
+import shutil
+import sys
+import tempfile
+import threading
+import zipfile
+from collections import defaultdict
+from datetime import datetime, timedelta
+from time import time
+
+from invoke import Collection, Config, Context, Program, task
+from invoke.runners import Result
+from invoke.util import yaml
+
+logging.basicConfig(level=logging.INFO)
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the helpers of the tests serve the fixtures and load the tasks
+sys.path.insert(0, ROOT_DIR)
+from conftest import load_module, local_server
+
+
+def make_fixtures(directory, conf):
+    """
+    Generate the files served to the downloads: an osm extract (random bytes
+    of the size of a small extract) and its md5, an OpenAddresses archive with many
+    members and a BANO file.
+    """
+    rand = random.Random(0)
+    os.makedirs(directory, exist_ok=True)
+
+    md5 = hashlib.md5()
+    with open(os.path.join(directory, "extract.osm.pbf"), "wb") as f:
+        for _ in range(conf["pbf_size_mb"]):
+            block = rand.getrandbits(8 * 2 ** 20).to_bytes(2 ** 20, "little")
+            md5.update(block)
+            f.write(block)
+    with open(os.path.join(directory, "extract.osm.pbf.md5"), "w") as f:
+        f.write(f"{md5.hexdigest()}  extract.osm.pbf\n")
+
+    with zipfile.ZipFile(os.path.join(directory, "openaddr.zip"), "w") as archive:
+        for i in range(conf["oa_members"]):
+            lines = ["LON,LAT,NUMBER,STREET,UNIT,CITY,DISTRICT,REGION,POSTCODE,ID,HASH"]
+            lines += [
+                f"{rand.uniform(5.7, 6.5):.7f},{rand.uniform(49.4, 50.2):.7f},{n},"
+                f"Rue {i},,City {i},,,L-{1000 + i},,{rand.getrandbits(64):x}"
+                for n in range(conf["oa_rows"])
+            ]
+            archive.writestr(f"lu/region_{i % 12}/source_{i}.csv", "\n".join(lines))
+        archive.writestr("fr/ignored.csv", "LON,LAT\n")
+
+    with gzip.open(os.path.join(directory, "full.csv.gz"), "wt") as f:
+        for n in range(conf["bano_rows"]):
+            f.write(
+                f"{n:010d},{n % 300},Rue {n // 300},{n % 90000:05d},Ville {n // 1000},"
+                f"CAD,{rand.uniform(43, 50):.6f},{rand.uniform(-1, 7):.6f}\n"
+            )
+
+
+# Directories of the data directory standing for the volumes of docker-compose.yml
+VOLUMES = {"osm": "osm", "addr": "addresses", "cosmogony": "cosmogony", "download_cache": "cache"}
+
+
+class FakeCompose(Context):
+    """
+    Context of the import where docker is faked: the commands of the download
+    image are run in process on a directory standing for the volumes, the
+    other images are never run (their binaries are recorded).
+
+    Each command is counted and timed by kind.
+    """
+
+    def __init__(self, config, data_dir, download, host_volumes):
+        super().__init__(config)
+        self._set(
+            data_dir=data_dir,
+            download=download,
+            host_volumes=host_volumes,
+            stats=defaultdict(lambda: [0, 0.0]),
+            lock=threading.Lock(),
+        )
+
+    def run(self, command, **kwargs):
+        start = time()
+        kind, result = self._fake(command)
+        with self.lock:
+            self.stats[kind][0] += 1
+            self.stats[kind][1] += time() - start
+
+        if result.exited and not kwargs.get("warn"):
+            raise Exception(f"{command} failed: {result.stderr}")
+        return result
+
+    def _fake(self, command):
+        if re.match(r"docker-compose .* config$", command):
+            # the variables are resolved like `docker-compose config` does
+            with open(os.path.join(ROOT_DIR, "docker-compose.yml")) as f:
+                config = re.sub(
+                    r"\$\{(\w+)(:?-([^}]*))?\}",
+                    lambda m: os.environ.get(m.group(1)) or m.group(3) or "",
+                    f.read(),
+                )
+            return "compose config", Result(stdout=config)
+
+        if command.startswith("docker volume inspect"):
+            if not self.host_volumes:
+                return "volume inspect", Result(exited=1)
+            name = command.split()[-1]
+            for volume, mountpoint in VOLUMES.items():
+                if name.endswith("_" + volume):
+                    return "volume inspect", Result(stdout=os.path.join(self.data_dir, mountpoint))
+            return "volume inspect", Result(exited=1)
+
+        match = re.match(r"docker-compose .* run --rm download (.*)$", command)
+        if match:
+            args = shlex.split(match.group(1))
+            return f"download {args[0]}", self._run_download(args)
+
+        raise Exception(f"unexpected command in the benchmark: {command}")
+
+    def _run_download(self, args):
+        # the paths of the volumes are the ones of the data directory
+        args = [re.sub(r"(?<![\w/])/data/", self.data_dir + "/", a) for a in args]
+        out = io.StringIO()
+        with self.lock, contextlib.redirect_stdout(out):
+            try:
+                Program(namespace=self.download).run(["invoke"] + args)
+                code = 0
+            except SystemExit as e:
+                code = e.code or 0
+        stdout = out.getvalue().replace(self.data_dir + "/", "/data/")
+        return Result(stdout=stdout, exited=code)
+
+
+def _import_config(url, conf):
+    config = Config()
+    config.set_project_location(ROOT_DIR)
+    config.load_project()
+    config.load_overrides(
+        {
+            "dataset": "benchmark",
+            "es": "http://127.0.0.1:1",
+            "es_import": {"enable": False},
+            "es_health": {"before_steps": False},
+            "metrics": {"enable": False},
+            "max_parallel_steps": conf["max_parallel_steps"],
+            "executors": {"default": "recording"},
+            "checkpoints_file": conf["checkpoints_file"],
+            "osm": {"url": f"{url}/extract.osm.pbf"},
+            "admin": {"cosmogony": {"output_dir": "/data/cosmogony", "langs": "fr"}},
+            "street": {"osm_db_file": "/data/osm/osm_db.tmp"},
+            "addresses": {
+                "bano": {"url": f"{url}/full.csv.gz"},
+                "oa": {
+                    "datasets": [
+                        {
+                            "filename": "openaddr.zip",
+                            "url": f"{url}/openaddr.zip",
+                            "include": ["lu/**.csv"],
+                        }
+                    ]
+                },
+            },
+        }
+    )
+    return config
+
+
+def _timed(name, stages, fn, details=None):
+    logging.info(f"running {name}")
+    start = time()
+    fn()
+    stages.append(dict(stage=name, seconds=round(time() - start, 3), **(details or {})))
+    logging.info(f"{name}: {stages[-1]['seconds']}s")
+
+
+@task(default=True)
+def run(ctx, output=None, baseline=None, keep=False):
+    """
+    Run the benchmark and write its timings in `output` (json). With
+    `baseline`, the timings are compared with the ones of a previous run.
+    """
+    conf = ctx.benchmark
+    work_dir = tempfile.mkdtemp(prefix="docker_mimir_benchmark_")
+    fixtures_dir = os.path.join(work_dir, "fixtures")
+    data_dir = os.path.join(work_dir, "data")
+    for mountpoint in VOLUMES.values():
+        os.makedirs(os.path.join(data_dir, mountpoint))
+
+    # the download image has pigz, gzip is a slower stand-in
+    if not shutil.which("pigz"):
+        bin_dir = os.path.join(work_dir, "bin")
+        os.makedirs(bin_dir)
+        with open(os.path.join(bin_dir, "pigz"), "w") as f:
+            f.write('#!/bin/sh\nexec gzip "$@"\n')
+        os.chmod(os.path.join(bin_dir, "pigz"), 0o755)
+        os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+
+    # the download image stores its cache in a volume
+    os.environ["INVOKE_CACHE_DIR"] = os.path.join(data_dir, "cache")
+    download_tasks = load_module("download_tasks", os.path.join(ROOT_DIR, "download/tasks.py"))
+    download = Collection.from_module(download_tasks)
+    # the configuration of the image, `invoke` loads it from the directory of
+    # the tasks
+    with open(os.path.join(ROOT_DIR, "download/invoke.yml")) as f:
+        download.configure(yaml.safe_load(f))
+    stages = []
+
+    try:
+        _timed("fixtures", stages, lambda: make_fixtures(fixtures_dir, conf))
+
+        with local_server(directory=fixtures_dir) as url:
+            download_config = Config()
+            download_config.set_project_location(os.path.join(ROOT_DIR, "download"))
+            download_config.load_project()
+            download_config.load_shell_env()
+            download_ctx = Context(download_config)
+            osm_file = os.path.join(data_dir, "osm", "extract.osm.pbf")
+
+            _timed(
+                "download osm (cold)",
+                stages,
+                lambda: download_tasks.download_file(
+                    download_ctx, osm_file, f"{url}/extract.osm.pbf", timedelta(days=1)
+                ),
+            )
+            _timed(
+                "download osm (cached)",
+                stages,
+                lambda: download_tasks.download_file(
+                    download_ctx, osm_file, f"{url}/extract.osm.pbf", timedelta(days=1)
+                ),
+            )
+            _timed(
+                "download oa + unzip",
+                stages,
+                lambda: download_tasks.download_oa.body(
+                    download_ctx,
+                    "openaddr.zip",
+                    f"{url}/openaddr.zip",
+                    "lu/**.csv",
+                    os.path.join(data_dir, "addresses", "oa"),
+                ),
+                {"members": conf["oa_members"]},
+            )
+            _timed(
+                "download bano + gunzip",
+                stages,
+                lambda: download_tasks.download_bano.body(
+                    download_ctx,
+                    f"{url}/full.csv.gz",
+                    os.path.join(data_dir, "addresses", "bano.csv"),
+                ),
+            )
+
+            def status_io():
+                for n in range(conf["status_updates"]):
+                    filename = os.path.join(data_dir, "cache", f"file_{n % 100}")
+                    download_tasks.save_file_status(
+                        download_ctx, filename, {"last_update": datetime.utcnow(), "md5": "0"}
+                    )
+                    download_tasks.get_file_status(download_ctx, filename)
+
+            _timed("status file i/o", stages, status_io, {"updates": conf["status_updates"]})
+
+            # the import, from the host
+            for host_volumes in (False, True):
+                for attempt in ("cold", "cached"):
+                    mimir_tasks = load_module("mimir_tasks", os.path.join(ROOT_DIR, "tasks.py"))
+                    checkpoints = os.path.join(work_dir, "checkpoints.json")
+                    if attempt == "cold":
+                        shutil.rmtree(os.path.join(data_dir, "cache"))
+                        os.makedirs(os.path.join(data_dir, "cache"))
+                        if os.path.exists(checkpoints):
+                            os.remove(checkpoints)
+
+                    import_ctx = FakeCompose(
+                        _import_config(url, dict(conf, checkpoints_file=checkpoints)),
+                        data_dir,
+                        download,
+                        host_volumes,
+                    )
+                    name = "load-all ({}, {})".format(
+                        attempt, "volumes on the host" if host_volumes else "volumes in docker"
+                    )
+                    _timed(name, stages, lambda: mimir_tasks.load_all.body(import_ctx))
+
+                    stats = import_ctx.stats
+                    stages[-1]["container runs"] = sum(
+                        n for kind, (n, _) in stats.items() if kind.startswith("download")
+                    )
+                    stages[-1]["binaries"] = sum(
+                        len(e.commands) for e in mimir_tasks._executors.values()
+                    )
+                    stages[-1]["commands"] = {
+                        kind: {"count": n, "seconds": round(seconds, 3)}
+                        for kind, (n, seconds) in sorted(stats.items())
+                    }
+    finally:
+        if keep:
+            logging.info(f"benchmark files kept in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    _report(stages, baseline)
+
+    output = output or conf.get("output")
+    if output:
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, "w") as f:
+            json.dump({"date": datetime.now().isoformat(), "stages": stages}, f, indent=2)
+        logging.info(f"timings written in {output}")
+
+
+def _report(stages, baseline):
+    previous = {}
+    if baseline:
+        with open(baseline) as f:
+            previous = {s["stage"]: s for s in json.load(f)["stages"]}
+
+    lines = []
+    for stage in stages:
+        line = f"{stage['stage']:<45} {stage['seconds']:>9.3f}s"
+        if stage["stage"] in previous and previous[stage["stage"]]["seconds"]:
+            ratio = stage["seconds"] / previous[stage["stage"]]["seconds"] - 1
+            line += f" ({ratio:+.0%})"
+        if "container runs" in stage:
+            line += f"  {stage['container runs']} container runs, {stage['binaries']} binaries"
+        lines.append(line)
+        for kind, command in stage.get("commands", {}).items():
+            lines.append(f"    {kind:<41} {command['seconds']:>9.3f}s  x{command['count']}")
+    logging.info("\n" + "\n".join(lines))
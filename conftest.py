@@ -0,0 +1,123 @@
+"""
+Helpers shared by the tests of the import, of the download image and of the
+runner, and by the benchmark: loading the tasks from their files and serving
+local stand-ins of the HTTP services.
+"""
+import contextlib
+import importlib.util
+import os
+import re
+import socketserver
+import sys
+import threading
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+import pytest
+
+
+def load_module(name, filename):
+    """
+    Load the tasks of `filename` as the module `name`. Like invoke, the
+    modules next to the tasks can be imported.
+    """
+    if os.path.dirname(filename) not in sys.path:
+        sys.path.insert(0, os.path.dirname(filename))
+    spec = importlib.util.spec_from_file_location(name, filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class FixturesHandler(SimpleHTTPRequestHandler):
+    """
+    Serve the files of a directory with support of the single range requests
+    (and of If-Range), like the servers of the extracts.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def send_head(self):
+        filename = self.translate_path(self.path)
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if not match or not os.path.isfile(filename):
+            return super().send_head()
+
+        # the whole file is sent if it changed since the validator was read
+        if self.headers.get("If-Range", self._etag(filename)) != self._etag(filename):
+            return super().send_head()
+
+        size = os.path.getsize(filename)
+        first = int(match.group(1))
+        last = min(int(match.group(2) or size - 1), size - 1)
+        if first >= size:
+            self.send_error(416)
+            return None
+
+        f = open(filename, "rb")
+        f.seek(first)
+        self.send_response(206)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Range", f"bytes {first}-{last}/{size}")
+        self.send_header("Content-Length", str(last - first + 1))
+        self.send_header("ETag", self._etag(filename))
+        self.end_headers()
+        return _LimitedReader(f, last - first + 1)
+
+    def _etag(self, filename):
+        return f'"{os.path.getmtime(filename)}-{os.path.getsize(filename)}"'
+
+
+class _LimitedReader:
+    def __init__(self, f, size):
+        self.f = f
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@contextlib.contextmanager
+def local_server(handler_class=FixturesHandler, directory=None):
+    """
+    Serve `handler_class` on a free local port (the files of `directory` for
+    a `FixturesHandler`), yield the url of the server.
+    """
+    if directory is not None:
+
+        class handler(handler_class):
+            def translate_path(self, path):
+                return os.path.join(directory, path.split("?")[0].lstrip("/"))
+
+        handler_class = handler
+
+    server = _ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}"
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+@pytest.fixture
+def http_server():
+    """
+    Start local servers, `http_server(handler_class, directory)` returns the
+    url of a new server (see `local_server`). They are stopped after the test.
+    """
+    with contextlib.ExitStack() as stack:
+        yield lambda *args, **kwargs: stack.enter_context(local_server(*args, **kwargs))
@@ -0,0 +1,49 @@
+"""
+Description of the content of the files read by the import steps, used to
+know if they changed since a step was run.
+
+It is used by the download image (`describe-files`) and, when the docker
+volumes can be read from there, by the import on the host: it must run with
+python 3.5.
+"""
+import hashlib
+import os
+
+
+def describe_path(local_path, file_status, path=None):
+    """
+    Describe the content of a file or of a directory at `local_path`, seen at
+    `path` from the containers (`local_path` by default). When the file was
+    downloaded by the download image (`file_status` is its status) its md5 is
+    used, otherwise its size and modification time are used.
+
+    Return None if there is nothing at `local_path`.
+    """
+    path = path or local_path
+
+    if os.path.isdir(local_path):
+        content = hashlib.md5()
+        for dirname, _, names in sorted(os.walk(local_path)):
+            for name in sorted(names):
+                full_path = os.path.join(dirname, name)
+                stat = os.stat(full_path)
+                content.update(
+                    "{}:{}:{}\n".format(
+                        os.path.join(path, os.path.relpath(full_path, local_path)),
+                        stat.st_size,
+                        stat.st_mtime,
+                    ).encode()
+                )
+        return {"directory": content.hexdigest()}
+
+    if not os.path.isfile(local_path):
+        return None
+
+    stat = os.stat(local_path)
+
+    # The md5 is only meaningful if the file was not modified since it was
+    # downloaded.
+    if file_status.get("md5") and stat.st_mtime <= (file_status.get("last_update") or 0):
+        return {"size": stat.st_size, "md5": file_status["md5"]}
+
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
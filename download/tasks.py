@@ -1,24 +1,58 @@
+import errno
+import fcntl
 import fnmatch
+import gzip
 import hashlib
 import invoke
 import json
+import math
 import os
 import re
 import requests
+import shutil
+import sqlite3
+import subprocess
 import sys
 import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from os import path, walk
+from os import path
+from requests.adapters import HTTPAdapter
+from xml.etree import ElementTree
 
 from invoke import task
 
+from files_description import describe_path
 
-STATUS_FILE_NAME = "_files_status.json"
+
+STATUS_DB_NAME = "_files_status.sqlite"
+
+# Status file used by previous versions, migrated to the database.
+LEGACY_STATUS_FILE_NAME = "_files_status.json"
+
+# Seconds to wait for a server to accept a connection or to send data.
+REQUEST_TIMEOUT = 60
+
+# Size of the blocks read from the network.
+CHUNK_SIZE = 1024 * 1024
+
+# Size of the blocks read when computing the checksums of a file on disk.
+HASH_BLOCK_SIZE = 16 * 1024 * 1024
+
+# Written bytes are flushed and recorded in the progress file after this many
+# bytes, this is the maximum amount of data downloaded again after an
+# interruption.
+PROGRESS_FLUSH_SIZE = 16 * 1024 * 1024
 
 
 def get_md5_from_url(url):
     try:
-        res = requests.get(url)
+        res = requests.get(url, timeout=REQUEST_TIMEOUT)
         res.raise_for_status()
     except Exception as err:
         print(f"failed to get hash from {url}: {err}", file=sys.stderr)
@@ -27,18 +61,69 @@ def get_md5_from_url(url):
     return res.text.split()[0]
 
 
-def raw_files_status(ctx):
-    files_status_path = path.join(ctx.cache_dir, STATUS_FILE_NAME)
+@contextmanager
+def files_status_db(ctx):
+    """
+    Connection to the database keeping the status of downloaded files.
+
+    The database lives in the cache directory which may be shared by several
+    containers: sqlite takes care of the locking and each update is done in
+    its own transaction, so a crash never leaves a corrupted status behind.
+    """
+    conn = sqlite3.connect(path.join(ctx.cache_dir, STATUS_DB_NAME), timeout=60)
+
+    try:
+        # Readers don't block writers (and the other way around) in WAL mode.
+        conn.execute("PRAGMA journal_mode=WAL")
+
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS files_status"
+                " (filename TEXT PRIMARY KEY, status TEXT NOT NULL)"
+            )
+
+        migrate_legacy_files_status(ctx, conn)
+        yield conn
+    finally:
+        conn.close()
+
+
+def migrate_legacy_files_status(ctx, conn):
+    """
+    Import the status of the files from the json file used by previous
+    versions.
+    """
+    legacy_path = path.join(ctx.cache_dir, LEGACY_STATUS_FILE_NAME)
+
+    if not path.isfile(legacy_path):
+        return
+
+    with open(legacy_path) as data:
+        legacy_status = json.load(data)
+
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO files_status VALUES (?, ?)",
+            [(k, json.dumps(v)) for k, v in legacy_status.items() if v is not None],
+        )
+
+    try:
+        os.replace(legacy_path, legacy_path + ".migrated")
+    except FileNotFoundError:
+        pass  # already migrated by another process
+
 
-    if path.isfile(files_status_path):
-        with open(files_status_path) as data:
-            return json.load(data)
+def raw_file_status(ctx, filename):
+    with files_status_db(ctx) as conn:
+        row = conn.execute(
+            "SELECT status FROM files_status WHERE filename = ?", (filename,)
+        ).fetchone()
 
-    return dict()
+    return json.loads(row[0]) if row else None
 
 
 def get_file_status(ctx, filename):
-    res = raw_files_status(ctx).get(filename)
+    res = raw_file_status(ctx, filename)
 
     if res is None:
         res = {"last_update": None, "md5": None}
@@ -50,16 +135,16 @@ def get_file_status(ctx, filename):
 
 
 def save_file_status(ctx, filename, status):
-    files_status_path = path.join(ctx.cache_dir, STATUS_FILE_NAME)
+    with files_status_db(ctx) as conn, conn:
+        if status is None:
+            conn.execute("DELETE FROM files_status WHERE filename = ?", (filename,))
+            return
 
-    if status is not None:
         status["last_update"] = status["last_update"].timestamp()
-
-    files_status = raw_files_status(ctx)
-    files_status[filename] = status
-
-    with open(files_status_path, "w") as data:
-        json.dump(files_status, data)
+        conn.execute(
+            "INSERT OR REPLACE INTO files_status VALUES (?, ?)",
+            (filename, json.dumps(status)),
+        )
 
 
 def needs_to_download(ctx, filename, max_age=None, md5_url=None):
@@ -82,6 +167,15 @@ def needs_to_download(ctx, filename, max_age=None, md5_url=None):
         expt_md5 = get_md5_from_url(md5_url)
         curr_md5 = file_status["md5"]
 
+        if curr_md5 is None and expt_md5 is not None:
+            # The file is there but its checksum was not recorded, computing
+            # it is still much faster than downloading the file again.
+            print(f"computing checksums of existing file {filename}")
+            checksums = hash_file(filename, checksum_algorithms(ctx))
+            last_update = datetime.utcfromtimestamp(os.stat(filename).st_mtime)
+            save_file_status(ctx, filename, {"last_update": last_update, **checksums})
+            curr_md5 = checksums["md5"]
+
         if expt_md5 is None or expt_md5 != curr_md5:
             return True
 
@@ -93,29 +187,399 @@ def needs_to_download(ctx, filename, max_age=None, md5_url=None):
     return False
 
 
-def download_file(ctx, filename, url, max_age=None, md5_url=None):
+def checksum_algorithms(ctx):
+    """
+    Checksums recorded for each downloaded file, md5 is always computed as it
+    is the checksum published along with OSM extracts.
+    """
+    return ["md5"] + [a for a in ctx.download.checksums if a != "md5"]
+
+
+def hash_file(filename, algorithms):
+    """
+    Compute the checksums of a file on disk, reading it by large blocks.
+    """
+    hashers = {algo: hashlib.new(algo) for algo in algorithms}
+    buffer = bytearray(HASH_BLOCK_SIZE)
+    view = memoryview(buffer)
+
+    with open(filename, "rb", buffering=0) as f:
+        for size in iter(lambda: f.readinto(buffer), 0):
+            for hasher in hashers.values():
+                hasher.update(view[:size])
+
+    return {algo: hasher.hexdigest() for algo, hasher in hashers.items()}
+
+
+class StreamHasher:
+    """
+    Compute the checksums of a file while it is being written, possibly out
+    of order.
+
+    The bytes written at the current hashing position are hashed directly
+    from memory (`feed`). The bytes written further in the file are read back
+    from the file once everything before them has been written (`catch_up`).
+    """
+
+    def __init__(self, filename, algorithms):
+        self.filename = filename
+        self.hashers = [hashlib.new(algo) for algo in algorithms]
+        self.position = 0
+        self.lock = threading.Lock()
+
+    def _update(self, data):
+        for hasher in self.hashers:
+            hasher.update(data)
+        self.position += len(data)
+
+    def feed(self, offset, data):
+        """
+        Hash data that was just written at `offset`, this is a no-op if the
+        data is not at the hashing position or if the hasher is busy.
+        """
+        if offset != self.position or not self.lock.acquire(blocking=False):
+            return
+
+        try:
+            if offset == self.position:
+                self._update(data)
+        finally:
+            self.lock.release()
+
+    def catch_up(self, until):
+        """
+        Hash the file up to the position `until`, all the bytes before this
+        position must have been written to the file.
+        """
+        with open(self.filename, "rb") as f:
+            while self.position < until:
+                with self.lock:
+                    f.seek(self.position)
+                    data = f.read(min(HASH_BLOCK_SIZE, until - self.position))
+                    if not data:
+                        raise Exception(f"{self.filename} is shorter than expected")
+                    self._update(data)
+
+    def hexdigests(self):
+        return {hasher.name: hasher.hexdigest() for hasher in self.hashers}
+
+
+class DownloadProgress:
+    """
+    Progress of a download split in segments, persisted in a json file next
+    to the downloaded file so that an interrupted download can be resumed.
+    """
+
+    def __init__(self, state_file, url, size, validator, segment_size):
+        self.state_file = state_file
+        self.lock = threading.Lock()
+        self.state = {
+            "url": url,
+            "size": size,
+            "validator": validator,
+            "segment_size": segment_size,
+            "done": [0] * ((size + segment_size - 1) // segment_size),
+        }
+        self.last_print = time.time()
+
+    def load(self):
+        """
+        Load the progress of a previous download of the same file, return
+        False if there is none or if the remote file changed since.
+        """
+        if not path.isfile(self.state_file):
+            return False
+
+        with open(self.state_file) as f:
+            previous = json.load(f)
+
+        if {k: v for k, v in previous.items() if k != "done"} != {
+            k: v for k, v in self.state.items() if k != "done"
+        }:
+            return False
+
+        self.state["done"] = previous["done"]
+        return True
+
+    def save(self):
+        tmp_file = self.state_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.state, f)
+        os.replace(tmp_file, self.state_file)
+
+    def segment(self, index):
+        """
+        Return the range of bytes that still have to be downloaded for a
+        segment, as (first, last) inclusive positions.
+        """
+        segment_size = self.state["segment_size"]
+        first = index * segment_size + self.state["done"][index]
+        last = min((index + 1) * segment_size, self.state["size"]) - 1
+        return first, last
+
+    def frontier(self):
+        """
+        Position before which all the bytes have been written.
+        """
+        with self.lock:
+            for index in range(len(self.state["done"])):
+                if not self.is_done(index):
+                    return self.segment(index)[0]
+            return self.state["size"]
+
+    def remaining_segments(self):
+        return [i for i in range(len(self.state["done"])) if not self.is_done(i)]
+
+    def is_done(self, index):
+        first, last = self.segment(index)
+        return first > last
+
+    def advance(self, index, nb_bytes):
+        with self.lock:
+            self.state["done"][index] += nb_bytes
+            self.save()
+
+            if time.time() - self.last_print > 10:
+                self.last_print = time.time()
+                done = sum(self.state["done"])
+                print(
+                    f" -> {done // 2**20}/{self.state['size'] // 2**20} MB"
+                    f" ({done / self.state['size']:.0%})"
+                )
+
+
+def http_session(nb_connections):
+    """
+    Session keeping up to `nb_connections` connections open to each host.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=nb_connections)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def probe_ranges(session, url):
+    """
+    Return the size of the remote file and a validator (ETag or Last-Modified)
+    if the server supports range requests, (None, None) otherwise.
+    """
+    with session.get(
+        url, headers={"Range": "bytes=0-0"}, stream=True, timeout=REQUEST_TIMEOUT
+    ) as res:
+        if res.status_code == 416:  # the file is empty
+            return None, None
+
+        res.raise_for_status()
+        content_range = res.headers.get("Content-Range", "")
+
+        if res.status_code != 206 or "/" not in content_range:
+            return None, None
+
+        size = _safe_int(content_range.split("/")[-1])
+
+        # Weak ETags can't be used in a "If-Range" header.
+        validator = res.headers.get("ETag")
+        if validator is None or validator.startswith("W/"):
+            validator = res.headers.get("Last-Modified")
+
+        return size, validator
+
+
+def _safe_int(val):
+    try:
+        return int(val)
+    except (ValueError, TypeError):
+        return None
+
+
+def fetch_segment(session, url, part_file, progress, hasher, index, max_retries, stop):
+    """
+    Download the remaining part of a segment, the download is retried from
+    where it stopped if the connection fails. The download is abandoned as
+    soon as the `stop` event is set.
+    """
+    for attempt in range(max_retries + 1):
+        first, last = progress.segment(index)
+        if first > last or stop.is_set():
+            return
+
+        headers = {"Range": f"bytes={first}-{last}"}
+        if progress.state["validator"]:
+            # Make sure the server doesn't send us a part of a new version.
+            headers["If-Range"] = progress.state["validator"]
+
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT) as res:
+                res.raise_for_status()
+                if res.status_code != 206:
+                    raise Exception(f"remote file changed during the download of {url}")
+
+                with open(part_file, "r+b") as f:
+                    f.seek(first)
+                    pending = 0
+
+                    for chunk in res.iter_content(CHUNK_SIZE):
+                        f.write(chunk)
+                        hasher.feed(first + pending, chunk)
+                        pending += len(chunk)
+
+                        if stop.is_set():
+                            break
+
+                        if pending >= PROGRESS_FLUSH_SIZE:
+                            f.flush()
+                            progress.advance(index, pending)
+                            first += pending
+                            pending = 0
+
+                    f.flush()
+                    progress.advance(index, pending)
+        except requests.RequestException as err:
+            if attempt == max_retries:
+                raise
+            print(f"segment {index} of {url} failed ({err}), retrying", file=sys.stderr)
+            stop.wait(2 ** attempt)
+
+    if not progress.is_done(index) and not stop.is_set():
+        raise Exception(f"failed to download segment {index} of {url}")
+
+
+def fetch_segments(ctx, session, url, filename, size, validator, nb_connections):
+    """
+    Download the file in segments of `segment_size` bytes, fetched in
+    parallel with `nb_connections` HTTP range requests. Return the checksums
+    of the file.
+    """
+    part_file = filename + ".part"
+    progress = DownloadProgress(
+        filename + ".progress.json", url, size, validator, ctx.download.segment_size
+    )
+    hasher = StreamHasher(part_file, checksum_algorithms(ctx))
+
+    if progress.load() and path.isfile(part_file):
+        print(f"resuming previous download of {url}")
+    else:
+        progress.save()
+        with open(part_file, "wb") as f:
+            f.truncate(size)
+
+    # Set on the first failure, to stop the download of the other segments.
+    stop = threading.Event()
+
+    with ThreadPoolExecutor(max_workers=nb_connections) as executor:
+        pending = {
+            executor.submit(
+                fetch_segment,
+                session,
+                url,
+                part_file,
+                progress,
+                hasher,
+                index,
+                ctx.download.max_retries,
+                stop,
+            )
+            for index in progress.remaining_segments()
+        }
+
+        try:
+            # Hash the parts of the file that were not hashed on the fly while
+            # the segments are downloaded.
+            while pending:
+                done, pending = wait(pending, timeout=1)
+                for future in done:
+                    future.result()
+                hasher.catch_up(progress.frontier())
+        except BaseException:
+            stop.set()
+            for future in pending:
+                future.cancel()
+            raise
+
+    hasher.catch_up(size)
+    os.replace(part_file, filename)
+    os.remove(progress.state_file)
+    return hasher.hexdigests()
+
+
+def fetch_single_stream(ctx, session, url, filename):
+    """
+    Download the file in a single stream. Return the checksums of the file.
+    """
+    part_file = filename + ".part"
+    hasher = StreamHasher(part_file, checksum_algorithms(ctx))
+
+    with session.get(url, stream=True, timeout=REQUEST_TIMEOUT) as res:
+        res.raise_for_status()
+        with open(part_file, "wb") as f:
+            for chunk in res.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+                hasher.feed(hasher.position, chunk)
+
+    os.replace(part_file, filename)
+    return hasher.hexdigests()
+
+
+def fetch_url(ctx, url, filename, nb_connections=None):
+    """
+    Download `url` into `filename` and return its checksums.
+
+    If the server supports range requests, the file is downloaded using
+    several connections (`download.nb_connections` by default) and the
+    download can be resumed after an interruption. Otherwise it is downloaded
+    in a single stream.
+    """
+    nb_connections = int(nb_connections or ctx.download.nb_connections)
+    session = http_session(nb_connections)
+    size, validator = probe_ranges(session, url)
+
+    if size is None:
+        print(f"{url} doesn't support range requests, downloading it in a single stream")
+        return fetch_single_stream(ctx, session, url, filename)
+
+    print(f"downloading {url} ({size // 2**20} MB)")
+    return fetch_segments(ctx, session, url, filename, size, validator, nb_connections)
+
+
+@contextmanager
+def file_lock(filename):
+    """
+    Lock a file against the other containers, through a lock file next to it.
+    """
+    os.makedirs(path.dirname(filename), exist_ok=True)
+
+    with open(filename + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def download_file(ctx, filename, url, max_age=None, md5_url=None, nb_connections=None):
+    # When a file is needed by several imports at the same time, the first
+    # one downloads it and the others wait for the download to be over.
+    with file_lock(filename):
+        download_locked_file(ctx, filename, url, max_age, md5_url, nb_connections)
+
+
+def download_locked_file(ctx, filename, url, max_age=None, md5_url=None, nb_connections=None):
+    """
+    Same as `download_file`, once the lock of the file is held.
+    """
     if not needs_to_download(ctx, filename, max_age, md5_url):
         return
 
     # Forget current informations about file in case the download fails.
     save_file_status(ctx, filename, None)
 
-    ctx.run(f"mkdir -p {path.dirname(filename)}/")
-    ctx.run(f"wget --progress=dot:giga -O {filename} {url}")
-
-    with open(filename, "rb") as f:
-        md5 = hashlib.md5()
-        for chunk in iter(lambda: f.read(4096), b""):
-            md5.update(chunk)
-        md5 = md5.hexdigest()
+    checksums = fetch_url(ctx, url, filename, nb_connections)
 
     if md5_url is not None:
         expt_md5 = get_md5_from_url(md5_url)
 
-        if md5 != expt_md5:
+        if checksums["md5"] != expt_md5:
             raise Exception(f"md5 at {md5_url} didn't match for {url}")
 
-    save_file_status(ctx, filename, {"last_update": datetime.utcnow(), "md5": md5})
+    save_file_status(ctx, filename, {"last_update": datetime.utcnow(), **checksums})
 
 
 @task
@@ -128,53 +592,654 @@ def file_exists(ctx, path):
         raise invoke.Exit(code=1)
 
 
+@task(iterable=["path"])
+def describe_files(ctx, path):
+    """
+    Print a json object giving for each path the description of its content
+    (null if it doesn't exist).
+    """
+    print(json.dumps({p: describe_path(p, raw_file_status(ctx, p) or {}) for p in path}))
+
+
+@task
+def make_fifo(ctx, fifo):
+    """
+    Create a named pipe, replacing any file already at this path.
+    """
+    if path.lexists(fifo):
+        os.remove(fifo)
+
+    os.makedirs(path.dirname(fifo), exist_ok=True)
+    os.mkfifo(fifo)
+
+
+def open_fifo_writer(fifo, timeout):
+    """
+    Open a named pipe for writing, waiting at most `timeout` seconds for a
+    reader to open it.
+    """
+    start = time.time()
+
+    while True:
+        try:
+            fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+            break
+        except OSError as err:
+            if err.errno != errno.ENXIO:  # ENXIO: no reader yet
+                raise
+            if time.time() - start > timeout:
+                raise Exception(f"nobody opened {fifo} for reading after {timeout}s")
+            time.sleep(0.1)
+
+    # Writes must block when the reader is slower than the decompression.
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+    return fd
+
+
+@task
+def stream_gzip(ctx, input_file, output_fifo, timeout=600):
+    """
+    Decompress a gzip file into a named pipe (created by make-fifo), read by
+    an importer running in another container.
+
+    The deflate format can't be decompressed in parallel: pigz only reads,
+    writes and checks the data in other threads than the decompression, which
+    is about twice as fast as gzip but uses a single core.
+    """
+    try:
+        fd = open_fifo_writer(output_fifo, int(timeout))
+
+        try:
+            print(f"streaming {input_file} into {output_fifo}")
+            subprocess.run(["pigz", "-dc", input_file], stdout=fd, check=True)
+        finally:
+            os.close(fd)
+    finally:
+        os.remove(output_fifo)
+
+
 @task
 def remove_directory(ctx, path):
     ctx.run(f"rm -rf {path}")
 
 
 @task
-def download_osm(ctx, osm_url, output_file):
+def download_osm(ctx, osm_url, output_file, nb_connections=None):
     download_file(
-        ctx, output_file, osm_url, md5_url=osm_url + ".md5",
+        ctx, output_file, osm_url, md5_url=osm_url + ".md5", nb_connections=nb_connections,
+    )
+
+
+def read_varint(data, pos):
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def int64(value):
+    """
+    Decode an int64 field read as an unsigned varint (the negative values are
+    encoded in two's complement on 64 bits).
+    """
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def parse_protobuf(data):
+    """
+    Decode a protobuf message without its schema, return the list of the
+    values of each field: integers for the scalar types (signed integers are
+    not decoded) and bytes for the strings and embedded messages.
+    """
+    fields = {}
+    pos = 0
+
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        wire_type = key & 0x7
+
+        if wire_type == 0:
+            value, pos = read_varint(data, pos)
+        elif wire_type == 1:
+            value, pos = int.from_bytes(data[pos : pos + 8], "little"), pos + 8
+        elif wire_type == 2:
+            size, pos = read_varint(data, pos)
+            value, pos = data[pos : pos + size], pos + size
+        elif wire_type == 5:
+            value, pos = int.from_bytes(data[pos : pos + 4], "little"), pos + 4
+        else:
+            raise ValueError(f"unsupported protobuf wire type {wire_type}")
+
+        fields.setdefault(key >> 3, []).append(value)
+
+    return fields
+
+
+def read_pbf_blob(f):
+    """
+    Read the next blob of an .osm.pbf file, return its type and its
+    decompressed content (None at the end of the file).
+    """
+    size = f.read(4)
+    if not size:
+        return None, None
+
+    blob_header = parse_protobuf(f.read(int.from_bytes(size, "big")))
+    blob = parse_protobuf(f.read(blob_header[3][0]))
+
+    if 1 in blob:
+        data = blob[1][0]
+    elif 3 in blob:
+        data = zlib.decompress(blob[3][0])
+    else:
+        raise ValueError("only raw and zlib compressed blobs are supported")
+
+    return blob_header[1][0].decode(), data
+
+
+def read_pbf_header(filename):
+    """
+    Read the header block of an .osm.pbf file, with its bounding box (in
+    degrees) and its replication sequence number, if any.
+    """
+    with open(filename, "rb") as f:
+        blob_type, data = read_pbf_blob(f)
+
+    if blob_type != "OSMHeader":
+        raise ValueError(f"{filename} doesn't start with an OSMHeader")
+
+    header = parse_protobuf(data)
+    bbox = None
+
+    if 1 in header:
+        # sint64 in nanodegrees: left, right, top, bottom
+        bbox_fields = parse_protobuf(header[1][0])
+        left, right, top, bottom = (
+            (v >> 1 ^ -(v & 1)) / 1e9 for v in (bbox_fields[i][0] for i in range(1, 5))
+        )
+        bbox = [left, bottom, right, top]
+
+    return {
+        "bbox": bbox,
+        "replication_timestamp": header.get(32, [None])[0],
+        "replication_sequence": header.get(33, [None])[0],
+        "replication_url": header.get(34, [b""])[0].decode() or None,
+    }
+
+
+# Kinds of imported data which may be affected by changes of an osm extract.
+OSM_CHANGED_KINDS = ["admins", "streets", "pois", "addresses"]
+
+# Keys of the tags of the osm objects imported as pois.
+POI_KEYS = {
+    "aeroway",
+    "amenity",
+    "craft",
+    "emergency",
+    "healthcare",
+    "historic",
+    "leisure",
+    "office",
+    "public_transport",
+    "railway",
+    "shop",
+    "sport",
+    "tourism",
+}
+
+
+def read_boundaries(filename):
+    """
+    Read the administrative boundaries of an osm extract, return the ids of
+    their relations, of the ways they are made of and of the nodes of these
+    ways.
+    """
+    # the ways of the relations and their nodes are written before them
+    with subprocess.Popen(
+        ["osmium", "tags-filter", "-f", "opl", "-o", "-", filename, "r/boundary=administrative"],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    ) as process:
+        boundaries = parse_boundaries(l for l in process.stdout if not l.startswith("n"))
+
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+    return boundaries
+
+
+def parse_boundaries(lines):
+    """
+    Parse the boundaries relations and their ways written in the OPL format,
+    eg. `r42 v1 ... Tboundary=administrative Mw1@outer,n2@admin_centre` and
+    `w1 v1 ... Nn3,n4`.
+    """
+    relations, ways = set(), set()
+    ways_nodes = {}
+
+    for line in lines:
+        fields = line.split()
+        if not fields or fields[0][0] not in "rw":
+            continue
+
+        if fields[0][0] == "w":
+            ways_nodes[int(fields[0][1:])] = [
+                int(node[1:])
+                for field in fields[1:]
+                if field[0] == "N"
+                for node in field[1:].split(",")
+                if node
+            ]
+            continue
+
+        relations.add(int(fields[0][1:]))
+        for field in fields[1:]:
+            if field[0] == "M" and len(field) > 1:
+                for member in field[1:].split(","):
+                    if member[0] == "w":
+                        ways.add(int(member[1:].split("@", 1)[0]))
+
+    nodes = {node for way in ways for node in ways_nodes.get(way, [])}
+    return relations, ways, nodes
+
+
+def changed_kinds(action, osm_type, tags, osm_id=None, boundaries=None):
+    """
+    Kinds of imported data which may be affected by the change of an osm
+    object (the deleted objects have no tags in the diffs).
+
+    `boundaries` are the ids of the relations, of the ways and of the nodes
+    of the administrative boundaries before the change (see
+    `read_boundaries`): only the changes of these objects and of the new
+    boundaries are considered for the admins.
+    """
+    kinds = set()
+    deleted = action == "delete"
+    boundary_relations, boundary_ways, boundary_nodes = boundaries or (set(), set(), set())
+
+    if osm_type == "relation" and (
+        tags.get("boundary") == "administrative" or osm_id in boundary_relations
+    ):
+        kinds.add("admins")
+    if osm_type == "way" and osm_id in boundary_ways:
+        kinds.add("admins")
+    if osm_type == "node" and ("place" in tags or osm_id in boundary_nodes):
+        kinds.add("admins")
+
+    if osm_type == "way" and (deleted or "highway" in tags):
+        kinds.add("streets")
+    if osm_type == "node" and not tags and action != "create":
+        kinds.add("streets")  # may move a street
+
+    if POI_KEYS & set(tags) or (deleted and osm_type != "relation"):
+        kinds.add("pois")
+
+    if "addr:housenumber" in tags or (deleted and osm_type != "relation"):
+        kinds.add("addresses")
+
+    return kinds
+
+
+def scan_osm_change(filename, boundaries=None):
+    """
+    Read an .osc.gz file, return the number of changed objects by type and
+    the kinds of imported data they affect (see `changed_kinds`).
+    """
+    counts = {"node": 0, "way": 0, "relation": 0}
+    kinds = set()
+    action = None
+    tags = {}
+
+    with gzip.open(filename) as f:
+        for event, elem in ElementTree.iterparse(f, events=("start", "end")):
+            if event == "start":
+                if elem.tag in ("create", "modify", "delete"):
+                    action = elem.tag
+                continue
+
+            if elem.tag == "tag":
+                tags[elem.get("k")] = elem.get("v")
+            elif elem.tag in counts:
+                counts[elem.tag] += 1
+                osm_id = int(elem.get("id"))
+                kinds |= changed_kinds(action, elem.tag, tags, osm_id, boundaries)
+                tags = {}
+                elem.clear()
+
+    return counts, kinds
+
+
+def read_replication_state(url):
+    res = requests.get(f"{url}/state.txt", timeout=REQUEST_TIMEOUT)
+    res.raise_for_status()
+    state = dict(
+        line.split("=", 1) for line in res.text.splitlines() if "=" in line and line[0] != "#"
+    )
+    return int(state["sequenceNumber"])
+
+
+def replication_diff_url(url, sequence):
+    seq = f"{sequence:09d}"
+    return f"{url}/{seq[:3]}/{seq[3:6]}/{seq[6:]}.osc.gz"
+
+
+@task
+def update_osm(ctx, osm_url, replication_url, output_file, max_diffs=None, nb_connections=None):
+    """
+    Update an osm extract with the replication diffs published since its last
+    update (its replication sequence number is kept in the status of the
+    file). The extract is downloaded again if it is missing, if it was never
+    updated, if it was updated from another replication url or if it is too
+    late (more than `max_diffs` diffs).
+
+    Print a json object with the changes as the last line of the output.
+    """
+    # the extract is not updated and downloaded at the same time by another
+    # import
+    with file_lock(output_file):
+        update_locked_osm(ctx, osm_url, replication_url, output_file, max_diffs, nb_connections)
+
+
+def update_locked_osm(ctx, osm_url, replication_url, output_file, max_diffs, nb_connections):
+    """
+    Same as `update_osm`, once the lock of the extract is held.
+    """
+    replication_url = replication_url.rstrip("/")
+    max_diffs = int(max_diffs or ctx.osm_update.max_diffs)
+    status = raw_file_status(ctx, output_file) or {}
+    sequence = status.get("replication_sequence") if path.isfile(output_file) else None
+    remote_sequence = read_replication_state(replication_url)
+
+    if status.get("replication_url") != replication_url:
+        # the sequence numbers of another replication don't match
+        sequence = None
+
+    if sequence is None or remote_sequence - sequence > max_diffs:
+        print(f"downloading the whole extract {osm_url}")
+        download_locked_file(
+            ctx, output_file, osm_url, md5_url=osm_url + ".md5", nb_connections=nb_connections
+        )
+
+        sequence = read_pbf_header(output_file)["replication_sequence"]
+        if sequence is None:
+            print(f"no replication sequence in {output_file}, using the latest one")
+            sequence = remote_sequence
+
+        save_replication_sequence(ctx, output_file, replication_url, sequence)
+        result = {"sequence": sequence, "full_download": True, "changed": OSM_CHANGED_KINDS}
+        print(json.dumps(result))
+        return
+
+    # the extracts updated at the same time don't share their diffs
+    diffs_dir = path.join(ctx.cache_dir, "replication", path.basename(output_file))
+    os.makedirs(diffs_dir, exist_ok=True)
+    counts = {"node": 0, "way": 0, "relation": 0}
+    kinds = set()
+    diffs = []
+    boundaries = read_boundaries(output_file) if remote_sequence > sequence else None
+
+    for seq in range(sequence + 1, remote_sequence + 1):
+        diff = path.join(diffs_dir, f"{seq}.osc.gz")
+        print(f"downloading diff {seq}")
+        fetch_url(ctx, replication_diff_url(replication_url, seq), diff, nb_connections)
+        diff_counts, diff_kinds = scan_osm_change(diff, boundaries)
+        counts = {t: counts[t] + diff_counts[t] for t in counts}
+        kinds |= diff_kinds
+        diffs.append(diff)
+
+    if diffs:
+        print(f"applying {len(diffs)} diffs to {output_file}")
+        tmp_file = output_file + ".updating"
+        subprocess.run(
+            ["osmium", "apply-changes", "--overwrite", "-f", "pbf", "-o", tmp_file, output_file]
+            + diffs,
+            check=True,
+        )
+        os.replace(tmp_file, output_file)
+
+        checksums = hash_file(output_file, checksum_algorithms(ctx))
+        save_file_status(ctx, output_file, {"last_update": datetime.utcnow(), **checksums})
+        save_replication_sequence(ctx, output_file, replication_url, remote_sequence)
+
+        for diff in diffs:
+            os.remove(diff)
+
+    result = {
+        "previous_sequence": sequence,
+        "sequence": remote_sequence,
+        "full_download": False,
+        "changes": counts,
+        "changed": [k for k in OSM_CHANGED_KINDS if k in kinds],
+    }
+    print(json.dumps(result))
+
+
+def save_replication_sequence(ctx, filename, replication_url, sequence):
+    status = get_file_status(ctx, filename)
+    status["replication_url"] = replication_url
+    status["replication_sequence"] = sequence
+    save_file_status(ctx, filename, status)
+
+
+def iter_pbf_blobs(f):
+    """
+    Iterate over the blobs of an .osm.pbf file without reading them, yield
+    their type, offset and size.
+    """
+    while True:
+        size = f.read(4)
+        if not size:
+            return
+
+        blob_header = parse_protobuf(f.read(int.from_bytes(size, "big")))
+        offset = f.tell()
+        yield blob_header[1][0].decode(), offset, blob_header[3][0]
+        f.seek(blob_header[3][0], os.SEEK_CUR)
+
+
+def iter_packed_sint64(data, limit):
+    """
+    Decode at most `limit` values of a packed and delta coded sint64 field.
+    """
+    pos = value = 0
+    for _ in range(limit):
+        if pos >= len(data):
+            return
+        delta, pos = read_varint(data, pos)
+        value += delta >> 1 ^ -(delta & 1)
+        yield value
+
+
+def sample_pbf_nodes(filename, nb_blobs, nodes_per_blob=500):
+    """
+    Positions (lon, lat) of a sample of the nodes of an .osm.pbf file: some
+    nodes of `nb_blobs` blobs evenly spread in the file. Only the dense nodes
+    are read, which is how the nodes of extracts are stored.
+    """
+    with open(filename, "rb") as f:
+        blobs = [b for b in iter_pbf_blobs(f) if b[0] == "OSMData"]
+        step = max(1, len(blobs) // nb_blobs)
+        points = []
+
+        for _, offset, size in blobs[::step]:
+            f.seek(offset)
+            blob = parse_protobuf(f.read(size))
+            data = blob[1][0] if 1 in blob else zlib.decompress(blob[3][0])
+            block = parse_protobuf(data)
+            granularity = block.get(17, [100])[0]
+            lat_offset = int64(block.get(19, [0])[0])
+            lon_offset = int64(block.get(20, [0])[0])
+
+            for group in block.get(2, []):
+                for dense in parse_protobuf(group).get(2, []):
+                    dense = parse_protobuf(dense)
+                    lats = iter_packed_sint64(dense[8][0], nodes_per_blob)
+                    lons = iter_packed_sint64(dense[9][0], nodes_per_blob)
+                    points.extend(
+                        (
+                            (lon_offset + granularity * lon) / 1e9,
+                            (lat_offset + granularity * lat) / 1e9,
+                        )
+                        for lat, lon in zip(lats, lons)
+                    )
+
+    return points
+
+
+def split_bbox(bbox, points, nb_tiles):
+    """
+    Split a bounding box [min lon, min lat, max lon, max lat] in `nb_tiles`
+    boxes holding about the same number of `points`, by cutting recursively
+    the longest side of the boxes.
+    """
+    if nb_tiles <= 1:
+        return [bbox]
+
+    min_lon, min_lat, max_lon, max_lat = bbox
+    width = (max_lon - min_lon) * math.cos(math.radians((min_lat + max_lat) / 2))
+    axis = 0 if width >= max_lat - min_lat else 1
+    nb_first = nb_tiles // 2
+
+    if points:
+        points = sorted(points, key=lambda p: p[axis])
+        cut = points[len(points) * nb_first // nb_tiles][axis]
+    else:
+        cut = bbox[axis] + (bbox[axis + 2] - bbox[axis]) * nb_first / nb_tiles
+
+    first, second = list(bbox), list(bbox)
+    first[axis + 2] = second[axis] = cut
+    return split_bbox(first, [p for p in points if p[axis] < cut], nb_first) + split_bbox(
+        second, [p for p in points if p[axis] >= cut], nb_tiles - nb_first
     )
 
 
 @task
-def download_bano(ctx, bano_url, output_file):
+def compute_tiles(ctx, osm_file, nb_tiles, sample_blobs=None):
+    """
+    Split the extent of an osm extract in `nb_tiles` tiles holding about the
+    same number of nodes, from a sample of its nodes. The outer sides of the
+    tiles are pushed to the limits of the world, so that the tiles cover all
+    the objects of the extract.
+
+    Print the list of the bounding boxes of the tiles as a json array as the
+    last line of the output.
+    """
+    points = sample_pbf_nodes(osm_file, int(sample_blobs or ctx.tiling.sample_blobs))
+    extent = read_pbf_header(osm_file)["bbox"]
+
+    if extent is None and points:
+        lons, lats = zip(*points)
+        extent = [min(lons), min(lats), max(lons), max(lats)]
+
+    tiles = split_bbox(extent or [-180, -90, 180, 90], points, int(nb_tiles))
+    world = [-180, -90, 180, 90]
+    tiles = [
+        [world[i] if tile[i] == extent[i] else tile[i] for i in range(4)] if extent else tile
+        for tile in tiles
+    ]
+
+    print(f"{len(points)} sampled nodes split in {len(tiles)} tiles")
+    print(json.dumps(tiles))
+
+
+@task
+def extract_tiles(ctx, osm_file, tiles, output_dir):
+    """
+    Extract tiles of an osm extract in a single pass, `tiles` is a json
+    object giving the bounding box of each output file. The ways crossing
+    the border of a tile are kept whole in it.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    with tempfile.NamedTemporaryFile("w", suffix=".json") as config:
+        json.dump(
+            {
+                "directory": output_dir,
+                "extracts": [
+                    {"output": path.basename(output), "bbox": bbox}
+                    for output, bbox in json.loads(tiles).items()
+                ],
+            },
+            config,
+        )
+        config.flush()
+
+        subprocess.run(
+            [
+                "osmium",
+                "extract",
+                "--overwrite",
+                "--strategy=complete_ways",
+                "--config",
+                config.name,
+                osm_file,
+            ],
+            check=True,
+        )
+
+
+@task
+def download_bano(ctx, bano_url, output_file, extract=True, nb_connections=None):
+    """
+    Download BANO in the cache and decompress it into `output_file`, use
+    `--no-extract` to keep only the compressed file in the cache.
+    """
     src_file = path.join(ctx.cache_dir, "bano.csv.gz")
-    download_file(ctx, src_file, bano_url, max_age=timedelta(days=7))
-    ctx.run(f"gunzip -c {src_file} > {output_file}")
+    download_file(
+        ctx, src_file, bano_url, max_age=timedelta(days=7), nb_connections=nb_connections
+    )
+
+    if extract:
+        ctx.run(f"pigz -dc {src_file} > {output_file}")
 
 
 @task
-def download_oa(ctx, src_filename, oa_url, oa_filter, output_dir):
+def download_oa(ctx, src_filename, oa_url, oa_filter, output_dir, nb_connections=None):
     src_file = path.join(ctx.cache_dir, src_filename)
-    download_file(ctx, src_file, oa_url, max_age=timedelta(days=7))
-
-    oa_tmp_dir = path.join(ctx.tmp_dir, "oa")
-    print(f"Unzipping {src_file}...")
-    ctx.run(f"unzip -o -qq -d {oa_tmp_dir} {src_file}")
-    print("Done unzipping!")
+    download_file(
+        ctx, src_file, oa_url, max_age=timedelta(days=7), nb_connections=nb_connections
+    )
 
-    # Collect the list of files to include in the output.
+    # Select the files to include in the output from the archive's index.
     keep_patterns = (fnmatch.translate(pat) for pat in oa_filter.split(","))
     pattern = re.compile("|".join(keep_patterns))
-    included_files = []
 
-    for dirname, _, files in walk(oa_tmp_dir):
-        for filename in files:
-            full_path = path.join(dirname, filename)
-            relt_path = path.relpath(full_path, oa_tmp_dir)
-
-            if pattern.match(relt_path):
-                included_files.append(full_path)
+    with zipfile.ZipFile(src_file) as archive:
+        included_members = [
+            member
+            for member in archive.infolist()
+            if not member.is_dir() and pattern.match(member.filename)
+        ]
 
     # Flatten all .csv into output directory.
-    print("Collect OpenAddresses data")
-    ctx.run(f"mkdir -p {output_dir}")
+    print(f"Collect OpenAddresses data from {src_file}")
+    os.makedirs(output_dir, exist_ok=True)
+    thread_archive = threading.local()
+    opened_archives = []
+
+    def extract(member):
+        # Each thread reads the archive through its own file handle.
+        if not hasattr(thread_archive, "archive"):
+            thread_archive.archive = zipfile.ZipFile(src_file)
+            opened_archives.append(thread_archive.archive)
 
-    for piece in included_files:
-        flat_name = path.join(src_filename, path.relpath(piece, oa_tmp_dir)).replace("/", "__")
+        flat_name = path.join(src_filename, member.filename).replace("/", "__")
+        output_file = path.join(output_dir, flat_name)
         print(f" -> add {flat_name}")
-        ctx.run(f"mv {piece} {output_dir}/{flat_name}")
+
+        with thread_archive.archive.open(member) as src:
+            with open(output_file + ".part", "wb") as dst:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+        os.replace(output_file + ".part", output_file)
+
+    try:
+        with ThreadPoolExecutor(max_workers=ctx.nb_extract_threads) as executor:
+            for _ in executor.map(extract, included_members):
+                pass
+    finally:
+        for archive in opened_archives:
+            archive.close()
@@ -0,0 +1,395 @@
+"""
+Tests of the downloads against a local HTTP server and of the scan of the
+osm changes, run with
+`python -m pytest` from this directory.
+"""
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime
+
+import pytest
+import requests
+from invoke import Config, Context
+
+from conftest import FixturesHandler, load_module
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+tasks = load_module("download_tasks", os.path.join(HERE, "tasks.py"))
+
+SEGMENT_SIZE = 64 * 1024
+
+
+@pytest.fixture
+def ctx(tmpdir):
+    config = Config(
+        overrides={
+            "cache_dir": str(tmpdir.mkdir("cache")),
+            "force_downloads": False,
+            "download": {
+                "nb_connections": 4,
+                "segment_size": SEGMENT_SIZE,
+                "max_retries": 0,
+                "checksums": ["md5", "sha256"],
+            },
+        }
+    )
+    return Context(config)
+
+
+@pytest.fixture
+def served(tmpdir):
+    served = tmpdir.mkdir("served")
+    _write_random(str(served.join("file.bin")), 10 * SEGMENT_SIZE + 123, seed=1)
+    return served
+
+
+def _write_random(filename, size, seed):
+    with open(filename, "wb") as f:
+        f.write(random.Random(seed).getrandbits(8 * size).to_bytes(size, "little"))
+
+
+def _md5(filename):
+    with open(filename, "rb") as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+@pytest.fixture
+def handler():
+    class handler(FixturesHandler):
+        """
+        Record the first byte of the ranges requested (except the probe of
+        the server). The ranges starting at `failing_offsets` fail after
+        `failure_delay` seconds, the others are sent after `delay` seconds.
+        """
+
+        ranges = []
+        failing_offsets = set()
+        failure_delay = 0
+        delay = 0
+
+        def send_head(self):
+            match = re.match(r"bytes=(\d+)-", self.headers.get("Range", ""))
+            if not match or self.headers["Range"] == "bytes=0-0":
+                return super().send_head()
+
+            first = int(match.group(1))
+            handler.ranges.append(first)
+            if first in handler.failing_offsets:
+                time.sleep(handler.failure_delay)
+                self.send_error(500)
+                return None
+
+            time.sleep(handler.delay)
+            return super().send_head()
+
+    return handler
+
+
+def test_download_in_segments(ctx, served, handler, tmpdir, http_server):
+    output = str(tmpdir.join("file.bin"))
+
+    url = http_server(handler, str(served))
+    checksums = tasks.fetch_url(ctx, f"{url}/file.bin", output)
+
+    assert _md5(output) == _md5(str(served.join("file.bin")))
+    assert checksums["md5"] == _md5(output)
+    assert sorted(handler.ranges) == [i * SEGMENT_SIZE for i in range(11)]
+    assert not os.path.exists(output + ".part")
+    assert not os.path.exists(output + ".progress.json")
+
+
+def test_resume_download(ctx, served, handler, tmpdir, http_server):
+    output = str(tmpdir.join("file.bin"))
+    # the other segments are downloaded before the failure
+    handler.failing_offsets = {3 * SEGMENT_SIZE}
+    handler.failure_delay = 0.5
+
+    url = http_server(handler, str(served))
+    with pytest.raises(requests.HTTPError):
+        tasks.fetch_url(ctx, f"{url}/file.bin", output)
+
+    assert os.path.exists(output + ".progress.json")
+    handler.failing_offsets = set()
+    handler.ranges = []
+    checksums = tasks.fetch_url(ctx, f"{url}/file.bin", output)
+
+    assert _md5(output) == _md5(str(served.join("file.bin")))
+    assert checksums["md5"] == _md5(output)
+    # the segments downloaded before the failure are not requested again
+    assert 3 * SEGMENT_SIZE in handler.ranges
+    assert not {0, SEGMENT_SIZE, 2 * SEGMENT_SIZE} & set(handler.ranges)
+
+
+def test_restart_download_when_the_file_changed(ctx, served, handler, tmpdir, http_server):
+    output = str(tmpdir.join("file.bin"))
+    handler.failing_offsets = {3 * SEGMENT_SIZE}
+    handler.failure_delay = 0.5
+
+    url = http_server(handler, str(served))
+    with pytest.raises(requests.HTTPError):
+        tasks.fetch_url(ctx, f"{url}/file.bin", output)
+
+    # a new version of the file, with another validator
+    _write_random(str(served.join("file.bin")), 9 * SEGMENT_SIZE, seed=2)
+    handler.failing_offsets = set()
+    handler.ranges = []
+    checksums = tasks.fetch_url(ctx, f"{url}/file.bin", output)
+
+    assert _md5(output) == _md5(str(served.join("file.bin")))
+    assert checksums["md5"] == _md5(output)
+    assert sorted(handler.ranges) == [i * SEGMENT_SIZE for i in range(9)]
+
+
+def test_file_changed_during_the_download(ctx, served, tmpdir, http_server):
+    output = str(tmpdir.join("file.bin"))
+    ctx.download.nb_connections = 1
+    changed = threading.Event()
+
+    class handler(FixturesHandler):
+        def send_head(self):
+            # the file changes once its first segment is sent
+            if self.headers.get("Range", "").startswith(f"bytes={SEGMENT_SIZE}-"):
+                if not changed.is_set():
+                    _write_random(str(served.join("file.bin")), 10 * SEGMENT_SIZE, seed=3)
+                    changed.set()
+            return super().send_head()
+
+    url = http_server(handler, str(served))
+    with pytest.raises(Exception, match="remote file changed"):
+        tasks.fetch_url(ctx, f"{url}/file.bin", output)
+
+
+def test_stop_on_first_failure(ctx, served, handler, tmpdir, http_server):
+    output = str(tmpdir.join("file.bin"))
+    ctx.download.nb_connections = 2
+    handler.failing_offsets = {0}
+    handler.delay = 0.5
+
+    url = http_server(handler, str(served))
+    with pytest.raises(requests.HTTPError):
+        tasks.fetch_url(ctx, f"{url}/file.bin", output)
+
+    # the segments that were not started yet are not downloaded
+    assert len(handler.ranges) < 11
+
+
+def test_unresponsive_server(ctx, served, tmpdir, http_server, monkeypatch):
+    output = str(tmpdir.join("file.bin"))
+    monkeypatch.setattr(tasks, "REQUEST_TIMEOUT", 0.5)
+
+    class handler(FixturesHandler):
+        def send_head(self):
+            # the connection is accepted, but nothing is sent
+            time.sleep(2)
+            return super().send_head()
+
+    url = http_server(handler, str(served))
+    start = time.time()
+    with pytest.raises(requests.Timeout):
+        tasks.fetch_url(ctx, f"{url}/file.bin", output)
+    assert time.time() - start < 1.5
+
+
+def test_download_without_ranges(ctx, served, tmpdir, http_server):
+    output = str(tmpdir.join("file.bin"))
+
+    class handler(FixturesHandler):
+        def send_head(self):
+            del self.headers["Range"]
+            return super().send_head()
+
+    url = http_server(handler, str(served))
+    checksums = tasks.fetch_url(ctx, f"{url}/file.bin", output)
+
+    assert checksums["md5"] == _md5(output) == _md5(str(served.join("file.bin")))
+
+
+OSM_CHANGE = """<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6" generator="test">
+  <modify>
+    <node id="1" version="2" lat="48.85" lon="2.35"/>
+    <way id="10" version="2">
+      <nd ref="1"/>
+      <nd ref="2"/>
+    </way>
+  </modify>
+  <create>
+    <node id="3" version="1" lat="48.86" lon="2.36">
+      <tag k="amenity" v="cafe"/>
+    </node>
+  </create>
+  <delete>
+    <relation id="100" version="3"/>
+  </delete>
+</osmChange>
+"""
+
+
+@pytest.fixture
+def osm_change(tmpdir):
+    filename = str(tmpdir.join("change.osc.gz"))
+    with gzip.open(filename, "wt") as f:
+        f.write(OSM_CHANGE)
+    return filename
+
+
+def test_scan_osm_change(osm_change):
+    counts, kinds = tasks.scan_osm_change(osm_change)
+
+    assert counts == {"node": 2, "way": 1, "relation": 1}
+    # the way and the relation are not boundaries
+    assert kinds == {"streets", "pois"}
+
+
+def test_scan_osm_change_of_boundaries(osm_change):
+    boundaries = tasks.parse_boundaries(
+        [
+            "r100 v2 dV c1 t2020-01-01T00:00:00Z i1 u Tboundary=administrative"
+            " Mw11@outer,w12@outer,n5@admin_centre",
+            "r200 v1 dV c1 t2020-01-01T00:00:00Z i1 u Tboundary=administrative Mw10@outer",
+        ]
+    )
+    assert boundaries == ({100, 200}, {10, 11, 12}, set())
+
+    _, kinds = tasks.scan_osm_change(osm_change, boundaries)
+    assert kinds == {"admins", "streets", "pois"}
+
+
+@pytest.mark.parametrize(
+    "action, osm_type, tags, osm_id, kinds",
+    [
+        ("create", "relation", {"boundary": "administrative"}, 1, {"admins"}),
+        ("modify", "relation", {"type": "route"}, 1, set()),
+        ("modify", "relation", {"type": "route"}, 100, {"admins"}),
+        ("delete", "relation", {}, 1, set()),
+        ("delete", "relation", {}, 100, {"admins"}),
+        ("modify", "way", {}, 1, set()),
+        ("modify", "way", {}, 10, {"admins"}),
+        ("modify", "way", {"highway": "residential"}, 1, {"streets"}),
+        ("delete", "way", {}, 10, {"admins", "streets", "pois", "addresses"}),
+        ("create", "node", {"place": "city"}, 1, {"admins"}),
+        ("modify", "node", {}, 1, {"streets"}),
+        ("modify", "node", {}, 5, {"admins", "streets"}),
+        ("create", "node", {"addr:housenumber": "1"}, 1, {"addresses"}),
+    ],
+)
+def test_changed_kinds(action, osm_type, tags, osm_id, kinds):
+    assert tasks.changed_kinds(action, osm_type, tags, osm_id, ({100}, {10}, {5})) == kinds
+
+
+def test_scan_osm_change_of_boundary_nodes(osm_change):
+    # the ways are written before the relations, with their nodes
+    boundaries = tasks.parse_boundaries(
+        [
+            "w20 v1 dV c1 t2020-01-01T00:00:00Z i1 u Tboundary=administrative Nn1,n4,n1",
+            "w21 v1 dV c1 t2020-01-01T00:00:00Z i1 u T Nn5,n6",
+            "r300 v1 dV c1 t2020-01-01T00:00:00Z i1 u Tboundary=administrative Mw20@outer",
+        ]
+    )
+    assert boundaries == ({300}, {20}, {1, 4})
+
+    # the node 1 of the boundary is moved
+    _, kinds = tasks.scan_osm_change(osm_change, boundaries)
+    assert kinds == {"admins", "streets", "pois"}
+
+
+def test_update_from_another_replication(ctx, tmpdir, monkeypatch, capsys, http_server):
+    served = tmpdir.mkdir("replication")
+    served.join("state.txt").write("sequenceNumber=105\n")
+    output = str(tmpdir.join("extract.osm.pbf"))
+    with open(output, "w") as f:
+        f.write("extract")
+
+    # the extract was updated from another replication, at a close sequence
+    ctx.osm_update = {"max_diffs": 10}
+    tasks.save_file_status(
+        ctx,
+        output,
+        {
+            "last_update": datetime.utcnow(),
+            "replication_url": "http://other/replication",
+            "replication_sequence": 100,
+        },
+    )
+    downloads = []
+
+    def download(ctx, filename, url, **kwargs):
+        # the extract is locked during its update
+        with open(filename + ".lock") as lock, pytest.raises(BlockingIOError):
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        downloads.append(url)
+
+    monkeypatch.setattr(tasks, "download_locked_file", download)
+    monkeypatch.setattr(tasks, "read_pbf_header", lambda f: {"replication_sequence": 104})
+
+    url = http_server(FixturesHandler, str(served))
+    tasks.update_osm(ctx, f"{url}/extract.osm.pbf", url, output)
+
+    result = json.loads(capsys.readouterr().out.splitlines()[-1])
+    assert result["full_download"] and result["sequence"] == 104
+    assert downloads == [f"{url}/extract.osm.pbf"]
+    status = tasks.raw_file_status(ctx, output)
+    assert (status["replication_url"], status["replication_sequence"]) == (url, 104)
+
+
+def _varint(value):
+    value &= (1 << 64) - 1
+    data = bytearray()
+    while value > 0x7F:
+        data.append(value & 0x7F | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def _field(number, value):
+    if isinstance(value, bytes):
+        return _varint(number << 3 | 2) + _varint(len(value)) + value
+    return _varint(number << 3) + _varint(value)
+
+
+def _packed_sint64(values):
+    data, previous = b"", 0
+    for value in values:
+        delta = value - previous
+        data += _varint(delta << 1 ^ delta >> 63)
+        previous = value
+    return data
+
+
+def _write_pbf(filename, blocks):
+    with open(filename, "wb") as f:
+        for blob_type, block in blocks:
+            blob = _field(1, block)
+            header = _field(1, blob_type.encode()) + _field(3, len(blob))
+            f.write(len(header).to_bytes(4, "big") + header + blob)
+
+
+def test_sample_pbf_nodes_with_negative_offsets(tmpdir):
+    filename = str(tmpdir.join("extract.osm.pbf"))
+    dense = (
+        _field(1, _packed_sint64([1, 2]))
+        + _field(8, _packed_sint64([10, 20]))
+        + _field(9, _packed_sint64([-10, 30]))
+    )
+    # offsets of -1 and -2 degrees, in nanodegrees
+    block = (
+        _field(2, _field(2, dense))
+        + _field(17, 100)
+        + _field(19, -1_000_000_000)
+        + _field(20, -2_000_000_000)
+    )
+    _write_pbf(filename, [("OSMHeader", b""), ("OSMData", block)])
+
+    points = tasks.sample_pbf_nodes(filename, nb_blobs=1)
+
+    assert points == pytest.approx([(-2.000001, -0.999999), (-1.999997, -0.999998)])
@@ -0,0 +1,59 @@
+"""
+pytest plugin deselecting the tests whose result is cached (see `run_pytest`
+in tasks.py)
+"""
+import os
+import re
+
+import pytest
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--cached-tests", help="file listing the ids of the tests to deselect"
+    )
+    parser.addoption(
+        "--cached-tests-report", help="file where the ids of the deselected tests are written"
+    )
+
+
+def test_id(nodeid):
+    """
+    id of a test in the junitxml reports ('<classname>::<name>')
+
+    >>> test_id("world/france/test_poi.yml::test_poi[q=louvre]")
+    'world.france.test_poi.yml::test_poi[q=louvre]'
+    >>> test_id("world/test_admin.py::TestAdmin::()::test_city[a::b]")
+    'world.test_admin.TestAdmin::test_city[a::b]'
+    """
+    # same as the mangling of the node ids by the junitxml plugin of pytest
+    path, bracket, params = nodeid.partition("[")
+    names = [n for n in path.split("::") if n != "()"]
+    names[0] = re.sub(r"\.py$", "", names[0].replace("/", "."))
+    names[-1] += bracket + params
+    return "{}::{}".format(".".join(names[:-1]), names[-1])
+
+
+@pytest.hookimpl(trylast=True)
+def pytest_collection_modifyitems(config, items):
+    cached_file = config.getoption("cached_tests")
+    if not cached_file:
+        return
+
+    with open(cached_file) as f:
+        cached = set(line.rstrip("\n") for line in f)
+
+    deselected = [item for item in items if test_id(item.nodeid) in cached]
+    if not deselected:
+        return
+    items[:] = [item for item in items if test_id(item.nodeid) not in cached]
+    config.hook.pytest_deselected(items=deselected)
+
+    report_file = config.getoption("cached_tests_report")
+    if report_file:
+        # each xdist worker collects the same tests, the file is replaced
+        # atomically
+        tmp_file = f"{report_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            f.writelines(test_id(item.nodeid) + "\n" for item in deselected)
+        os.replace(tmp_file, report_file)
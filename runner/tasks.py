@@ -1,11 +1,24 @@
-from invoke import task
+from invoke import Exit, task
+import asyncio
+import glob
+import itertools
 import os
+import ssl
 import datetime
+import math
 import re
 import logging
 import requests
 import csv
 import json
+import sqlite3
+import statistics
+import subprocess
+import xml.etree.ElementTree as ET
+import yaml
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from urllib.parse import urlencode, urlparse
 
 logging.basicConfig(level=logging.INFO)
 
@@ -120,21 +133,372 @@ def _get_results(region, category, pytest_logs):
     return res
 
 
+PROGRESS_LINE_PATTERN = re.compile("^(\\S+ )?(?P<results>[.FEsxX]+)( +\\[ *\\d+%\\])?$")
+
+COLLECTED_PATTERN = re.compile("(collected (?P<collected>\\d+) items?|\\[(?P<workers>\\d+)\\] / gw|\\[(?P<items>\\d+) items?\\])")
+
+
+def _progress_results(line):
+    """
+    number of tests done, passed and failed on a progress line of pytest
+
+    >>> _progress_results("world/france/test_poi.yml ..F.s     [ 42%]")
+    (5, 3, 1)
+    >>> _progress_results("..........E [100%]")
+    (11, 10, 1)
+    >>> _progress_results("===== 1 failed in 1 seconds =====")
+    (0, 0, 0)
+    """
+    match = PROGRESS_LINE_PATTERN.match(line.rstrip())
+    if not match:
+        return 0, 0, 0
+    results = match.group("results")
+    return len(results), results.count("."), results.count("F") + results.count("E")
+
+
+def _nb_collected(line):
+    """
+    number of tests to run, from the collection line of pytest
+
+    >>> _nb_collected("collected 1234 items / 34 deselected / 1200 selected")
+    1234
+    >>> _nb_collected("gw0 [1200] / gw1 [1200]")
+    1200
+    >>> _nb_collected("12 workers [1200 items]")
+    1200
+    >>> _nb_collected("world/france/test_poi.yml ..F.s") is None
+    True
+    """
+    match = COLLECTED_PATTERN.search(line)
+    if not match:
+        return None
+    return int(next(g for g in match.group("collected", "workers", "items") if g))
+
+
+class _Progress:
+    """
+    progress of a pytest run, from its output
+
+    only the counters and the last summary line are kept
+    """
+
+    def __init__(self, name, interval):
+        self.name = name
+        self.interval = interval
+        self.start = self.last_log = time()
+        self.total = None
+        self.done = self.passed = self.failed = 0
+        self.summary_line = ""
+
+    def feed(self, line):
+        if RESULT_LINE_PATTERN.match(line):
+            self.summary_line = line.strip()
+        elif self.done == 0 and _nb_collected(line):
+            # only the selected tests are run
+            selected = re.search("(\\d+) selected", line)
+            self.total = int(selected.group(1)) if selected else _nb_collected(line)
+        else:
+            done, passed, failed = _progress_results(line)
+            self.done += done
+            self.passed += passed
+            self.failed += failed
+
+        if self.interval and time() - self.last_log >= self.interval:
+            self.last_log = time()
+            logging.info(self.status())
+
+    def status(self):
+        elapsed = time() - self.start
+        rate = self.done / elapsed if elapsed else 0
+        status = f"{self.name}: {self.done}/{self.total or '?'} tests, {rate:.1f} tests/s"
+        if self.passed + self.failed:
+            status += f", {self.passed / (self.passed + self.failed):.0%} passed"
+        if self.total and rate:
+            eta = datetime.timedelta(seconds=round((self.total - self.done) / rate))
+            status += f", ETA {eta}"
+        return status
+
+
+WORKERS_ARG_PATTERN = re.compile("^(-n|--numprocesses)[= ]?(?P<workers>\\d+|auto)$")
+
+
+def _split_workers_arg(args):
+    """
+    split the number of pytest-xdist workers from the additional pytest args
+
+    >>> _split_workers_arg(["--check-duplicates=10", "-n 12", "--https-no-verify"])
+    (['--check-duplicates=10', '--https-no-verify'], 12)
+    >>> _split_workers_arg(["--numprocesses=3"])
+    ([], 3)
+    >>> _split_workers_arg(["--https-no-verify"])
+    (['--https-no-verify'], None)
+    """
+    workers = None
+    other_args = []
+    for arg in args:
+        match = WORKERS_ARG_PATTERN.match(arg.strip())
+        if not match:
+            other_args.append(arg)
+        elif match.group("workers") == "auto":
+            workers = os.cpu_count()
+        else:
+            workers = int(match.group("workers"))
+    return other_args, workers
+
+
+def _share_workers(workers, max_parallel_jobs, nb_jobs):
+    """
+    number of jobs to run at the same time and number of workers of each job,
+    within the budget of workers
+
+    >>> _share_workers(12, 4, 10)
+    (4, 3)
+    >>> _share_workers(12, 4, 2)
+    (2, 6)
+    >>> _share_workers(2, 4, 10)
+    (2, 1)
+    >>> _share_workers(None, 4, 10)
+    (4, None)
+    """
+    parallel = max(1, min(max_parallel_jobs, nb_jobs, workers or max_parallel_jobs))
+    return parallel, (workers // parallel if workers else None)
+
+
+def _open_results_db(ctx):
+    """
+    database of the results of the tests, by test id, geocoder version and
+    dataset fingerprint
+    """
+    path = ctx.get("results_db") or os.path.join(ctx.base_output_dir, "results.sqlite")
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    db = sqlite3.connect(path, timeout=60)
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS results (
+            test_id TEXT,
+            version TEXT,
+            fingerprint TEXT,
+            passed INTEGER,
+            duration REAL,
+            run_at REAL,
+            PRIMARY KEY (test_id, version, fingerprint)
+        )
+        """
+    )
+    # history of the runs of run-all, with the results of each region/category
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            run_at REAL,
+            name TEXT,
+            url TEXT,
+            version TEXT,
+            fingerprint TEXT,
+            output_dir TEXT
+        )
+        """
+    )
+    db.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS run_results (
+            run_id INTEGER REFERENCES runs(id),
+            region TEXT,
+            category TEXT,
+            {", ".join(f"{c} REAL" for c in HISTORY_COLUMN)}
+        )
+        """
+    )
+    return db
+
+
+# results of a region/category kept in the history of the runs
+HISTORY_COLUMN = [
+    "failed",
+    "total",
+    "cached",
+    "duration_seconds",
+    "p50_ms",
+    "p95_ms",
+    "p99_ms",
+    "max_ms",
+    "qps",
+]
+
+
+def _save_run(ctx, name, url, version, fingerprint, results):
+    with _open_results_db(ctx) as db:
+        run_id = db.execute(
+            "INSERT INTO runs (run_at, name, url, version, fingerprint, output_dir)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (time(), name, url, version or "", fingerprint or "", ctx.output_dir),
+        ).lastrowid
+        db.executemany(
+            f"INSERT INTO run_results VALUES (?, ?, ?, {', '.join('?' for _ in HISTORY_COLUMN)})",
+            [
+                [run_id, r["region"], r["category"]] + [r.get(c) for c in HISTORY_COLUMN]
+                for r in results
+            ],
+        )
+    db.close()
+
+
+def _read_junitxml(xml_file):
+    """
+    results of the test cases of a junitxml report: (test id, passed, duration)
+    """
+    results = []
+    for case in ET.parse(xml_file).iter("testcase"):
+        if case.find("skipped") is not None:
+            continue
+        passed = case.find("failure") is None and case.find("error") is None
+        test_id = f"{case.get('classname', '')}::{case.get('name')}"
+        results.append((test_id, passed, _safe_cast(case.get("time"), float)))
+    return results
+
+
+def _junitxml_duration(xml_file):
+    """
+    duration (in s) of the tests of a junitxml report, measured by pytest
+    from the start of its session: the startup of pytest is not counted.
+    None if the report doesn't give it
+    """
+    root = ET.parse(xml_file).getroot()
+    suites = [root] if root.tag == "testsuite" else root.findall("testsuite")
+    durations = [_safe_cast(suite.get("time"), float) for suite in suites]
+    if not durations or None in durations:
+        return None
+    return sum(durations)
+
+
+def _save_results(ctx, results, run_at, version, fingerprint):
+    with _open_results_db(ctx) as db:
+        db.executemany(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (test_id, version or "", fingerprint or "", passed, duration, run_at)
+                for test_id, passed, duration in results
+            ],
+        )
+    db.close()
+
+
+def _cached_tests(ctx, version, fingerprint):
+    """
+    ids of the tests that passed with this version and dataset
+    """
+    db = _open_results_db(ctx)
+    try:
+        return [
+            test_id
+            for test_id, in db.execute(
+                "SELECT test_id FROM results WHERE version = ? AND fingerprint = ? AND passed",
+                (version or "", fingerprint or ""),
+            )
+        ]
+    finally:
+        db.close()
+
+
+def _percentile(values, percent):
+    """
+    percentile of sorted values (nearest rank)
+
+    >>> _percentile([1, 2, 3, 4], 50)
+    2
+    >>> _percentile([1, 2, 3, 4], 99)
+    4
+    >>> _percentile([], 50) is None
+    True
+    """
+    if not values:
+        return None
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+def _latency_stats(durations, wall_time):
+    """
+    latency percentiles (in ms) of the queries and number of queries per
+    second of a run
+
+    >>> _latency_stats([0.010, 0.020, 0.030, 0.500], 2)
+    {'p50_ms': 20, 'p95_ms': 500, 'p99_ms': 500, 'max_ms': 500, 'qps': 2.0}
+    >>> _latency_stats([], 2)
+    {}
+    """
+    durations = sorted(d for d in durations if d is not None)
+    if not durations:
+        return {}
+    stats = {
+        f"{name}_ms": round(_percentile(durations, percent) * 1000)
+        for name, percent in [("p50", 50), ("p95", 95), ("p99", 99), ("max", 100)]
+    }
+    stats["qps"] = round(len(durations) / wall_time, 1) if wall_time else None
+    return stats
+
+
+def _write_latencies(latency_file, results):
+    with open(latency_file, "w") as f:
+        w = csv.writer(f)
+        w.writerow(["test_id", "passed", "latency_ms"])
+        for test_id, passed, duration in sorted(results, key=lambda r: -(r[2] or 0)):
+            w.writerow([test_id, int(passed), round(duration * 1000) if duration is not None else None])
+
+
+def _add_cached(res, nb_cached):
+    """
+    add the cached results to the results of a run
+
+    >>> _add_cached({'failed': 1, 'total': 2, 'duration': '0:00:01', 'ratio': '50%'}, 2)
+    {'failed': 1, 'total': 4, 'duration': '0:00:01', 'ratio': '75%', 'cached': 2}
+    """
+    if "total" in res:
+        res["total"] += nb_cached
+        ratio = (res["total"] - res["failed"]) / res["total"] if res["total"] else 0
+        res["ratio"] = f"{ratio:.0%}"
+    res["cached"] = nb_cached
+    return res
+
+
 @task
-def run_pytest(ctx, url, name, region, category):
+def run_pytest(
+    ctx,
+    url,
+    name,
+    region,
+    category,
+    workers=None,
+    version=None,
+    fingerprint=None,
+    changed_only=False,
+):
     _init_output_dir(ctx, name)
     directory = f"{ctx.geocoder_sources}/geocoder_tester/world/{region}"
     category_name = category["name"]
 
-    if category.get("remaining_tests"):
-        selector = _get_remaining_tests(ctx)
-    else:
-        selector = category["selector"]
+    selector = _category_selector(ctx, category)
 
-    additional_args = " ".join(ctx.get("additional_pytest_args", []))
+    additional_args, default_workers = _split_workers_arg(ctx.get("additional_pytest_args", []))
+    workers = workers or default_workers
+    if workers:
+        additional_args.append(f"-n {workers}")
     test_name = f"{region}_{category_name}"
     report_file = os.path.join(ctx.output_dir, f"{test_name}_report.txt")
     xml_report_file = os.path.join(ctx.output_dir, f"{test_name}_report.xml")
+
+    cached_report_file = os.path.join(ctx.output_dir, f"{test_name}_cached.txt")
+    if changed_only:
+        # the tests that passed with the same version and dataset are not run
+        # again, they are deselected by the cached_tests plugin
+        cached_file = os.path.join(ctx.output_dir, f"{test_name}_cached_tests.txt")
+        with open(cached_file, "w") as f:
+            f.writelines(t + "\n" for t in _cached_tests(ctx, version, fingerprint))
+        additional_args += [
+            "-p cached_tests",
+            f"--cached-tests={cached_file}",
+            f"--cached-tests-report={cached_report_file}",
+        ]
+    additional_args = " ".join(additional_args)
     py_test = " ".join(
         [
             f"pytest {directory}",
@@ -153,16 +517,67 @@ def run_pytest(ctx, url, name, region, category):
         # we create the parent dir if needed
         os.makedirs(os.path.dirname(log_file))
 
+    start = time()
+    progress = _Progress(test_name, ctx.get("progress_interval", 30))
+    # the cached_tests plugin is next to this file
+    python_path = os.pathsep.join(
+        filter(None, [os.path.dirname(os.path.abspath(__file__)), os.environ.get("PYTHONPATH")])
+    )
     with open(log_file, "w") as log_file:
-        res = ctx.run(py_test, out_stream=log_file, warn=True)
+        # the output is parsed while it's written in the log, without keeping
+        # it in memory
+        process = subprocess.Popen(
+            py_test,
+            shell=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            encoding="utf-8",
+            errors="replace",
+            env=dict(os.environ, PYTHONPATH=python_path),
+        )
+        for line in process.stdout:
+            log_file.write(line)
+            progress.feed(line)
+        process.wait()
 
-        # print(f'res: {res.stdout}')
-        res = _get_results(region, category_name, res.stdout)
-        logging.info(f"result = {res}")
-        return res
+    logging.info(progress.status())
+    res = _get_results(region, category_name, progress.summary_line)
+    wall_time = time() - start
+    res["duration_seconds"] = round(wall_time, 1)
+
+    if os.path.exists(xml_report_file):
+        # the latency of a query is the duration of its test case, the
+        # queries per second don't count the startup of pytest
+        results = _read_junitxml(xml_report_file)
+        tests_time = _junitxml_duration(xml_report_file) or wall_time
+        res.update(_latency_stats([r[2] for r in results], tests_time))
+        _write_latencies(os.path.join(ctx.output_dir, f"{test_name}_latency.csv"), results)
+        _save_results(ctx, results, os.path.getmtime(xml_report_file), version, fingerprint)
+    if changed_only:
+        nb_cached = 0
+        if os.path.exists(cached_report_file):
+            with open(cached_report_file) as f:
+                nb_cached = sum(1 for _ in f)
+        _add_cached(res, nb_cached)
+
+    logging.info(f"result = {res}")
+    return res
 
 
-REPORT_COLUMN = ["region", "category", "failed", "total", "ratio", "duration"]
+REPORT_COLUMN = [
+    "region",
+    "category",
+    "failed",
+    "total",
+    "ratio",
+    "duration",
+    "cached",
+    "p50_ms",
+    "p95_ms",
+    "p99_ms",
+    "max_ms",
+    "qps",
+]
 
 
 def _get_version(url):
@@ -184,8 +599,19 @@ def _get_version(url):
 
 
 @task(default=True)
-def run_all(ctx, url=None, name="geocoder-tester", regions=None):
+def run_all(
+    ctx, url=None, name="geocoder-tester", regions=None, fingerprint=None, changed_only=False
+):
+    """
+    run the tests of all the regions and categories
+
+    the results are kept in a database, by geocoder version and dataset
+    fingerprint (which identifies the imported data). With --changed-only,
+    only the tests that are new or did not pass with this version and dataset
+    are run, the report adds the cached results.
+    """
     _init_output_dir(ctx, name)
+    fingerprint = fingerprint or ctx.get("dataset_fingerprint")
     url = url or ctx.url
     if regions:  # we use this parameter to override the categories
         ctx.regions = regions.split(",")
@@ -194,16 +620,29 @@ def run_all(ctx, url=None, name="geocoder-tester", regions=None):
 
     logging.info(f"testing {name} on {url}")
 
-    res = []
-
     version = _get_version(url)
     if version:
         logging.info(f"testing version {version}")
-    for region in ctx.regions:
-        for category in ctx.categories:
-            logging.info(f"running tests on {region} / {category}")
-            r = run_pytest(ctx, url, name, region, category)
-            res.append(r)
+    # the region/category jobs are run concurrently, sharing the workers
+    jobs = [(region, category) for region in ctx.regions for category in ctx.categories]
+    scheduler = ctx.get("scheduler", {})
+    workers = scheduler.get("workers") or _split_workers_arg(
+        ctx.get("additional_pytest_args", [])
+    )[1]
+    parallel, job_workers = _share_workers(
+        workers, scheduler.get("max_parallel_jobs") or 1, len(jobs)
+    )
+    logging.info(f"running {len(jobs)} jobs, {parallel} at a time with {job_workers} workers each")
+
+    def run_job(region, category):
+        logging.info(f"running tests on {region} / {category}")
+        return run_pytest(
+            ctx, url, name, region, category, job_workers, version, fingerprint, changed_only
+        )
+
+    with ThreadPoolExecutor(max_workers=parallel) as pool:
+        futures = [pool.submit(run_job, region, category) for region, category in jobs]
+        res = [f.result() for f in futures]
 
     report = "\n".join(_pretty_print(res, REPORT_COLUMN))
     logging.info(report)
@@ -212,18 +651,29 @@ def run_all(ctx, url=None, name="geocoder-tester", regions=None):
     with open(report_file, "w") as log_file:
         log_file.write(f"report on '{name}'\n")
         log_file.write(f"queries made on {url} | version = {version} \n")
+        if fingerprint:
+            log_file.write(f"dataset fingerprint = {fingerprint}\n")
         log_file.write(report)
 
     report_file = os.path.join(ctx.output_dir, f"report.json")
     with open(report_file, "w") as log_file:
-        data = {"name": name, "url": url, "version": version, "md_report": report}
+        data = {
+            "name": name,
+            "url": url,
+            "version": version,
+            "fingerprint": fingerprint,
+            "md_report": report,
+            "results": [{k: r.get(k) for k in REPORT_COLUMN} for r in res],
+        }
         log_file.write(json.dumps(data, indent=2))
 
+    _save_run(ctx, name, url, version, fingerprint, res)
+
     # print also a csv to better compare the results
     csv_file = os.path.join(ctx.output_dir, f"report.csv")
     csv_column = REPORT_COLUMN + ["directory", "url", "name", "version"]
     with open(csv_file, "w") as csv_file:
-        w = csv.DictWriter(csv_file, csv_column)
+        w = csv.DictWriter(csv_file, csv_column, extrasaction="ignore")
         w.writeheader()
         for r in res:
             r.update(
@@ -235,3 +685,581 @@ def run_all(ctx, url=None, name="geocoder-tester", regions=None):
                 }
             )
             w.writerow(r)
+
+
+# parameters of the geocoder-tester test cases sent with the queries
+QUERY_PARAMS = {"query": "q", "lat": "lat", "lon": "lon", "lang": "lang", "limit": "limit"}
+
+
+def _query_params(case):
+    """
+    parameters of the query of a geocoder-tester test case
+
+    >>> _query_params({"query": "rue de rivoli", "lang": "fr", "expected": {}})
+    {'q': 'rue de rivoli', 'lang': 'fr'}
+    >>> _query_params({"expected": {}}) is None
+    True
+    """
+    if not case.get("query"):
+        return None
+    return {p: case[k] for k, p in QUERY_PARAMS.items() if case.get(k) not in (None, "")}
+
+
+def _find_test_cases(data):
+    # the test cases are the dicts with a query, at any level of the yaml
+    if isinstance(data, dict) and "query" in data:
+        yield data
+    elif isinstance(data, (dict, list)):
+        for d in data.values() if isinstance(data, dict) else data:
+            yield from _find_test_cases(d)
+
+
+def _load_queries(ctx, regions):
+    """
+    queries of the test cases (yaml and csv files) of the geocoder-tester
+    regions
+    """
+    queries = []
+    for region in regions:
+        directory = f"{ctx.geocoder_sources}/geocoder_tester/world/{region}"
+        for path in sorted(glob.glob(f"{directory}/**/*", recursive=True)):
+            try:
+                if path.endswith((".yml", ".yaml")):
+                    with open(path) as f:
+                        cases = list(_find_test_cases(yaml.safe_load(f)))
+                elif path.endswith(".csv"):
+                    with open(path) as f:
+                        cases = list(csv.DictReader(f))
+                else:
+                    continue
+            except (yaml.YAMLError, csv.Error, UnicodeDecodeError) as e:
+                logging.warning(f"skipping {path}: {e}")
+                continue
+            queries += [p for p in map(_query_params, cases) if p]
+    return queries
+
+
+class _ConnectionPool:
+    """
+    keep-alive HTTP/1.1 connections to a host, at most `size` at the same time
+    """
+
+    def __init__(self, loop, url, size, timeout):
+        self.loop = loop
+        self.url = urlparse(url)
+        self.timeout = timeout
+        self.idle = []
+        self.slots = asyncio.Semaphore(size)
+
+    async def get(self, params):
+        """
+        send a GET request, return the status of the response
+        """
+        await self.slots.acquire()
+        try:
+            while True:
+                reused = bool(self.idle)
+                conn = self.idle.pop() if reused else await self._connect()
+                try:
+                    status, keep_alive = await asyncio.wait_for(
+                        self._request(conn, params), self.timeout
+                    )
+                    break
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    conn[1].close()
+                    # the server may have closed an idle connection
+                    if not reused:
+                        raise
+                except BaseException:
+                    conn[1].close()
+                    raise
+            if keep_alive:
+                self.idle.append(conn)
+            else:
+                conn[1].close()
+            return status
+        finally:
+            self.slots.release()
+
+    async def _connect(self):
+        https = self.url.scheme == "https"
+        return await asyncio.open_connection(
+            self.url.hostname,
+            self.url.port or (443 if https else 80),
+            ssl=ssl.create_default_context() if https else None,
+        )
+
+    async def _request(self, conn, params):
+        reader, writer = conn
+        path = f"{self.url.path or '/'}?{urlencode(params)}"
+        writer.write(
+            f"GET {path} HTTP/1.1\r\nHost: {self.url.netloc}\r\n"
+            "Connection: keep-alive\r\n\r\n".encode()
+        )
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError("connection closed by the server")
+        version, status = status_line.decode().split()[:2]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, _, value = line.decode().partition(":")
+            headers[key.strip().lower()] = value.strip()
+
+        keep_alive = version == "HTTP/1.1" and headers.get("connection") != "close"
+        if headers.get("transfer-encoding") == "chunked":
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                await reader.readexactly(size + 2)
+                if size == 0:
+                    break
+        elif "content-length" in headers:
+            await reader.readexactly(int(headers["content-length"]))
+        else:
+            await reader.read()
+            keep_alive = False
+        return int(status), keep_alive
+
+
+# upper bounds (in ms) of the buckets of the latency histogram
+LATENCY_BUCKETS = [5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+
+def _histogram(latencies):
+    """
+    number of latencies (in s) by bucket
+
+    >>> _histogram([0.001, 0.004, 0.015, 7])
+    {'<=5ms': 2, '<=20ms': 1, '>5000ms': 1}
+    """
+    histogram = {}
+    for latency in latencies:
+        bucket = next(
+            (f"<={b}ms" for b in LATENCY_BUCKETS if latency * 1000 <= b),
+            f">{LATENCY_BUCKETS[-1]}ms",
+        )
+        histogram[bucket] = histogram.get(bucket, 0) + 1
+    return histogram
+
+
+class _Level:
+    """
+    results of a level of load (a number of clients or a rate of queries)
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+
+    def record(self, latency, status):
+        if status == 200:
+            self.latencies.append(latency)
+        else:
+            self.errors += 1
+
+    def stats(self, duration):
+        sent = len(self.latencies) + self.errors
+        stats = {
+            "level": self.name,
+            "sent": sent,
+            "errors": self.errors,
+            "error_rate": f"{self.errors / sent:.1%}" if sent else None,
+        }
+        stats.update(_latency_stats(self.latencies, duration))
+        stats["histogram"] = _histogram(self.latencies)
+        return stats
+
+
+async def _send(pool, params, level, scheduled_at):
+    # the latency of an open loop includes the time waiting for a connection
+    try:
+        status = await pool.get(params)
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+        logging.debug(f"query {params} failed: {e}")
+        status = None
+    if level:
+        level.record(time() - scheduled_at, status)
+
+
+async def _closed_loop(pool, queries, clients, duration, level):
+    """
+    `clients` clients sending a query as soon as they got the previous answer
+    """
+    end = time() + duration
+
+    async def client():
+        while time() < end:
+            await _send(pool, next(queries), level, time())
+
+    await asyncio.gather(*[client() for _ in range(clients)])
+
+
+async def _open_loop(pool, queries, qps, duration, level):
+    """
+    queries sent at a fixed rate, whatever the answers
+    """
+    start = time()
+    tasks = []
+    for i in range(int(qps * duration)):
+        scheduled_at = start + i / qps
+        await asyncio.sleep(max(0, scheduled_at - time()))
+        tasks.append(pool.loop.create_task(_send(pool, next(queries), level, scheduled_at)))
+    if tasks:
+        await asyncio.wait(tasks)
+
+
+async def _load_test(loop, url, queries, mode, levels, conf):
+    pool = _ConnectionPool(
+        loop,
+        url,
+        int(conf.get("max_connections") or max(levels)),
+        float(conf.get("timeout") or 10),
+    )
+    run = _closed_loop if mode == "closed" else _open_loop
+    duration = float(conf.get("duration") or 30)
+    warmup = float(conf.get("warmup") or 0)
+
+    if warmup:
+        logging.info(f"warming up for {warmup}s")
+        await run(pool, queries, levels[0], warmup, None)
+
+    results = []
+    for value in levels:
+        name = f"{value} clients" if mode == "closed" else f"{value} qps"
+        logging.info(f"running {name} for {duration}s")
+        level = _Level(name)
+        start = time()
+        await run(pool, queries, value, duration, level)
+        results.append(level.stats(time() - start))
+        logging.info(f"{name}: {results[-1]}")
+
+    for reader, writer in pool.idle:
+        writer.close()
+    return results
+
+
+def _saturation_qps(results, max_error_rate):
+    """
+    highest throughput reached with at most `max_error_rate` errors
+
+    >>> _saturation_qps([
+    ...     {"qps": 10.0, "sent": 100, "errors": 0},
+    ...     {"qps": 30.0, "sent": 300, "errors": 1},
+    ...     {"qps": 40.0, "sent": 400, "errors": 80},
+    ... ], 0.01)
+    30.0
+    """
+    return max(
+        (
+            r.get("qps") or 0
+            for r in results
+            if r["sent"] and r["errors"] / r["sent"] <= max_error_rate
+        ),
+        default=None,
+    )
+
+
+LOAD_TEST_COLUMN = [
+    "level",
+    "sent",
+    "errors",
+    "error_rate",
+    "p50_ms",
+    "p95_ms",
+    "p99_ms",
+    "max_ms",
+    "qps",
+]
+
+
+@task(iterable=["levels"])
+def load_test(ctx, url=None, name="load-test", regions=None, mode=None, levels=None):
+    """
+    replay the queries of the geocoder-tester regions against the geocoder
+
+    closed mode: each level is a number of concurrent clients, sending their
+    next query as soon as they get an answer
+    open mode: each level is a rate of queries (per second), sent whatever the
+    answers
+
+    each level runs `load_test.duration` seconds, after a warm-up of
+    `load_test.warmup` seconds. The saturation throughput is the highest rate
+    of answers with at most `load_test.max_error_rate` errors.
+    """
+    _init_output_dir(ctx, name)
+    url = url or ctx.url
+    if not url:
+        raise Exception("no url provided")
+    conf = ctx.get("load_test", {})
+    regions = regions.split(",") if regions else ctx.regions
+    mode = mode or conf.get("mode") or "closed"
+    if mode not in ("closed", "open"):
+        raise Exception(f"unknown load test mode '{mode}'")
+    levels = [float(l) if mode == "open" else int(l) for l in levels or conf.get(mode) or []]
+    if not levels:
+        raise Exception(f"no levels of load for the {mode} mode")
+
+    queries = _load_queries(ctx, regions)
+    if not queries:
+        raise Exception(f"no queries found in {regions}")
+    logging.info(f"load testing {url} with {len(queries)} queries ({mode} loop)")
+
+    loop = asyncio.new_event_loop()
+    try:
+        results = loop.run_until_complete(
+            _load_test(loop, url, itertools.cycle(queries), mode, levels, conf)
+        )
+    finally:
+        loop.close()
+    saturation = _saturation_qps(results, float(conf.get("max_error_rate") or 0.01))
+
+    report = "\n".join(_pretty_print(results, LOAD_TEST_COLUMN))
+    logging.info(report)
+    logging.info(f"saturation throughput: {saturation} qps")
+
+    with open(os.path.join(ctx.output_dir, "load_test.log"), "w") as log_file:
+        log_file.write(f"load test '{name}' on {url} ({mode} loop)\n")
+        log_file.write(report)
+        log_file.write(f"\nsaturation throughput: {saturation} qps\n")
+
+    with open(os.path.join(ctx.output_dir, "load_test.json"), "w") as log_file:
+        data = {
+            "name": name,
+            "url": url,
+            "mode": mode,
+            "version": _get_version(url),
+            "saturation_qps": saturation,
+            "levels": results,
+        }
+        log_file.write(json.dumps(data, indent=2))
+    return results
+
+
+def _wilcoxon_z(diffs):
+    """
+    z score of the Wilcoxon signed-rank test of paired differences, positive
+    when the values increased (normal approximation)
+
+    >>> round(_wilcoxon_z([1, 2, 3, 4, 5, 6, 7, 8, 9, 10]), 2)
+    2.8
+    >>> round(_wilcoxon_z([1, -1, 2, -2]), 2)
+    0.0
+    """
+    diffs = sorted((d for d in diffs if d), key=abs)
+    n = len(diffs)
+    if not n:
+        return 0.0
+    # the tied differences get the mean of their ranks
+    w = 0.0
+    for _, group in itertools.groupby(enumerate(diffs, 1), key=lambda r: abs(r[1])):
+        group = list(group)
+        rank = sum(r for r, _ in group) / len(group)
+        w += rank * sum(1 for _, d in group if d > 0)
+    mean = n * (n + 1) / 4
+    return (w - mean) / math.sqrt(n * (n + 1) * (2 * n + 1) / 24)
+
+
+def _ratio_drop_z(baseline_passed, baseline_total, passed, total):
+    """
+    z score of the drop of a pass ratio (two-proportion test)
+
+    >>> round(_ratio_drop_z(90, 100, 80, 100), 2)
+    1.98
+    >>> _ratio_drop_z(100, 100, 100, 100)
+    0.0
+    """
+    if not baseline_total or not total:
+        return 0.0
+    pooled = (baseline_passed + passed) / (baseline_total + total)
+    error = math.sqrt(pooled * (1 - pooled) * (1 / baseline_total + 1 / total))
+    drop = baseline_passed / baseline_total - passed / total
+    return drop / error if error else 0.0
+
+
+def _last_run(db, version, name):
+    return db.execute(
+        "SELECT id, version, fingerprint FROM runs WHERE version = ? AND (? IS NULL OR name = ?)"
+        " ORDER BY run_at DESC LIMIT 1",
+        (version, name, name),
+    ).fetchone()
+
+
+def _run_results(db, run_id):
+    cursor = db.execute(
+        f"SELECT region, category, {', '.join(HISTORY_COLUMN)} FROM run_results WHERE run_id = ?",
+        (run_id,),
+    )
+    return {
+        (row[0], row[1]): dict(zip(HISTORY_COLUMN, row[2:])) for row in cursor.fetchall()
+    }
+
+
+def _category_selector(ctx, category):
+    """
+    `-k` expression selecting the tests of a category, like `run_pytest`
+    """
+    if category.get("remaining_tests"):
+        return _get_remaining_tests(ctx)
+    return category["selector"]
+
+
+def _matches_selector(test_id, selector):
+    """
+    whether a test is selected by a `-k` expression of pytest, whose names
+    match (case insensitively) the substrings of the test id
+
+    >>> _matches_selector("world.fr.test_poi::test_poi[cafe]", "test_poi and not fuzzy")
+    True
+    >>> _matches_selector("world.fr.test_fuzzy::test_fuzzy[paris]", "not (fuzzy or test_poi)")
+    False
+    >>> _matches_selector("world.fr.test_admin::test_admin[paris]", "")
+    True
+    """
+    tokens = re.findall(r"[()]|[^\s()]+", selector)
+    if not tokens:
+        return True
+    expression = " ".join(
+        t if t in ("(", ")", "and", "or", "not") else str(t.lower() in test_id.lower())
+        for t in tokens
+    )
+    return eval(expression, {"__builtins__": {}})
+
+
+def _query_latencies(db, run, region, selector):
+    """
+    latencies of the queries of a region/category that passed in a run, by
+    test id
+    """
+    cursor = db.execute(
+        "SELECT test_id, duration FROM results"
+        " WHERE version = ? AND fingerprint = ? AND passed AND test_id LIKE ?",
+        (run[1], run[2], f"%world.{region}.%"),
+    )
+    return {
+        test_id: duration
+        for test_id, duration in cursor.fetchall()
+        if _matches_selector(test_id, selector)
+    }
+
+
+COMPARE_COLUMN = [
+    "region",
+    "category",
+    "baseline_ratio",
+    "ratio",
+    "ratio_z",
+    "baseline_p50_ms",
+    "p50_ms",
+    "latency_change",
+    "latency_z",
+    "regression",
+]
+
+
+@task
+def compare(ctx, baseline, version=None, name=None):
+    """
+    compare the last run of a version (the last run by default) with the last
+    run of the baseline version
+
+    a region/category regresses when its pass ratio drops or the latency of
+    its queries increases beyond the thresholds of `compare`, and the change
+    is statistically significant. The command fails if there is a regression.
+    """
+    conf = ctx.get("compare", {})
+    max_ratio_drop = float(conf.get("max_ratio_drop") or 0)
+    max_latency_increase = float(conf.get("max_latency_increase") or 0)
+    min_z_score = float(conf.get("min_z_score") or 1.645)
+
+    db = _open_results_db(ctx)
+    try:
+        baseline_run = _last_run(db, baseline, name)
+        if not baseline_run:
+            raise Exit(f"no run of the baseline version {baseline}", code=2)
+        if version:
+            run = _last_run(db, version, name)
+        else:
+            run = db.execute(
+                "SELECT id, version, fingerprint FROM runs WHERE (? IS NULL OR name = ?)"
+                " ORDER BY run_at DESC LIMIT 1",
+                (name, name),
+            ).fetchone()
+        if not run:
+            raise Exit(f"no run of the version {version}", code=2)
+
+        baseline_results = _run_results(db, baseline_run[0])
+        results = _run_results(db, run[0])
+        categories = {c["name"]: c for c in ctx.categories}
+        latencies = {}
+        # the latencies are compared on the same tests as the pass ratio
+        for region, category in results:
+            if category not in categories:
+                continue
+            selector = _category_selector(ctx, categories[category])
+            before = _query_latencies(db, baseline_run, region, selector)
+            after = _query_latencies(db, run, region, selector)
+            latencies[(region, category)] = [
+                (before[t], after[t])
+                for t in before.keys() & after.keys()
+                if before[t] and after[t] is not None
+            ]
+    finally:
+        db.close()
+
+    comparison = []
+    for (region, category), r in sorted(results.items()):
+        b = baseline_results.get((region, category))
+        if not b or not b["total"] or not r["total"]:
+            continue
+        passed, baseline_passed = r["total"] - r["failed"], b["total"] - b["failed"]
+        ratio_drop = baseline_passed / b["total"] - passed / r["total"]
+        ratio_z = _ratio_drop_z(baseline_passed, b["total"], passed, r["total"])
+        comparison.append(
+            {
+                "region": region,
+                "category": category,
+                "baseline_ratio": f"{baseline_passed / b['total']:.1%}",
+                "ratio": f"{passed / r['total']:.1%}",
+                "ratio_z": f"{ratio_z:.2f}",
+                "baseline_p50_ms": b["p50_ms"],
+                "p50_ms": r["p50_ms"],
+                "regression": "ratio" if ratio_drop > max_ratio_drop and ratio_z > min_z_score else "",
+            }
+        )
+
+    # the latencies are compared on the queries run with both versions
+    for (region, category), pairs in sorted(latencies.items()):
+        if not pairs:
+            continue
+        baseline_median = statistics.median(p[0] for p in pairs)
+        median = statistics.median(p[1] for p in pairs)
+        latency_change = median / baseline_median - 1
+        latency_z = _wilcoxon_z([after - before for before, after in pairs])
+        comparison.append(
+            {
+                "region": region,
+                "category": f"{category} ({len(pairs)} queries)",
+                "baseline_p50_ms": round(baseline_median * 1000),
+                "p50_ms": round(median * 1000),
+                "latency_change": f"{latency_change:+.0%}",
+                "latency_z": f"{latency_z:.2f}",
+                "regression": "latency"
+                if latency_change > max_latency_increase and latency_z > min_z_score
+                else "",
+            }
+        )
+
+    logging.info(f"comparing version {run[1]} with {baseline}")
+    logging.info("\n".join(_pretty_print(comparison, COMPARE_COLUMN)))
+
+    regressions = [c for c in comparison if c["regression"]]
+    if regressions:
+        raise Exit(
+            "regressions in "
+            + ", ".join(f"{c['region']}/{c['category']} ({c['regression']})" for c in regressions),
+            code=1,
+        )
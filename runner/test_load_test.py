@@ -0,0 +1,170 @@
+"""
+Tests of the load test against a local stub of the geocoder, run with
+`python -m pytest` from this directory.
+"""
+import asyncio
+import itertools
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+from invoke import Config, Context
+
+from conftest import load_module, local_server
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+tasks = load_module("runner_tasks", os.path.join(HERE, "tasks.py"))
+
+
+class StubGeocoder:
+    """
+    Answer the autocomplete queries with a keep-alive connection, the
+    queries of `failing` fail. The answers of `chunked` are chunked.
+    """
+
+    def __init__(self, failing=(), chunked=False):
+        self.failing = set(failing)
+        self.chunked = chunked
+        self.queries = []
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    def handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                with stub.lock:
+                    stub.connections += 1
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == "/status":
+                    self._send(200, {"version": "stub"})
+                    return
+
+                query = parse_qs(url.query)
+                with stub.lock:
+                    stub.queries.append(query)
+                status = 500 if query["q"][0] in stub.failing else 200
+                self._send(status, {"features": []})
+
+            def _send(self, status, body):
+                content = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                if stub.chunked:
+                    self.send_header("Transfer-Encoding", "chunked")
+                    self.end_headers()
+                    self.wfile.write(b"%x\r\n%s\r\n0\r\n\r\n" % (len(content), content))
+                else:
+                    self.send_header("Content-Length", str(len(content)))
+                    self.end_headers()
+                    self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+@pytest.fixture
+def ctx(tmpdir):
+    region = tmpdir.mkdir("geocoder_tester").mkdir("world").mkdir("test")
+    region.join("test_streets.yml").write(
+        "tests:\n"
+        "  - query: rue de rivoli\n"
+        "    lang: fr\n"
+        "    expected: {}\n"
+        "  - query: avenue foch\n"
+        "    expected: {}\n"
+    )
+    region.join("test_pois.csv").write("query,lat,lon\nfailing cafe,48.8,2.3\n")
+
+    config = Config(
+        overrides={
+            "base_output_dir": str(tmpdir.join("results")),
+            "geocoder_sources": str(tmpdir),
+            "regions": ["test"],
+            "load_test": {
+                "mode": "closed",
+                "closed": [1, 4],
+                "open": [20],
+                "duration": 0.5,
+                "warmup": 0,
+                "timeout": 5,
+                "max_error_rate": 0.5,
+            },
+        }
+    )
+    return Context(config)
+
+
+def test_load_queries(ctx):
+    assert tasks._load_queries(ctx, ["test"]) == [
+        {"q": "failing cafe", "lat": "48.8", "lon": "2.3"},
+        {"q": "rue de rivoli", "lang": "fr"},
+        {"q": "avenue foch"},
+    ]
+
+
+def test_closed_load_test(ctx, http_server):
+    stub = StubGeocoder(failing=["failing cafe"])
+    url = http_server(stub.handler()) + "/autocomplete"
+
+    results = tasks.load_test(ctx, url=url)
+
+    assert [r["level"] for r in results] == ["1 clients", "4 clients"]
+    for result in results:
+        assert result["sent"] > 0
+        # a query out of 3 fails
+        assert 0 < result["errors"] < result["sent"]
+        assert sum(result["histogram"].values()) == result["sent"] - result["errors"]
+    assert {q["q"][0] for q in stub.queries} == {"failing cafe", "rue de rivoli", "avenue foch"}
+    # the connections of the pool (4 clients at most) are kept alive, the
+    # version of the geocoder is read with another one
+    assert stub.connections <= 4 + 1 < len(stub.queries)
+
+    with open(os.path.join(ctx.output_dir, "load_test.json")) as f:
+        report = json.load(f)
+    assert report["version"] == "stub"
+    assert report["levels"] == results
+    assert report["saturation_qps"] == max(r["qps"] for r in results)
+
+
+def test_open_load_test(ctx, http_server):
+    stub = StubGeocoder(chunked=True)
+    url = http_server(stub.handler()) + "/autocomplete"
+
+    results = tasks.load_test(ctx, url=url, mode="open")
+
+    assert len(results) == 1
+    # the queries are sent at the given rate
+    assert results[0]["level"] == "20.0 qps"
+    assert results[0]["sent"] == len(stub.queries) == 10
+    assert results[0]["errors"] == 0
+
+
+def test_unreachable_geocoder(ctx):
+    queries = itertools.cycle([{"q": "rue de rivoli"}])
+    with local_server(StubGeocoder().handler()) as url:
+        pass
+
+    # the geocoder is stopped, all the queries fail
+    loop = asyncio.new_event_loop()
+    try:
+        results = loop.run_until_complete(
+            tasks._load_test(loop, url, queries, "closed", [2], {"duration": 0.2})
+        )
+    finally:
+        loop.close()
+
+    assert results[0]["sent"] == results[0]["errors"] > 0
+    assert tasks._saturation_qps(results, 0.01) is None
@@ -0,0 +1,170 @@
+"""
+Tests of the reports of the runs of the geocoder tester, run with
+`python -m pytest` from this directory.
+"""
+import os
+import random
+import subprocess
+import sys
+from time import time
+
+import pytest
+from invoke import Config, Context, Exit
+
+from conftest import load_module
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+tasks = load_module("runner_tasks", os.path.join(HERE, "tasks.py"))
+
+
+@pytest.mark.parametrize(
+    "report, duration",
+    [
+        (
+            '<testsuites><testsuite name="pytest" tests="2" time="1.5">'
+            '<testcase classname="test" name="a" time="0.5"/>'
+            '<testcase classname="test" name="b" time="0.7"/>'
+            "</testsuite></testsuites>",
+            1.5,
+        ),
+        # the format of the reports of pytest < 5.1
+        ('<testsuite name="pytest" tests="0" time="0.25"></testsuite>', 0.25),
+        ('<testsuites><testsuite name="pytest" tests="0"/></testsuites>', None),
+    ],
+)
+def test_junitxml_duration(tmpdir, report, duration):
+    xml_file = tmpdir.join("report.xml")
+    xml_file.write(report)
+
+    assert tasks._junitxml_duration(str(xml_file)) == duration
+
+
+def test_duration_of_a_pytest_run(tmpdir):
+    tmpdir.join("test_query.py").write("import time\n\ndef test_query():\n    time.sleep(0.2)\n")
+    xml_file = str(tmpdir.join("report.xml"))
+
+    start = time()
+    subprocess.run(
+        [sys.executable, "-m", "pytest", "-p", "no:cacheprovider", f"--junitxml={xml_file}"],
+        cwd=str(tmpdir),
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+    wall_time = time() - start
+
+    # the startup of python and of pytest is not counted
+    assert 0.2 <= tasks._junitxml_duration(xml_file) < wall_time
+    assert [r[:2] for r in tasks._read_junitxml(xml_file)] == [("test_query::test_query", True)]
+
+
+
+CATEGORIES = [
+    {"name": "fuzzy", "selector": "fuzzy"},
+    {"name": "poi", "selector": "test_poi"},
+    {"name": "autre", "remaining_tests": True},
+]
+
+
+@pytest.fixture
+def ctx(tmpdir):
+    config = Config(
+        overrides={
+            "base_output_dir": str(tmpdir),
+            "output_dir": str(tmpdir),
+            "categories": CATEGORIES,
+            "compare": {"max_ratio_drop": 0.01, "max_latency_increase": 0.2},
+        }
+    )
+    return Context(config)
+
+
+def _latencies(seed, factor=1):
+    # the latencies of the queries change a bit from a run to the other
+    noise = random.Random(seed)
+    return [factor * (0.02 + i / 1000) + noise.uniform(-0.002, 0.002) for i in range(40)]
+
+
+def _save_run(ctx, version, latencies, failed):
+    """
+    Save a run of the 40 queries of each category (in the region fr) with
+    their latencies, the first `failed` queries of a category fail.
+    """
+    modules = {"fuzzy": "test_fuzzy", "poi": "test_poi", "autre": "test_streets"}
+    results = [
+        (f"world.fr.{modules[c]}::{modules[c]}[{i}]", i >= failed.get(c, 0), latency)
+        for c in modules
+        for i, latency in enumerate(latencies[c])
+    ]
+    tasks._save_results(ctx, results, time(), version, "dataset")
+    tasks._save_run(
+        ctx,
+        "geocoder-tester",
+        "http://geocoder",
+        version,
+        "dataset",
+        [{"region": "fr", "category": c, "failed": failed.get(c, 0), "total": 40} for c in modules],
+    )
+
+
+@pytest.fixture
+def baseline(ctx):
+    latencies = {"fuzzy": _latencies(1), "poi": _latencies(2), "autre": _latencies(3)}
+    _save_run(ctx, "v1", latencies, {"fuzzy": 1})
+
+
+def test_compare_without_regression(ctx, baseline):
+    # a query fails, the latencies only change a bit
+    latencies = {"fuzzy": _latencies(4), "poi": _latencies(5), "autre": _latencies(6, 1.05)}
+    _save_run(ctx, "v2", latencies, {"fuzzy": 2})
+
+    tasks.compare(ctx, "v1", "v2")
+
+
+def test_compare_with_regressions(ctx, baseline):
+    # the pois are slower, the other queries fail
+    latencies = {"fuzzy": _latencies(4), "poi": _latencies(5, 1.5), "autre": _latencies(6)}
+    _save_run(ctx, "v2", latencies, {"fuzzy": 1, "autre": 12})
+
+    with pytest.raises(Exit) as e:
+        tasks.compare(ctx, "v1", "v2")
+
+    assert e.value.code == 1
+    assert e.value.message == "regressions in fr/autre (ratio), fr/poi (40 queries) (latency)"
+
+
+def test_query_latencies_of_a_category(ctx, baseline):
+    db = tasks._open_results_db(ctx)
+    run = tasks._last_run(db, "v1", None)
+
+    for category, prefix, nb_queries in [
+        ("fuzzy", "world.fr.test_fuzzy::", 39),
+        ("poi", "world.fr.test_poi::", 40),
+        ("autre", "world.fr.test_streets::", 40),
+    ]:
+        selector = tasks._category_selector(ctx, {c["name"]: c for c in CATEGORIES}[category])
+        latencies = tasks._query_latencies(db, run, "fr", selector)
+        # only the queries that passed
+        assert len(latencies) == nb_queries
+        assert all(test_id.startswith(prefix) for test_id in latencies)
+    db.close()
+
+
+@pytest.mark.parametrize(
+    "seed, factor, significant",
+    [(1, 1, False), (2, 1.005, False), (3, 1.1, True), (4, 0.9, False)],
+)
+def test_wilcoxon_z(seed, factor, significant):
+    before, after = _latencies(0), _latencies(seed, factor)
+
+    z = tasks._wilcoxon_z([b - a for a, b in zip(before, after)])
+
+    assert (z > 1.645) == significant
+
+
+@pytest.mark.parametrize(
+    "baseline_passed, passed, significant",
+    [(40, 40, False), (39, 38, False), (40, 38, False), (40, 36, True), (38, 40, False)],
+)
+def test_ratio_drop_z(baseline_passed, passed, significant):
+    assert (tasks._ratio_drop_z(baseline_passed, 40, passed, 40) > 1.645) == significant
@@ -1,37 +1,802 @@
+import atexit
 import os
-from invoke import task
+from invoke import Context, task
 from invoke.config import DataProxy
+from invoke.util import yaml
+import hashlib
+import itertools
+import json
 import logging
-from retrying import retry
+import math
+import re
+import sqlite3
+import threading
+from collections import defaultdict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager
 from datetime import timedelta
-from time import time
+from time import localtime, sleep, strftime, time
+import urllib.error
+import urllib.request
+from urllib.parse import urlencode, urlparse
 
-logging.basicConfig(level=logging.INFO)
+from download.files_description import describe_path
 
+logging.basicConfig(level=logging.INFO)
 
-def run_rust_binary(ctx, container, bin, files, params):
-    cmd = "{} {}".format(bin, params)
-    files_args = _build_docker_files_args(files)
-    cmd = "docker-compose {files} run --rm {container} {cmd}".format(
-        files=files_args, container=container, cmd=cmd
-    )
+# Cache directory of the download image, where the status of the downloaded
+# files is kept.
+DOWNLOAD_CACHE_DIR = "/data/cache"
+DOWNLOAD_STATUS_DB = os.path.join(DOWNLOAD_CACHE_DIR, "_files_status.sqlite")
+
+# Heuristics used to autotune the importers, see `_autotune`.
+AUTOTUNE_INPUT_SIZE_PER_THREAD = 256 * 2 ** 20
+AUTOTUNE_INPUT_SIZE_PER_SHARD = 4 * 2 ** 30
+AUTOTUNE_MEMORY_PER_THREAD = 512 * 2 ** 20
+
+# Where the limits of the cgroup of the import are read, see `_host_resources`.
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+
+def run_rust_binary(
+    ctx,
+    container,
+    bin,
+    files,
+    params,
+    inputs=[],
+    before_run=None,
+    index=None,
+    checkpoint=True,
+    output=None,
+):
+    """
+    Run a binary of a docker-compose service, with the executor configured
+    for this service (see `_get_executor`).
+
+    `inputs` are the paths (in the containers) of the files read by the
+    binary, `index` the alias of the elasticsearch index it imports and
+    `output` the path of the file it writes, if any. If checkpoints are used
+    (see `_use_checkpoints`), each successful run is recorded as a
+    checkpoint, identified by the content of the inputs, the parameters and
+    the docker image. If `resume` is set in the configuration, the run is
+    skipped if a matching checkpoint exists and its index and its output
+    still exist. The runs whose inputs can't be described are never recorded
+    (`checkpoint=False`).
+
+    `before_run` is called right before running the binary, if it is not
+    skipped.
+
+    The resources used by the run are recorded in the metrics of the import
+    (see `_record_metrics`).
+
+    Return False if the run was skipped.
+    """
+    # For images with an entrypoint, the service is given as the binary.
+    service = container or bin
+    executor = _get_executor(ctx, files, service)
+    metrics = _metrics_conf(ctx)
+
+    image = None
+    if metrics.get("enable") or (checkpoint and _use_checkpoints(ctx)):
+        image = executor.version(container, bin)
+
+    fingerprint = None
+    if checkpoint and _use_checkpoints(ctx):
+        fingerprint = _step_fingerprint(
+            ctx, files, service, "{} {}".format(bin, params), inputs, image
+        )
+    name = "docker_mimir_{}_{}_{}".format(service, os.getpid(), next(_run_counter))
+    cmd = executor.command(container, bin, params, name)
 
     logging.info("{sep} {msg} {sep}".format(sep="*" * 15, msg=bin))
+
+    if ctx.get("resume") and fingerprint and _has_checkpoint(ctx, fingerprint):
+        if index is not None and not _es_index_exists(_es_host_url(ctx, files), index):
+            logging.info("{} already ran but {} doesn't exist anymore".format(bin, index))
+        elif output is not None and not file_exists(ctx, files, output):
+            logging.info("{} already ran but {} doesn't exist anymore".format(bin, output))
+        else:
+            logging.info(
+                "{sep} {bin} already ran with the same inputs, skipping it {sep}".format(
+                    sep="*" * 15, bin=bin
+                )
+            )
+            return False
+
+    if before_run:
+        before_run()
+
     logging.info("running: {}".format(cmd))
+    sampler = None
+    if metrics.get("enable") and executor.container(name):
+        sampler = _StatsSampler(
+            ctx,
+            executor.container(name),
+            float(metrics.get("sampling_interval") or 5),
+            shared=executor.container(name) != name,
+        )
+        sampler.start()
+
     start = time()
-    ctx.run(cmd)
+    success = False
+    try:
+        executor.run(cmd)
+        success = True
+    finally:
+        duration = time() - start
+        if metrics.get("enable"):
+            _record_metrics(
+                ctx,
+                dict(
+                    dataset=ctx.get("dataset"),
+                    task=getattr(_current_step, "name", None) or bin or container,
+                    image=image,
+                    success=success,
+                    started_at=start,
+                    duration_seconds=duration,
+                    **(sampler.stop() if sampler else {})
+                ),
+            )
     logging.info(
         "{sep} {bin} ran in {time} {sep}".format(
-            sep="*" * 15, bin=bin, time=timedelta(seconds=time() - start)
+            sep="*" * 15, bin=bin, time=timedelta(seconds=duration)
+        )
+    )
+    if fingerprint:
+        _save_checkpoint(ctx, fingerprint, bin or container)
+    return True
+
+
+_checkpoints_lock = threading.Lock()
+
+
+def _use_checkpoints(ctx):
+    """
+    Checkpoints are recorded if a `checkpoints_file` is configured, or when
+    the import is resumed.
+    """
+    return bool(ctx.get("checkpoints_file") or ctx.get("resume"))
+
+
+def _checkpoints_file(ctx):
+    return ctx.get("checkpoints_file") or "checkpoints.json"
+
+
+def _load_checkpoints(ctx):
+    if not os.path.isfile(_checkpoints_file(ctx)):
+        return {}
+
+    with open(_checkpoints_file(ctx)) as f:
+        return json.load(f)
+
+
+def _has_checkpoint(ctx, fingerprint):
+    with _checkpoints_lock:
+        return fingerprint in _load_checkpoints(ctx)
+
+
+def _save_checkpoint(ctx, fingerprint, step):
+    with _checkpoints_lock:
+        checkpoints = _load_checkpoints(ctx)
+        checkpoints[fingerprint] = {"step": step, "finished_at": time()}
+        _write_atomically(_checkpoints_file(ctx), json.dumps(checkpoints, indent=2))
+
+
+_run_counter = itertools.count()
+
+# Units of the sizes printed by `docker stats`
+_STATS_UNITS = {
+    "b": 1,
+    "kb": 10 ** 3,
+    "mb": 10 ** 6,
+    "gb": 10 ** 9,
+    "tb": 10 ** 12,
+    "kib": 2 ** 10,
+    "mib": 2 ** 20,
+    "gib": 2 ** 30,
+    "tib": 2 ** 40,
+}
+
+
+def _parse_stats_size(size):
+    match = re.match(r"\s*([\d.]+)\s*([a-zA-Z]*)", size)
+    if not match:
+        return None
+    return int(float(match.group(1)) * _STATS_UNITS.get(match.group(2).lower(), 1))
+
+
+def _parse_stats(line):
+    """
+    Parse a line of `docker stats --format '{{json .}}'`. The sizes that
+    are not known ("--") are None.
+    """
+    stats = json.loads(line)
+    net_rx, _, net_tx = stats["NetIO"].partition("/")
+    block_read, _, block_write = stats["BlockIO"].partition("/")
+    return {
+        "cpu_percent": float(stats["CPUPerc"].rstrip("%") or 0),
+        "memory_bytes": _parse_stats_size(stats["MemUsage"].split("/")[0]),
+        "network_receive_bytes": _parse_stats_size(net_rx),
+        "network_transmit_bytes": _parse_stats_size(net_tx),
+        "block_read_bytes": _parse_stats_size(block_read),
+        "block_write_bytes": _parse_stats_size(block_write),
+    }
+
+
+class _StatsSampler(threading.Thread):
+    """
+    Sample the resources used by a container with `docker stats` until
+    stopped. The container may not exist yet when the sampling starts.
+
+    The I/O counters of a `shared` container (like a worker) are counted
+    from the first sample.
+    """
+
+    COUNTERS = [
+        "network_receive_bytes",
+        "network_transmit_bytes",
+        "block_read_bytes",
+        "block_write_bytes",
+    ]
+
+    def __init__(self, ctx, container, interval, shared=False):
+        super().__init__(daemon=True)
+        self.ctx = ctx
+        self.container = container
+        self.interval = interval
+        self.shared = shared
+        self.samples = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            res = self.ctx.run(
+                "docker stats --no-stream --format '{{{{json .}}}}' {}".format(self.container),
+                hide=True,
+                warn=True,
+            )
+            if res.ok and res.stdout.strip():
+                try:
+                    self.samples.append(_parse_stats(res.stdout.strip().splitlines()[-1]))
+                except (ValueError, KeyError) as e:
+                    logging.debug("invalid stats for {}: {}".format(self.container, e))
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        """
+        Stop the sampling and summarize the samples.
+        """
+        self.stopped.set()
+        self.join()
+
+        if not self.samples:
+            return {"samples": 0}
+
+        cpu = [s["cpu_percent"] for s in self.samples]
+        memory = [s["memory_bytes"] for s in self.samples if s["memory_bytes"] is not None]
+        summary = {
+            "samples": len(self.samples),
+            "cpu_percent_avg": sum(cpu) / len(cpu),
+            "cpu_percent_max": max(cpu),
+            "memory_avg_bytes": sum(memory) // len(memory) if memory else None,
+            "memory_peak_bytes": max(memory) if memory else None,
+        }
+        for counter in self.COUNTERS:
+            values = [s[counter] for s in self.samples if s[counter] is not None]
+            if not values:
+                summary[counter] = None
+                continue
+            summary[counter] = max(values) - (values[0] if self.shared else 0)
+        return summary
+
+
+_metrics_lock = threading.Lock()
+_metrics = {}
+
+
+def _metrics_conf(ctx):
+    return ctx.get("metrics") or {}
+
+
+def _record_metrics(ctx, record):
+    """
+    Add the metrics of a run to the metrics of the import, which are written
+    in a JSON file per import in `metrics.output_dir` and, if
+    `metrics.textfile_dir` is set, in a textfile for the node exporter.
+    """
+    conf = _metrics_conf(ctx)
+    dataset = ctx.get("dataset") or "default"
+
+    with _metrics_lock:
+        metrics = _metrics.setdefault(dataset, {"started_at": record["started_at"], "steps": []})
+        metrics["steps"].append(record)
+
+        output_dir = conf.get("output_dir") or "metrics"
+        os.makedirs(output_dir, exist_ok=True)
+        _write_atomically(
+            os.path.join(
+                output_dir,
+                "{}_{}.json".format(
+                    dataset, strftime("%Y%m%dT%H%M%S", localtime(metrics["started_at"]))
+                ),
+            ),
+            json.dumps(
+                dict(metrics, dataset=dataset),
+                indent=2,
+            ),
         )
+
+        if conf.get("textfile_dir"):
+            _write_atomically(
+                os.path.join(conf["textfile_dir"], "docker_mimir_{}.prom".format(dataset)),
+                _metrics_textfile(metrics["steps"]),
+            )
+
+
+# Metrics of the textfile: (name, key of the records, help)
+_TEXTFILE_METRICS = [
+    ("step_success", "success", "Whether the step succeeded."),
+    ("step_start_time_seconds", "started_at", "Start time of the step."),
+    ("step_duration_seconds", "duration_seconds", "Duration of the step."),
+    ("step_cpu_percent_avg", "cpu_percent_avg", "Average cpu usage of the step."),
+    ("step_cpu_percent_max", "cpu_percent_max", "Maximum cpu usage of the step."),
+    ("step_memory_avg_bytes", "memory_avg_bytes", "Average memory used by the step."),
+    ("step_memory_peak_bytes", "memory_peak_bytes", "Highest sampled memory used by the step."),
+    ("step_block_read_bytes", "block_read_bytes", "Bytes read from disk by the step."),
+    ("step_block_write_bytes", "block_write_bytes", "Bytes written to disk by the step."),
+    ("step_network_receive_bytes", "network_receive_bytes", "Bytes received by the step."),
+    ("step_network_transmit_bytes", "network_transmit_bytes", "Bytes sent by the step."),
+]
+
+
+def _metrics_textfile(records):
+    """
+    Metrics in the Prometheus text format, only the last run of each task is
+    kept. The labels without value (like the image of a binary which is not
+    known) are left out.
+    """
+
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    last_runs = {}
+    for record in records:
+        last_runs[(record["dataset"], record["task"])] = record
+
+    lines = []
+    for name, key, help in _TEXTFILE_METRICS:
+        lines.append("# HELP docker_mimir_{} {}".format(name, help))
+        lines.append("# TYPE docker_mimir_{} gauge".format(name))
+        for record in last_runs.values():
+            if record.get(key) is None:
+                continue
+            labels = ",".join(
+                '{}="{}"'.format(label, escape(record[label]))
+                for label in ("dataset", "task", "image")
+                if record.get(label) is not None
+            )
+            lines.append("docker_mimir_{}{{{}}} {}".format(name, labels, float(record[key])))
+    return "\n".join(lines) + "\n"
+
+
+def _write_atomically(filename, content):
+    # write in a temporary file to never leave a truncated file behind
+    tmp_file = "{}.tmp".format(filename)
+    with open(tmp_file, "w") as f:
+        f.write(content)
+    os.replace(tmp_file, filename)
+
+
+def _step_fingerprint(ctx, files, service, cmd, inputs, version):
+    """
+    Hash of everything that defines the result of a step: the content of
+    its input files, its parameters and the version of the binary (the docker
+    image used to run it).
+    """
+    description = {
+        "service": service,
+        "cmd": " ".join(cmd.split()),
+        "image": version,
+        "inputs": _describe_files(ctx, files, inputs),
+    }
+    return hashlib.sha256(
+        json.dumps(description, sort_keys=True).encode()
+    ).hexdigest()
+
+
+def _describe_files(ctx, files, paths):
+    """
+    Describe the content of the given files (their md5 if they were
+    downloaded, their size and modification time otherwise).
+
+    This is done directly on the host if the docker volumes can be accessed
+    from there, otherwise from inside the download image.
+    """
+    paths = [p for p in paths if p]
+    if not paths:
+        return {}
+
+    host_description = _describe_files_on_host(ctx, files, paths)
+    if host_description is not None:
+        return host_description
+
+    files_args = _build_docker_files_args(files)
+    res = ctx.run(
+        "docker-compose {files} run --rm download describe-files {paths}".format(
+            files=files_args, paths="".join(_get_cli_param(p, "--path") for p in paths)
+        ),
+        hide="out",
+    )
+    return json.loads(res.stdout.strip().splitlines()[-1])
+
+
+def _image_digest(ctx, files, service):
+    return _image_property(ctx, files, service, ".Id")
+
+
+def _image_property(ctx, files, service, field):
+    """
+    Json value of a field of the image of a service, None if the image is not
+    available locally.
+    """
+    image = _compose_config(ctx, files)["services"].get(service, {}).get("image")
+    if not image:
+        return None
+
+    res = ctx.run(
+        "docker image inspect --format '{{{{json {}}}}}' {}".format(field, image),
+        hide=True,
+        warn=True,
     )
+    return json.loads(res.stdout) if res.ok else None
+
+
+class ComposeExecutor:
+    """
+    Run each binary in a new container (`docker-compose run`).
+    """
+
+    def __init__(self, ctx, files, service):
+        self.ctx = ctx
+        self.files = files
+        self.service = service
+
+    def version(self, container, bin):
+        """
+        Version of the binary run by `command` (the digest of the image of
+        the service).
+        """
+        return _image_digest(self.ctx, self.files, self.service)
+
+    def command(self, container, bin, params, name):
+        """
+        Command running the binary, `name` is a unique name for the run.
+        """
+        return "docker-compose {files} run --rm --name {name} {service} {cmd}".format(
+            files=_build_docker_files_args(self.files),
+            name=name,
+            service=self.service,
+            cmd="{} {}".format(bin if container else "", params),
+        )
+
+    def container(self, name):
+        """
+        Name of the container where the run `name` happens, if any.
+        """
+        return name
+
+    def run(self, cmd):
+        self.ctx.run(cmd)
+
+    def stop(self):
+        pass
+
+
+class WorkerExecutor(ComposeExecutor):
+    """
+    Keep a container of the service running and run each binary in it
+    (`docker exec`), to avoid creating a container for each run.
+    """
+
+    def __init__(self, ctx, files, service):
+        super().__init__(ctx, files, service)
+        self.container_name = "docker_mimir_{}_{}_worker".format(
+            service, ctx.get("dataset") or "default"
+        )
+        self.lock = threading.Lock()
+        self.started = False
+
+    def _start(self):
+        with self.lock:
+            if self.started:
+                return
+
+            # A worker may remain from a previous run that was interrupted.
+            self.ctx.run("docker rm -f {}".format(self.container_name), hide=True, warn=True)
+            self.ctx.run(
+                "docker-compose {files} run -d --name {name} --entrypoint sh {service}"
+                " -c 'trap exit TERM; while true; do sleep 1; done'".format(
+                    files=_build_docker_files_args(self.files),
+                    name=self.container_name,
+                    service=self.service,
+                )
+            )
+            self.started = True
+
+    def container(self, name):
+        return self.container_name
+
+    def command(self, container, bin, params, name):
+        # `docker exec` ignores the entrypoint of the image
+        entrypoint = _image_property(self.ctx, self.files, self.service, ".Config.Entrypoint")
+        return "docker exec {name} {cmd}".format(
+            name=self.container_name,
+            cmd=" ".join((entrypoint or []) + [bin if container else "", params]),
+        )
+
+    def run(self, cmd):
+        self._start()
+        self.ctx.run(cmd)
+
+    def stop(self):
+        with self.lock:
+            if self.started:
+                self.ctx.run("docker rm -f {}".format(self.container_name), hide=True, warn=True)
+                self.started = False
+
+
+class LocalExecutor(ComposeExecutor):
+    """
+    Run the binaries installed on the host. The paths of the docker volumes in
+    the parameters are replaced by their path on the host.
+
+    The binary of a service with an entrypoint (like cosmogony) must have the
+    name of the service.
+    """
+
+    def version(self, container, bin):
+        cmd = "{} --version".format(self._binary(bin if container else ""))
+        res = self.ctx.run(cmd, hide=True, warn=True)
+        return "local: {}".format(res.stdout.strip() if res.ok else None)
+
+    def _binary(self, bin):
+        return bin or self.service
+
+    def container(self, name):
+        return None
+
+    def command(self, container, bin, params, name):
+        for source, target in _service_mounts(self.ctx, self.files, self.service):
+            pattern = r"(?<![\w/]){}(?=[/\s\"']|$)".format(re.escape(target))
+            if not re.search(pattern, params):
+                continue
+            if source is None:
+                raise Exception(
+                    "volume {} of {} can't be accessed from the host".format(target, self.service)
+                )
+            params = re.sub(pattern, lambda _: source, params)
+
+        return "{} {}".format(self._binary(bin if container else ""), params)
+
+
+class RecordingExecutor(ComposeExecutor):
+    """
+    Record the commands instead of running them, for tests.
+    """
+
+    def __init__(self, ctx, files, service):
+        super().__init__(ctx, files, service)
+        self.commands = []
+
+    def version(self, container, bin):
+        return "recording"
+
+    def container(self, name):
+        return None
+
+    def run(self, cmd):
+        self.commands.append(cmd)
+
+
+EXECUTORS = {
+    "compose": ComposeExecutor,
+    "worker": WorkerExecutor,
+    "local": LocalExecutor,
+    "recording": RecordingExecutor,
+}
+
+_executors_lock = threading.Lock()
+_executors = {}
+
+
+def _get_executor(ctx, files, service):
+    """
+    Executor used to run the binaries of a service, configured by service in
+    `executors` (`default` applies to the services not listed). Each context
+    (eg. each region of `load_regions`) has its own executors.
+    """
+    conf = ctx.get("executors") or {}
+    backend = conf.get(service) or conf.get("default") or "compose"
+    if backend not in EXECUTORS:
+        raise Exception("unknown executor '{}' for {}".format(backend, service))
+
+    # the executors keep their context, its id is not reused while they exist
+    key = (id(ctx), _build_docker_files_args(files), service, backend)
+    with _executors_lock:
+        if key not in _executors:
+            _executors[key] = EXECUTORS[backend](ctx, files, service)
+        return _executors[key]
+
+
+def _stop_executors():
+    with _executors_lock:
+        for executor in _executors.values():
+            executor.stop()
+
+
+# The workers are also stopped when a task other than load_all used them.
+atexit.register(_stop_executors)
+
+
+_compose_configs = {}
+
+
+def _compose_config(ctx, files):
+    """
+    The docker-compose configuration resulting from all the compose files,
+    with the environment variables resolved.
+    """
+    files_args = _build_docker_files_args(files)
+    if files_args not in _compose_configs:
+        res = ctx.run("docker-compose {} config".format(files_args), hide=True)
+        _compose_configs[files_args] = yaml.safe_load(res.stdout)
+    return _compose_configs[files_args]
+
+
+def _describe_files_on_host(ctx, files, paths):
+    """
+    Same as the `describe-files` task of the download image, but done from the
+    host. Return None if some of the files can't be accessed from the host.
+    """
+    status_db = _host_path(ctx, files, DOWNLOAD_STATUS_DB)
+    host_paths = [_host_path(ctx, files, p) for p in paths]
+
+    if status_db is None or None in host_paths:
+        return None
+
+    if not os.path.isfile(status_db):
+        legacy_status = os.path.join(os.path.dirname(status_db), "_files_status.json")
+        if os.path.isfile(legacy_status):
+            return None  # the download image must migrate it first
+
+        return {
+            path: describe_path(host_path, {}, path) for path, host_path in zip(paths, host_paths)
+        }
+
+    try:
+        conn = sqlite3.connect("file:{}?mode=ro".format(status_db), uri=True)
+        try:
+            files_status = {
+                filename: json.loads(status)
+                for filename, status in conn.execute(
+                    "SELECT filename, status FROM files_status WHERE filename IN ({})".format(
+                        ",".join("?" * len(paths))
+                    ),
+                    paths,
+                )
+            }
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+
+    return {
+        path: describe_path(host_path, files_status.get(path) or {}, path)
+        for path, host_path in zip(paths, host_paths)
+    }
+
+
+def _host_path(ctx, files, path, service="download"):
+    """
+    Path on the host of a file seen at `path` by the containers of `service`,
+    using the volumes defined in the docker-compose files. Return None if the
+    file is not in a volume or if the volume can't be accessed from the host.
+    """
+    for source, target in _service_mounts(ctx, files, service):
+        if path != target and not path.startswith(target.rstrip("/") + "/"):
+            continue
+
+        if source is None or not os.access(source, os.R_OK | os.X_OK):
+            return None
+
+        return os.path.normpath(os.path.join(source, os.path.relpath(path, target)))
+
+    return None
+
+
+_services_mounts = {}
+
+
+def _service_mounts(ctx, files, service):
+    """
+    List of (host path, path in the container) of the volumes mounted in a
+    service, the host path is None if it can't be found.
+    """
+    key = (_build_docker_files_args(files), service)
+    if key in _services_mounts:
+        return _services_mounts[key]
+
+    mounts = []
+    service_conf = _compose_config(ctx, files)["services"].get(service, {})
+
+    for volume in service_conf.get("volumes", []):
+        if isinstance(volume, dict):  # long syntax
+            source, target = volume.get("source"), volume.get("target")
+        else:
+            parts = volume.split(":")
+            if len(parts) < 2:
+                continue  # anonymous volume
+            source, target = parts[0], parts[1]
+
+        if source and not os.path.isabs(source):
+            source = _volume_mountpoint(ctx, files, source)
+
+        mounts.append((source, target))
+
+    # The most specific mount points first.
+    mounts.sort(key=lambda m: len(m[1]), reverse=True)
+    _services_mounts[key] = mounts
+    return mounts
+
+
+def _volume_mountpoint(ctx, files, volume):
+    """
+    Directory of a named volume on the host, None if it doesn't exist.
+    """
+    volume_conf = (_compose_config(ctx, files).get("volumes") or {}).get(volume) or {}
+    external = volume_conf.get("external")
+
+    if volume_conf.get("name"):
+        name = volume_conf["name"]
+    elif external:
+        name = external.get("name", volume) if isinstance(external, dict) else volume
+    else:
+        name = "{}_{}".format(_compose_project_name(ctx, files), volume)
+
+    res = ctx.run(
+        'docker volume inspect --format "{{{{.Mountpoint}}}}" {}'.format(name),
+        hide=True,
+        warn=True,
+    )
+    return res.stdout.strip() if res.ok else None
+
+
+def _compose_project_name(ctx, files):
+    """
+    Name of the docker-compose project, given in its configuration since
+    docker-compose v2. Otherwise it is the name docker-compose v1 (>= 1.21)
+    gives to the project: COMPOSE_PROJECT_NAME or the name of the directory,
+    without the characters it strips.
+    """
+    name = _compose_config(ctx, files).get("name")
+    if name:
+        return name
+
+    name = os.environ.get("COMPOSE_PROJECT_NAME") or os.path.basename(os.getcwd())
+    return re.sub(r"[^-_a-z0-9]", "", name.lower())
 
 
 def file_exists(ctx, files, path):
     """
-    Check if a file exist, this check will be done from inside of the download
-    image, thus all docker volumes will be mounted.
+    Check if a file exist. The check is done on the host if the docker volume
+    containing the file can be accessed from there, otherwise it is done from
+    inside of the download image, thus all docker volumes will be mounted.
     """
+    host_path = _host_path(ctx, files, path)
+    if host_path is not None:
+        return os.path.isfile(host_path)
+
     files_args = _build_docker_files_args(files)
     return ctx.run(
         "docker-compose {files} run --rm download file-exists --path={path}".format(files=files_args, path=path),
@@ -40,6 +805,99 @@ def file_exists(ctx, files, path):
     ).exited == 0
 
 
+# A step of the import, `inputs` and `outputs` are the names of the resources
+# (files, ES indexes, ...) needed and produced by the step.
+Step = namedtuple("Step", ["name", "run", "inputs", "outputs"])
+
+
+# The step run by the current thread, to name the metrics of its runs.
+_current_step = threading.local()
+
+
+# Limit on the number of steps run at the same time by all the regions
+# imported by `load_regions`.
+_steps_budget = None
+
+
+def _run_step(step):
+    _current_step.name = step.name
+    try:
+        if _steps_budget is None:
+            return step.run()
+        with _steps_budget:
+            return step.run()
+    finally:
+        _current_step.name = None
+
+
+def _run_steps(steps, max_parallel_steps=1, available=()):
+    """
+    Run all the steps, a step is started as soon as all the steps producing
+    its inputs are done. The inputs that are not produced by any step must be
+    `available` before the run (eg. the admins imported before the pois),
+    otherwise no step is run.
+
+    At most `max_parallel_steps` steps are run at the same time. If a step
+    fails, no new step is started and the error is raised once the running
+    steps are over.
+    """
+    producers = defaultdict(set)
+    for step in steps:
+        for output in step.outputs:
+            producers[output].add(step.name)
+
+    missing = [
+        s.name for s in steps if any(not producers[i] and i not in available for i in s.inputs)
+    ]
+    if missing:
+        raise Exception(
+            "impossible to run steps {}: their inputs are produced by no step".format(
+                ", ".join(missing)
+            )
+        )
+
+    pending = list(steps)
+    running = {}
+    done = set()
+    errors = []
+
+    def is_ready(step):
+        return all(producers[i] <= done for i in step.inputs)
+
+    with ThreadPoolExecutor(max_workers=max_parallel_steps) as executor:
+        while pending or running:
+            ready_steps = [s for s in pending if is_ready(s)] if not errors else []
+            for step in ready_steps[: max_parallel_steps - len(running)]:
+                logging.info("starting step {}".format(step.name))
+                pending.remove(step)
+                running[executor.submit(_run_step, step)] = step
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                step = running.pop(future)
+                if future.exception() is not None:
+                    logging.error(
+                        "step {} failed: {}".format(step.name, future.exception())
+                    )
+                    errors.append(future.exception())
+                else:
+                    logging.info("step {} done".format(step.name))
+                    done.add(step.name)
+
+    if errors:
+        raise errors[0]
+
+    if pending:
+        raise Exception(
+            "impossible to run steps {}: their inputs depend on themselves".format(
+                ", ".join(s.name for s in pending)
+            )
+        )
+
+
 @task()
 def download_osm(ctx, files=[]):
     files_args = _build_docker_files_args(files)
@@ -47,61 +905,229 @@ def download_osm(ctx, files=[]):
     if ctx.get("osm", {}).get("url"):
         file_name = os.path.basename(ctx.osm.url)
         ctx.osm.file = os.path.join("/data/osm", file_name)
-        ctx.run(
+        _run_download(
+            ctx,
             "docker-compose {files} run --rm download"
             " download-osm --osm-url={osm_url} --output-file={output_file}".format(
                 files=files_args, osm_url=ctx.osm.url, output_file=ctx.osm.file
-            )
+            ),
+            ctx.osm.url,
+        )
+
+
+def _update_osm(ctx, files):
+    """
+    Update the osm extract with the replication diffs published since its
+    last update, return the kinds of imported data (admins, streets, pois,
+    addresses) that may have changed.
+    """
+    if not (ctx.get("osm", {}).get("url") and ctx.osm.get("replication_url")):
+        raise Exception("`osm.url` and `osm.replication_url` are needed to update the import")
+
+    files_args = _build_docker_files_args(files)
+    ctx.osm.file = os.path.join("/data/osm", os.path.basename(ctx.osm.url))
+    res = _run_download(
+        ctx,
+        "docker-compose {files} run --rm download update-osm --osm-url={osm_url}"
+        " --replication-url={replication_url} --output-file={output_file}".format(
+            files=files_args,
+            osm_url=ctx.osm.url,
+            replication_url=ctx.osm.replication_url,
+            output_file=ctx.osm.file,
+        ),
+        ctx.osm.replication_url,
+    )
+
+    update = json.loads(res.stdout.strip().splitlines()[-1])
+    logging.info(
+        "osm extract updated to sequence {}, changed: {}".format(
+            update["sequence"], ", ".join(update["changed"]) or "nothing"
         )
+    )
+    return update["changed"]
 
 
 @task()
 def download_addresses(ctx, files=[]):
-    files_args = _build_docker_files_args(files)
+    steps = _download_addresses_steps(ctx, files)
+    _run_steps(steps, max_parallel_steps=max(1, len(steps)), available=["osm_file"])
 
-    if ctx.addresses.get("bano", {}).get("url"):
-        ctx.addresses.bano.file = "/data/addresses/bano.csv"
-        ctx.run(
-            "docker-compose {files} run --rm download"
-            " download-bano --bano-url={bano_url} --output-file={output_file}".format(
-                files=files_args,
-                bano_url=ctx.addresses.bano.url,
-                output_file=ctx.addresses.bano.file,
-            )
+
+# Download commands run by `load_regions`, a command shared by several regions
+# is only run once.
+_shared_downloads_lock = threading.Lock()
+_shared_downloads = None
+
+
+def _run_download(ctx, cmd, url=None):
+    """
+    Run a command of the download image, within the limits of the downloads
+    from `url` (the number of connections it may open is given to the
+    command). When regions are imported by `load_regions`, the result of the
+    first run of the command is shared by all the regions.
+    """
+
+    def run():
+        if url is None:
+            return ctx.run(cmd)
+        with _download_slot(ctx, url) as nb_connections:
+            return ctx.run("{} --nb-connections={}".format(cmd, nb_connections))
+
+    with _shared_downloads_lock:
+        if _shared_downloads is None:
+            future = None
+        elif cmd in _shared_downloads:
+            future, first_run = _shared_downloads[cmd], False
+        else:
+            future, first_run = Future(), True
+            _shared_downloads[cmd] = future
+
+    if future is None:
+        return run()
+
+    if first_run:
+        try:
+            future.set_result(run())
+        except Exception as e:
+            future.set_exception(e)
+    else:
+        logging.info("waiting for the same download of another region: {}".format(cmd))
+
+    return future.result()
+
+
+_download_slots = threading.Condition()
+_running_downloads = defaultdict(int)
+
+
+@contextmanager
+def _download_slot(ctx, url):
+    """
+    Wait until `url` can be downloaded without exceeding the maximum number
+    of downloads running at the same time (`downloads.max_parallel`) and of
+    connections opened to the host of `url`
+    (`downloads.max_connections_per_host`). Yield the number of connections
+    the download can open (`downloads.nb_connections`).
+    """
+    conf = ctx.get("downloads") or {}
+    host = urlparse(url).netloc
+    max_parallel = int(conf.get("max_parallel") or 4)
+    max_connections = int(conf.get("max_connections_per_host") or 16)
+    nb_connections = min(int(conf.get("nb_connections") or 8), max_connections)
+
+    # The downloads are counted under the None key, the connections under
+    # the key of their host.
+    with _download_slots:
+        _download_slots.wait_for(
+            lambda: _running_downloads[None] < max_parallel
+            and _running_downloads[host] + nb_connections <= max_connections
         )
+        _running_downloads[None] += 1
+        _running_downloads[host] += nb_connections
 
-    if ctx.addresses.get("oa", {}).get("datasets"):
-        if not ctx.addresses.oa.path:
-            ctx.addresses.oa.path = "/data/addresses/oa"
+    try:
+        yield nb_connections
+    finally:
+        with _download_slots:
+            _running_downloads[None] -= 1
+            _running_downloads[host] -= nb_connections
+            _download_slots.notify_all()
+
+
+def _download_bano(ctx, files):
+    if not ctx.addresses.get("bano", {}).get("url"):
+        return
 
-        ctx.run("docker-compose {} run --rm download remove-directory {}".format(
-            files_args, ctx.addresses.oa.path)
+    files_args = _build_docker_files_args(files)
+    ctx.addresses.bano.file = "/data/addresses/bano.csv"
+    extract_param = ""
+
+    # The deduplication can't read the addresses from a stream.
+    if ctx.addresses.get("stream") and not ctx.addresses.deduplication.enable:
+        extract_param = " --no-extract"
+        ctx.addresses.bano.file = "/data/cache/bano.csv.gz"
+
+    _run_download(
+        ctx,
+        "docker-compose {files} run --rm download"
+        " download-bano --bano-url={bano_url} --output-file={output_file}{extract}".format(
+            files=files_args,
+            bano_url=ctx.addresses.bano.url,
+            output_file="/data/addresses/bano.csv",
+            extract=extract_param,
+        ),
+        ctx.addresses.bano.url,
+    )
+
+
+def _download_oa(ctx, files):
+    if not ctx.addresses.get("oa", {}).get("datasets"):
+        return
+
+    files_args = _build_docker_files_args(files)
+    if not ctx.addresses.oa.path:
+        ctx.addresses.oa.path = "/data/addresses/oa"
+
+    _run_download(ctx, "docker-compose {} run --rm download remove-directory {}".format(
+        files_args, ctx.addresses.oa.path)
+    )
+
+    def download_dataset(dataset):
+        params = [
+            _get_cli_param(ctx.addresses.oa.path, "--output-dir"),
+            _get_cli_param(dataset['filename'], "--src-filename"),
+            _get_cli_param(dataset['url'], "--oa-url"),
+            _get_cli_param(",".join(dataset['include']), "--oa-filter"),
+        ]
+        _run_download(
+            ctx,
+            "docker-compose {} run --rm download download-oa {}".format(
+                files_args, " ".join(params)
+            ),
+            dataset['url'],
         )
 
-        for dataset in ctx.addresses.oa.datasets:
-            params = [
-                _get_cli_param(ctx.addresses.oa.path, "--output-dir"),
-                _get_cli_param(dataset['filename'], "--src-filename"),
-                _get_cli_param(dataset['url'], "--oa-url"),
-                _get_cli_param(",".join(dataset['include']), "--oa-filter"),
-            ]
-            ctx.run(
-                "docker-compose {} run --rm download download-oa {}".format(files_args, " ".join(params))
+    # All the datasets are fetched concurrently (within the downloads limits),
+    # a failure doesn't prevent the other datasets from being downloaded.
+    datasets = ctx.addresses.oa.datasets
+    with ThreadPoolExecutor(max_workers=len(datasets)) as executor:
+        futures = [executor.submit(download_dataset, d) for d in datasets]
+
+    failures = []
+    for dataset, future in zip(datasets, futures):
+        if future.exception() is not None:
+            logging.error(
+                "failed to download OpenAddresses dataset {} from {}: {}".format(
+                    dataset['filename'], dataset['url'], future.exception()
+                )
             )
+            failures.append(dataset['filename'])
 
-    if ctx.addresses.get("osm", {}).get("url"):
-        file_name = os.path.basename(ctx.addresses.osm.url)
-        ctx.addresses.osm.file = os.path.join("/data/osm", file_name)
-        ctx.run(
-            "docker-compose {files} run --rm download"
-            " download-osm --osm-url={osm_url} --output-file={output_file}".format(
-                files=files_args,
-                osm_url=ctx.addresses.osm.url,
-                output_file=ctx.addresses.osm.file,
-            )
+    if failures:
+        raise Exception(
+            "failed to download OpenAddresses datasets: {}".format(", ".join(failures))
         )
 
 
+def _download_osm_addresses(ctx, files):
+    if not ctx.addresses.get("osm", {}).get("url"):
+        return
+
+    files_args = _build_docker_files_args(files)
+    file_name = os.path.basename(ctx.addresses.osm.url)
+    ctx.addresses.osm.file = os.path.join("/data/osm", file_name)
+    _run_download(
+        ctx,
+        "docker-compose {files} run --rm download"
+        " download-osm --osm-url={osm_url} --output-file={output_file}".format(
+            files=files_args,
+            osm_url=ctx.addresses.osm.url,
+            output_file=ctx.addresses.osm.file,
+        ),
+        ctx.addresses.osm.url,
+    )
+
+
 @task()
 def generate_cosmogony(ctx, files=[]):
     logging.info("generating cosmogony file")
@@ -131,6 +1157,8 @@ def generate_cosmogony(ctx, files=[]):
                 cosmogony_file=cosmogony_file,
                 additional_params=additional_params,
             ),
+            inputs=[ctx.osm.file],
+            output=cosmogony_file,
         )
         ctx.admin.cosmogony.file = cosmogony_file
 
@@ -138,36 +1166,458 @@ def generate_cosmogony(ctx, files=[]):
 @task()
 def load_cosmogony(ctx, files=[]):
     logging.info("loading cosmogony")
-    conf = ctx.admin.cosmogony
-    additional_params = _get_cli_param(conf.get("nb_shards"), "--nb-shards")
-    additional_params += _get_cli_param(conf.get("nb_replicas"), "--nb-replicas")
+    conf = _autotune(ctx, files, ctx.admin.cosmogony, [ctx.admin.cosmogony.file], ["nb_shards"])
+    with _es_import_mode(ctx, files, "admin", conf) as conf:
+        additional_params = _get_cli_param(conf.get("nb_shards"), "--nb-shards")
+        additional_params += _get_cli_param(conf.get("nb_replicas"), "--nb-replicas")
 
-    langs_params = ""
-    if ctx.admin.cosmogony.get("langs", ""):
-        langs_codes = ctx.admin.cosmogony.langs.split(",")
-        for code in langs_codes:
-            langs_params += _get_cli_param(code, "--lang")
+        langs_params = ""
+        if ctx.admin.cosmogony.get("langs", ""):
+            langs_codes = ctx.admin.cosmogony.langs.split(",")
+            for code in langs_codes:
+                langs_params += _get_cli_param(code, "--lang")
+
+        run_rust_binary(
+            ctx,
+            "mimir",
+            "cosmogony2mimir",
+            files,
+            "--input {ctx.admin.cosmogony.file} \
+            {langs_params} \
+            --connection-string {ctx.es} \
+            --dataset {ctx.dataset} \
+            {additional_params} \
+            ".format(
+                ctx=ctx, langs_params=langs_params, additional_params=additional_params
+            ),
+            inputs=[ctx.admin.cosmogony.file],
+            index=_dataset_alias("admin", ctx.dataset),
+        )
+
+
+def _get_cli_param(conf_value, cli_param_name):
+    if conf_value is not None and conf_value != "":
+        return ' {param}="{value}"'.format(param=cli_param_name, value=conf_value)
+    return ""
+
+
+_es_imports_lock = threading.Lock()
+_es_imports = {}
+
+
+@contextmanager
+def _es_import_mode(ctx, files, index_type, conf, dataset=None):
+    """
+    Put the indices of `index_type` created for the dataset in import mode
+    while the block is run: no refresh, an asynchronous translog and, if
+    their number of replicas is configured, no replicas (through an index
+    template). Yield a copy of the configuration of the step, with the number
+    of replicas to give to the importer.
+
+    `dataset` is the dataset of the import if it's not the configured one
+    (eg. a tile).
+
+    Elasticsearch is awaited first if `es_health.before_steps` is set.
+
+    Once the last import of these indices is over, their refresh interval
+    and replicas are restored, they are optionally force-merged and their
+    health is awaited.
+    """
+    if (ctx.get("es_health") or {}).get("before_steps"):
+        _wait_for_es(ctx, files)
+
+    conf = dict(conf or {})
+    es_conf = ctx.get("es_import") or {}
+    if not es_conf.get("enable"):
+        yield conf
+        return
+
+    dataset = dataset or ctx.dataset
+    url = _es_host_url(ctx, files)
+    template = "docker_mimir_import_{}_{}".format(index_type, dataset)
+    pattern = "munin_{}_{}_*".format(index_type, dataset)
+
+    with _es_imports_lock:
+        if template not in _es_imports:
+            # the replicas that are not configured are left to elasticsearch
+            nb_replicas = conf.get("nb_replicas")
+            if nb_replicas == "":
+                nb_replicas = None
+
+            settings = {"refresh_interval": "-1", "translog": {"durability": "async"}}
+            if nb_replicas is not None:
+                settings["number_of_replicas"] = 0
+
+            _es_request(
+                url,
+                "PUT",
+                "/_template/{}".format(template),
+                {"template": pattern, "order": 100, "settings": {"index": settings}},
+            )
+            _es_imports[template] = {
+                "users": 0,
+                "existing_indices": set(_dataset_indices(url, index_type, dataset)),
+                "nb_replicas": nb_replicas,
+            }
+        _es_imports[template]["users"] += 1
+        nb_replicas = _es_imports[template]["nb_replicas"]
+
+    success = False
+    try:
+        if nb_replicas is not None:
+            conf["nb_replicas"] = 0
+        yield conf
+        success = True
+    finally:
+        with _es_imports_lock:
+            _es_imports[template]["users"] -= 1
+            last = _es_imports[template]["users"] == 0
+            if last:
+                existing_indices = _es_imports.pop(template)["existing_indices"]
+                _es_request(url, "DELETE", "/_template/{}".format(template))
+
+        if last and success:
+            _es_restore_indices(ctx, url, index_type, dataset, existing_indices, nb_replicas)
+
+
+def _es_restore_indices(ctx, url, index_type, dataset, existing_indices, nb_replicas):
+    """
+    Restore the settings of the indices of the dataset that are not in
+    `existing_indices` (ie. created by the import) once their import is over,
+    their replicas are only restored if `nb_replicas` is set.
+    """
+    es_conf = ctx.get("es_import") or {}
+    indices = sorted(set(_dataset_indices(url, index_type, dataset)) - existing_indices)
+    if not indices:
+        return
+
+    logging.info("restoring the settings of {}".format(", ".join(indices)))
+    indices = ",".join(indices)
+    settings = {
+        "refresh_interval": es_conf.get("refresh_interval") or "1s",
+        "translog": {"durability": "request"},
+    }
+    if nb_replicas is not None:
+        settings["number_of_replicas"] = nb_replicas
+    _es_request(url, "PUT", "/{}/_settings".format(indices), {"index": settings})
+    _es_request(url, "POST", "/{}/_refresh".format(indices))
+
+    if es_conf.get("force_merge"):
+        # a force merge can take a while, it's not timed out
+        _es_request(
+            url,
+            "POST",
+            "/{}/_forcemerge?max_num_segments={}".format(
+                indices, es_conf.get("max_num_segments") or 1
+            ),
+            timeout=None,
+        )
+
+    status = es_conf.get("wait_for_status")
+    if not status and nb_replicas:
+        # the replicas can't be allocated on the node of their primary shard
+        status = "yellow"
+        logging.info(
+            "waiting for {} to be yellow rather than green: their {} replicas"
+            " can't be allocated on a single node".format(indices, nb_replicas)
+        )
+    status = status or "green"
+    timeout = int(es_conf.get("timeout") or 600)
+    health = _es_request(
+        url,
+        "GET",
+        "/_cluster/health/{}?wait_for_status={}&timeout={}s".format(indices, status, timeout),
+        timeout=timeout + 30,
+        ok_statuses=[408],
+    )
+    if health.get("timed_out"):
+        raise Exception(
+            "{} are not {} after {}s: {}".format(indices, status, timeout, health.get("status"))
+        )
+
+
+def _es_delete_outside(url, index, bbox):
+    """
+    Delete the documents of `index` (or of the indices of an alias) whose
+    coordinates are outside of `bbox`.
+    """
+    min_lon, min_lat, max_lon, max_lat = bbox
+    _es_request(url, "POST", "/{}/_refresh".format(index))
+    res = _es_request(
+        url,
+        "POST",
+        "/{}/_search?scroll=5m".format(index),
+        {
+            "size": 1000,
+            "_source": False,
+            "query": {
+                "bool": {
+                    "filter": {"exists": {"field": "coord"}},
+                    "must_not": {
+                        "geo_bounding_box": {
+                            "coord": {
+                                "top_left": {"lat": max_lat, "lon": min_lon},
+                                "bottom_right": {"lat": min_lat, "lon": max_lon},
+                            }
+                        }
+                    },
+                }
+            },
+        },
+    )
+
+    deleted = 0
+    while res["hits"]["hits"]:
+        _es_request(
+            url,
+            "POST",
+            "/_bulk",
+            "".join(
+                json.dumps({"delete": {k: hit[k] for k in ("_index", "_type", "_id")}}) + "\n"
+                for hit in res["hits"]["hits"]
+            ),
+        )
+        deleted += len(res["hits"]["hits"])
+        res = _es_request(
+            url, "POST", "/_search/scroll", {"scroll": "5m", "scroll_id": res["_scroll_id"]}
+        )
+
+    _es_request(url, "POST", "/{}/_refresh".format(index))
+    logging.info("deleted {} documents of {} outside of {}".format(deleted, index, bbox))
+
+
+# Suffix of the names of the indices created by mimir, after their dataset.
+INDEX_SUFFIX = r"_\d{8}_\d{6}_\d+$"
+
+
+def _dataset_indices(url, index_type, dataset):
+    """
+    Indices of `index_type` of the dataset, without the ones of the datasets
+    it prefixes (eg. `fr_2` for `fr`).
+    """
+    name = re.compile(re.escape("munin_{}_{}".format(index_type, dataset)) + INDEX_SUFFIX)
+    indices = _es_request(url, "GET", "/munin_{}_{}_*/_settings".format(index_type, dataset))
+    return sorted(index for index in indices if name.match(index))
+
+
+def _es_delete_stale_tiles(url, index_type, dataset, nb_tiles):
+    """
+    Delete the indices of the tiles of the dataset above `nb_tiles` and the
+    index of the dataset imported without tiles.
+    """
+    tiled = re.compile(
+        re.escape("munin_{}_{}_tile".format(index_type, dataset)) + r"(\d+)" + INDEX_SUFFIX
+    )
+    indices = _es_request(url, "GET", "/munin_{}_{}_*/_settings".format(index_type, dataset))
+    stale = _dataset_indices(url, index_type, dataset) + [
+        index
+        for index in indices
+        if tiled.match(index) and int(tiled.match(index).group(1)) >= nb_tiles
+    ]
+
+    if stale:
+        logging.info("deleting stale indices {}".format(", ".join(stale)))
+        _es_request(url, "DELETE", "/{}".format(",".join(stale)))
+
+
+def _es_host_url(ctx, files):
+    """
+    Url of elasticsearch reachable from the host: `es_import.url`, or the
+    port published by docker-compose if `es` is the url of a service.
+    """
+    es_conf = ctx.get("es_import") or {}
+    if es_conf.get("url"):
+        return es_conf["url"].rstrip("/")
+
+    es = urlparse(ctx.es)
+    if es.hostname in (_compose_config(ctx, files).get("services") or {}):
+        res = ctx.run(
+            "docker-compose {} port {} {}".format(
+                _build_docker_files_args(files), es.hostname, es.port or 9200
+            ),
+            hide=True,
+            warn=True,
+        )
+        if res.ok and res.stdout.strip():
+            host, port = res.stdout.strip().rsplit(":", 1)
+            if host in ("0.0.0.0", "::", "[::]"):
+                host = "localhost"
+            return "{}://{}:{}".format(es.scheme, host, port)
+
+    return ctx.es.rstrip("/")
+
+
+def _es_request(url, method, path, body=None, timeout=60, ok_statuses=[]):
+    """
+    Send a request to elasticsearch, `body` is serialized in json unless it's
+    already a string (eg. for bulk requests).
+    """
+    if body is not None and not isinstance(body, str):
+        body = json.dumps(body)
+
+    request = urllib.request.Request(
+        url + path,
+        method=method,
+        data=body.encode() if body is not None else None,
+        headers={"Content-Type": "application/json"},
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            content = response.read()
+    except urllib.error.HTTPError as e:
+        if e.code not in ok_statuses:
+            raise Exception(
+                "{} {} failed with {}: {}".format(method, path, e.code, e.read().decode())
+            )
+        content = e.read()
+    return json.loads(content.decode()) if content else {}
+
+
+def _es_index_exists(url, index):
+    """
+    Check if an index (or an alias) exists in elasticsearch.
+    """
+    request = urllib.request.Request("{}/{}".format(url, index), method="HEAD")
+    try:
+        with urllib.request.urlopen(request, timeout=60):
+            return True
+    except urllib.error.HTTPError as e:
+        if e.code != 404:
+            raise
+        return False
+
+
+def _dataset_alias(index_type, dataset):
+    """
+    Alias given by mimir to the index of a type of data of a dataset.
+    """
+    return "munin_{}_{}".format(index_type, dataset)
+
+
+def _autotune(ctx, files, conf, inputs, keys, parallel_runs=1, resources=None):
+    """
+    Return a copy of the configuration of an importer, where the values of
+    `keys` (among nb_threads, nb_insert_threads and nb_shards) that are not
+    set are computed from the resources of the host and the size of the
+    inputs, if `autotune` is enabled.
+
+    The resources (the number of cpus and the memory, read by
+    `_host_resources` by default) are shared between the imports that can
+    run at the same time (`concurrent_imports`, set by load_all) and the
+    `parallel_runs` of this importer (eg. one per tile).
+    """
+    conf = dict(conf.items()) if _is_config_object(conf) else {}
+    missing_keys = [k for k in keys if conf.get(k) in (None, "")]
+
+    if not ctx.get("autotune") or not missing_keys:
+        return conf
+
+    cpus, memory = resources or _host_resources()
+    # the share of the host given to a region by `load_regions`
+    cpus = min(cpus, ctx.get("max_cpus") or cpus)
+    memory = min(memory, ctx.get("max_memory") or memory)
+    concurrent_imports = (ctx.get("concurrent_imports") or 1) * parallel_runs
+    nb_threads = min(
+        max(1, cpus // concurrent_imports),
+        max(1, memory // concurrent_imports // AUTOTUNE_MEMORY_PER_THREAD),
+    )
+
+    input_sizes = [_input_size(ctx, files, i) for i in inputs if i]
+    input_size = sum(input_sizes) if input_sizes and None not in input_sizes else None
+    tuned = {}
+
+    if input_size is not None:
+        # There is no point in using many threads for small inputs.
+        nb_threads = min(nb_threads, max(1, math.ceil(input_size / AUTOTUNE_INPUT_SIZE_PER_THREAD)))
+        tuned["nb_shards"] = min(cpus, max(1, math.ceil(input_size / AUTOTUNE_INPUT_SIZE_PER_SHARD)))
+
+    tuned["nb_threads"] = nb_threads
+    tuned["nb_insert_threads"] = max(1, nb_threads // 2)
+
+    for key in missing_keys:
+        conf[key] = tuned.get(key)
+
+    logging.info(
+        "autotuned {} (cpus: {}, memory: {}MB, inputs: {}MB)".format(
+            ", ".join("{}={}".format(k, conf[k]) for k in missing_keys),
+            cpus,
+            memory // 2 ** 20,
+            None if input_size is None else input_size // 2 ** 20,
+        )
+    )
+    return conf
+
+
+def _host_resources(cgroup_root=CGROUP_ROOT, cpus=None, memory=None):
+    """
+    Number of cpus and memory (in bytes) available, taking into account the
+    limits of the cgroup. `cpus` and `memory` are the physical resources of
+    the host, read from the system by default.
+    """
+    if cpus is None and hasattr(os, "sched_getaffinity"):
+        cpus = len(os.sched_getaffinity(0))
+    elif cpus is None:
+        cpus = os.cpu_count() or 1
+
+    if memory is None:
+        memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+    def read(filename):
+        return _read_first_line(os.path.join(cgroup_root, filename))
+
+    # cgroup v2
+    cpu_max = read("cpu.max")
+    if cpu_max and not cpu_max.startswith("max"):
+        quota, period = cpu_max.split()
+        cpus = min(cpus, max(1, int(quota) // int(period)))
+
+    memory_max = read("memory.max")
+    if memory_max and memory_max != "max":
+        memory = min(memory, int(memory_max))
+
+    # cgroup v1, "unlimited" is a huge memory limit
+    cpu_quota = read("cpu/cpu.cfs_quota_us")
+    cpu_period = read("cpu/cpu.cfs_period_us")
+    if cpu_quota and cpu_period and int(cpu_quota) > 0:
+        cpus = min(cpus, max(1, int(cpu_quota) // int(cpu_period)))
+
+    memory_limit = read("memory/memory.limit_in_bytes")
+    if memory_limit:
+        memory = min(memory, int(memory_limit))
+
+    return cpus, memory
+
+
+def _read_first_line(path):
+    try:
+        with open(path) as f:
+            return f.readline().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _input_size(ctx, files, path):
+    """
+    Size in bytes of a file or of all the files of a directory, None if it
+    is unknown.
+    """
+    host_path = _host_path(ctx, files, path)
 
-    run_rust_binary(
-        ctx,
-        "mimir",
-        "cosmogony2mimir",
-        files,
-        "--input {ctx.admin.cosmogony.file} \
-        {langs_params} \
-        --connection-string {ctx.es} \
-        --dataset {ctx.dataset} \
-        {additional_params} \
-        ".format(
-            ctx=ctx, langs_params=langs_params, additional_params=additional_params
-        ),
-    )
+    if host_path is None:
+        description = _describe_files(ctx, files, [path]).get(path) or {}
+        return description.get("size")
 
+    if os.path.isdir(host_path):
+        return sum(
+            os.path.getsize(os.path.join(dirname, name))
+            for dirname, _, names in os.walk(host_path)
+            for name in names
+        )
 
-def _get_cli_param(conf_value, cli_param_name):
-    if conf_value is not None and conf_value != "":
-        return ' {param}="{value}"'.format(param=cli_param_name, value=conf_value)
-    return ""
+    if os.path.isfile(host_path):
+        return os.path.getsize(host_path)
+
+    return None
 
 
 @task()
@@ -176,105 +1626,140 @@ def load_osm_admins(ctx, files=[]):
     osm_param = ctx.admin.get("osm")
     if not osm_param:
         return
-    args = "--import-admin"
-    if _is_config_object(osm_param):
-        for lvl in osm_param["levels"]:
-            args += " --level {}".format(lvl)
-        args += _get_cli_param(osm_param.get("nb_shards"), "--nb-admin-shards")
-        args += _get_cli_param(osm_param.get("nb_replicas"), "--nb-admin-replicas")
+    osm_conf = _autotune(ctx, files, osm_param, [ctx.osm.file], ["nb_shards"])
+    with _es_import_mode(ctx, files, "admin", osm_conf) as osm_conf:
+        args = "--import-admin"
+        if _is_config_object(osm_param):
+            for lvl in osm_param["levels"]:
+                args += " --level {}".format(lvl)
+        args += _get_cli_param(osm_conf.get("nb_shards"), "--nb-admin-shards")
+        args += _get_cli_param(osm_conf.get("nb_replicas"), "--nb-admin-replicas")
 
-    run_rust_binary(
-        ctx,
-        "mimir",
-        "osm2mimir",
-        files,
-        "--input {ctx.osm.file} \
-        --connection-string {ctx.es} \
-        --dataset {ctx.dataset}\
-        {args} \
-        ".format(
-            ctx=ctx, args=args
-        ),
-    )
+        run_rust_binary(
+            ctx,
+            "mimir",
+            "osm2mimir",
+            files,
+            "--input {ctx.osm.file} \
+            --connection-string {ctx.es} \
+            --dataset {ctx.dataset}\
+            {args} \
+            ".format(
+                ctx=ctx, args=args
+            ),
+            inputs=[ctx.osm.file],
+            index=_dataset_alias("admin", ctx.dataset),
+        )
 
 
 @task()
 def load_osm_pois(ctx, files=[]):
     logging.info("importing poi from osm")
-    poi_conf = ctx.get("poi", {}).get("osm")
-    poi_args = "--import-poi"
-    if poi_conf:
+    if _tiling_conf(ctx):
+        _run_tiles(ctx, files, "poi", lambda tile, n: _import_osm_pois(ctx, files, tile, n))
+    else:
+        _import_osm_pois(ctx, files, _whole_dataset(ctx))
+
+
+def _import_osm_pois(ctx, files, tile, parallel_runs=1):
+    poi_conf = _autotune(
+        ctx, files, ctx.get("poi", {}).get("osm"), [tile.file], ["nb_shards"], parallel_runs
+    )
+    with _es_import_mode(ctx, files, "poi", poi_conf, tile.dataset) as poi_conf:
+        poi_args = "--import-poi"
         poi_args += _get_cli_param(poi_conf.get("nb_shards"), "--nb-poi-shards")
         poi_args += _get_cli_param(poi_conf.get("nb_replicas"), "--nb-poi-replicas")
         poi_args += _get_cli_param(poi_conf.get("poi_config"), "--poi-config")
 
-    run_rust_binary(
-        ctx,
-        "mimir",
-        "osm2mimir",
-        files,
-        "--input {ctx.osm.file} \
-        --connection-string {ctx.es} \
-        --dataset {ctx.dataset}\
-        {poi_args} \
-        ".format(
-            ctx=ctx, poi_args=poi_args
-        ),
-    )
+        run_rust_binary(
+            ctx,
+            "mimir",
+            "osm2mimir",
+            files,
+            "--input {tile.file} \
+            --connection-string {ctx.es} \
+            --dataset {tile.dataset}\
+            {poi_args} \
+            ".format(
+                ctx=ctx, tile=tile, poi_args=poi_args
+            ),
+            inputs=[tile.file],
+            index=_dataset_alias("poi", tile.dataset),
+        )
 
 
 @task()
 def load_osm_streets(ctx, files=[]):
     logging.info("importing data from osm")
+    if _tiling_conf(ctx):
+        _run_tiles(ctx, files, "street", lambda tile, n: _import_osm_streets(ctx, files, tile, n))
+    else:
+        _import_osm_streets(ctx, files, _whole_dataset(ctx))
 
-    street_conf = ""
-    street_conf += _get_cli_param(
-        ctx.get("street", {}).get("nb_shards"), "--nb-street-shards"
-    )
-    street_conf += _get_cli_param(
-        ctx.get("street", {}).get("nb_replicas"), "--nb-street-replicas"
-    )
 
-    street_conf += _get_cli_param(ctx.get("street", {}).get("osm_db_file"), "--db-file")
+def _import_osm_streets(ctx, files, tile, parallel_runs=1):
+    conf = _autotune(ctx, files, ctx.get("street"), [tile.file], ["nb_shards"], parallel_runs)
+    with _es_import_mode(ctx, files, "street", conf, tile.dataset) as conf:
+        street_conf = ""
+        street_conf += _get_cli_param(conf.get("nb_shards"), "--nb-street-shards")
+        street_conf += _get_cli_param(conf.get("nb_replicas"), "--nb-street-replicas")
 
-    run_rust_binary(
-        ctx,
-        "mimir",
-        "osm2mimir",
-        files,
-        "--input {ctx.osm.file} \
-        --connection-string {ctx.es} \
-        --dataset {ctx.dataset} \
-        --import-way \
-        {street_conf} \
-        ".format(
-            ctx=ctx, street_conf=street_conf
-        ),
-    )
+        if conf.get("osm_db_file") and tile.index is not None:
+            conf["osm_db_file"] += ".tile{}".format(tile.index)
+        street_conf += _get_cli_param(conf.get("osm_db_file"), "--db-file")
+
+        run_rust_binary(
+            ctx,
+            "mimir",
+            "osm2mimir",
+            files,
+            "--input {tile.file} \
+            --connection-string {ctx.es} \
+            --dataset {tile.dataset} \
+            --import-way \
+            {street_conf} \
+            ".format(
+                ctx=ctx, tile=tile, street_conf=street_conf
+            ),
+            inputs=[tile.file],
+            index=_dataset_alias("street", tile.dataset),
+        )
 
 
 @task()
 def dedupe_addresses(ctx, files=[]):
     """Fetch and deduplicate addresses"""
     download_addresses(ctx, files)
+    _dedupe_addresses(ctx, files)
+
 
+def _dedupe_addresses(ctx, files):
     output_csv = ctx.addresses.deduplication.output
     logging.info("Running addresses importer/deduplicator")
 
+    inputs = [
+        ctx.addresses.get("bano", {}).get("file"),
+        ctx.addresses.get("oa", {}).get("path"),
+        ctx.addresses.get("osm", {}).get("file"),
+    ]
+    conf = _autotune(ctx, files, ctx.addresses.deduplication, inputs, ["nb_threads"])
+
     options = [
         "--refresh-delay=60000",
         "--output-compressed-csv=" + output_csv,
         _get_cli_param(ctx.addresses.get("bano", {}).get("file"), "--bano"),
         _get_cli_param(ctx.addresses.get("oa", {}).get("path"), "--openaddresses"),
         _get_cli_param(ctx.addresses.get("osm", {}).get("file"), "--osm"),
-        _get_cli_param(ctx.addresses.deduplication.get("nb_threads"), "--num-threads"),
+        _get_cli_param(conf.get("nb_threads"), "--num-threads"),
     ]
 
     if len(options) == 0:
         logging.info("No dataset to import: aborting addresses deduplication")
         return
 
-    run_rust_binary(ctx, "addresses-importer", "", files, " ".join(options))
+    run_rust_binary(
+        ctx, "addresses-importer", "", files, " ".join(options), inputs, output=output_csv
+    )
 
 
 def load_addresses_base_params(ctx, addr_conf):
@@ -292,16 +1777,90 @@ def load_addresses_base_params(ctx, addr_conf):
 def load_bano_adresses(ctx, input_file, files=[]):
     """Populate ES with addresses from a BANO file"""
     logging.info("importing bano addresses from %s", input_file)
-    params = load_addresses_base_params(ctx, ctx.addresses.bano) + [_get_cli_param(input_file, "--input")]
-    run_rust_binary(ctx, "mimir", "bano2mimir", files, " ".join(params))
+    _load_addresses_file(ctx, "bano2mimir", ctx.addresses.bano, input_file, files)
 
 
 @task()
 def load_oa_addresses(ctx, input_path, files=[]):
     """Populate ES with addresses from an OpenAddresses file"""
     logging.info("importing oa addresses from %s", input_path)
-    params = load_addresses_base_params(ctx, ctx.addresses.oa) + [_get_cli_param(input_path, "--input")]
-    run_rust_binary(ctx, "mimir", "openaddresses2mimir", files, " ".join(params))
+    _load_addresses_file(ctx, "openaddresses2mimir", ctx.addresses.oa, input_path, files)
+
+
+def _load_addresses_file(ctx, bin, addr_conf, input_path, files):
+    """
+    Run an addresses importer on a file (or a directory).
+
+    If `stream` is set in the addresses configuration, gzip files are
+    decompressed on the fly by the download image into a named pipe read by
+    the importer, instead of being read from disk by the importer.
+    """
+    addr_conf = _autotune(
+        ctx, files, addr_conf, [input_path], ["nb_threads", "nb_insert_threads", "nb_shards"]
+    )
+    with _es_import_mode(ctx, files, "addr", addr_conf) as addr_conf:
+        _run_addresses_importer(ctx, bin, addr_conf, input_path, files)
+
+
+def _run_addresses_importer(ctx, bin, addr_conf, input_path, files):
+    params = load_addresses_base_params(ctx, addr_conf)
+    index = _dataset_alias("addr", ctx.dataset)
+
+    if not (ctx.addresses.get("stream") and input_path.endswith(".gz")):
+        params.append(_get_cli_param(input_path, "--input"))
+        run_rust_binary(ctx, "mimir", bin, files, " ".join(params), [input_path], index=index)
+        return
+
+    files_args = _build_docker_files_args(files)
+    fifo = os.path.join("/data/addresses", os.path.basename(input_path)[: -len(".gz")])
+    streamer_name = "docker_mimir_stream_{}_{}".format(os.getpid(), next(_run_counter))
+    stream_errors = []
+
+    def stream():
+        try:
+            ctx.run(
+                "docker-compose {files} run --rm --name {name} download stream-gzip"
+                " --input-file={input_file} --output-fifo={fifo}".format(
+                    files=files_args, name=streamer_name, input_file=input_path, fifo=fifo
+                )
+            )
+        except Exception as e:
+            stream_errors.append(e)
+
+    # The streaming container only stops once the importer has read all the
+    # addresses (or after a timeout if the importer never opens the pipe).
+    streamer = threading.Thread(target=stream)
+
+    def start_streaming():
+        ctx.run("docker-compose {} run --rm download make-fifo --fifo={}".format(files_args, fifo))
+        streamer.start()
+
+    params.append(_get_cli_param(fifo, "--input"))
+    try:
+        run_rust_binary(
+            ctx,
+            "mimir",
+            bin,
+            files,
+            " ".join(params),
+            [input_path],
+            before_run=start_streaming,
+            index=index,
+        )
+    except BaseException:
+        if streamer.ident is not None:
+            # the streaming container would wait for a reader until its timeout
+            if streamer.is_alive():
+                ctx.run("docker rm -f {}".format(streamer_name), hide=True, warn=True)
+            streamer.join()
+            for e in stream_errors:
+                logging.error("failed to stream {}: {}".format(input_path, e))
+        raise
+
+    if streamer.ident is not None:
+        streamer.join()
+    if stream_errors:
+        raise stream_errors[0]
 
 
 @task()
@@ -314,27 +1873,121 @@ def load_addresses(ctx, skip_deduplication=True, files=[]):
     computation will be performed. If you wish to disable this behavior, use
     `--no-skip-deduplication`.
     """
+    _run_steps(
+        _addresses_steps(ctx, skip_deduplication, files), available=["osm_file", "admin_index"]
+    )
+
+
+def _addresses_steps(ctx, skip_deduplication, files):
     if not _is_config_object(ctx.get("addresses")):
         logging.info("no addresses to import")
-        return
+        return []
+
+    # The paths of the downloaded files are only set once they are downloaded,
+    # the files that are not downloaded are given by the configuration.
+    download_steps = _download_addresses_steps(ctx, files)
+    downloaded = [o for s in download_steps for o in s.outputs]
 
     if ctx.addresses.deduplication.enable:
         output_csv = ctx.addresses.deduplication.output
 
         if skip_deduplication and file_exists(ctx, files, output_csv):
             logging.info("`%s` already exists: skipping deduplication", output_csv)
-        else:
-            dedupe_addresses(ctx, files)
+            return [
+                Step(
+                    "load_oa_addresses",
+                    lambda: load_oa_addresses(ctx, output_csv, files),
+                    inputs=["admin_index"],
+                    outputs=["addresses_index"],
+                )
+            ]
 
-        load_oa_addresses(ctx, output_csv, files)
-    else:
-        download_addresses(ctx, files)
+        return download_steps + [
+            Step(
+                "load_oa_addresses",
+                lambda: load_oa_addresses(ctx, output_csv, files),
+                inputs=["addresses_csv", "admin_index"],
+                outputs=["addresses_index"],
+            ),
+            Step(
+                "dedupe_addresses",
+                lambda: _dedupe_addresses(ctx, files),
+                inputs=downloaded,
+                outputs=["addresses_csv"],
+            ),
+        ]
+
+    steps = download_steps
+    bano_conf = ctx.addresses.get("bano") or {}
+    oa_conf = ctx.addresses.get("oa") or {}
+
+    if bano_conf.get("url") or bano_conf.get("file"):
+        steps.append(
+            Step(
+                "load_bano_addresses",
+                lambda: load_bano_adresses(ctx, ctx.addresses.bano.file, files),
+                inputs=[i for i in ["bano_file"] if i in downloaded] + ["admin_index"],
+                outputs=["addresses_index"],
+            )
+        )
+
+    if oa_conf.get("datasets") or oa_conf.get("path"):
+        steps.append(
+            Step(
+                "load_oa_addresses",
+                lambda: load_oa_addresses(ctx, ctx.addresses.oa.path, files),
+                inputs=[i for i in ["oa_files"] if i in downloaded] + ["admin_index"],
+                outputs=["addresses_index"],
+            )
+        )
+
+    return steps
+
+
+def _download_addresses_steps(ctx, files):
+    """
+    Steps downloading the configured sources of addresses.
+    """
+    steps = []
+
+    if (ctx.addresses.get("bano") or {}).get("url"):
+        steps.append(
+            Step(
+                "download_bano",
+                lambda: _download_bano(ctx, files),
+                inputs=[],
+                outputs=["bano_file"],
+            )
+        )
 
-        if ctx.addresses.get("bano", {}).get("file"):
-            load_bano_adresses(ctx, ctx.addresses.bano.file, files)
+    if (ctx.addresses.get("oa") or {}).get("datasets"):
+        steps.append(
+            Step(
+                "download_oa",
+                lambda: _download_oa(ctx, files),
+                inputs=[],
+                outputs=["oa_files"],
+            )
+        )
+
+    if (ctx.addresses.get("osm") or {}).get("url"):
+        # The same extract can be used for the main import and for the
+        # addresses, in this case we must not download it twice at the same
+        # time.
+        osm_addresses_inputs = []
+        if ctx.addresses.osm.url == ctx.get("osm", {}).get("url"):
+            osm_addresses_inputs = ["osm_file"]
+
+        steps.append(
+            Step(
+                "download_osm_addresses",
+                lambda: _download_osm_addresses(ctx, files),
+                inputs=osm_addresses_inputs,
+                outputs=["osm_addresses_file"],
+            )
+        )
 
-        if ctx.addresses.get("oa", {}).get("path"):
-            load_oa_addresses(ctx, ctx.addresses.oa.path, files)
+    return steps
 
 
 @task()
@@ -349,37 +2002,153 @@ def load_fafnir_pois(ctx, files=[]):
         return
 
     logging.info("fafnir {}".format(fafnir_conf))
+    if _tiling_conf(ctx):
+        _run_tiles(
+            ctx,
+            files,
+            "poi",
+            lambda tile, n: _import_fafnir_pois(ctx, files, fafnir_conf, tile, n),
+            extract=False,
+        )
+    else:
+        _import_fafnir_pois(ctx, files, fafnir_conf, _whole_dataset(ctx))
 
-    langs_params = ""
-    if fafnir_conf.get("langs", ""):
-        langs_codes = fafnir_conf.get("langs").split(",")
-        for code in langs_codes:
-            langs_params += _get_cli_param(code, "--lang")
 
-    additional_params = _get_cli_param(fafnir_conf.get("nb_threads"), "--nb-threads")
-    additional_params += _get_cli_param(
-        fafnir_conf.get("bounding-box"), "--bounding-box"
-    )
-    additional_params += _get_cli_param(fafnir_conf.get("nb_shards"), "--nb-shards")
-    additional_params += _get_cli_param(fafnir_conf.get("nb_replicas"), "--nb-replicas")
+def _import_fafnir_pois(ctx, files, fafnir_conf, tile, parallel_runs=1):
+    fafnir_conf = _autotune(ctx, files, fafnir_conf, [], ["nb_threads"], parallel_runs)
+    with _es_import_mode(ctx, files, "poi", fafnir_conf, tile.dataset) as fafnir_conf:
+        langs_params = ""
+        if fafnir_conf.get("langs", ""):
+            langs_codes = fafnir_conf.get("langs").split(",")
+            for code in langs_codes:
+                langs_params += _get_cli_param(code, "--lang")
+
+        if tile.bbox is not None:
+            fafnir_conf["bounding-box"] = ",".join(str(c) for c in tile.bbox)
+
+        additional_params = _get_cli_param(fafnir_conf.get("nb_threads"), "--nb-threads")
+        additional_params += _get_cli_param(
+            fafnir_conf.get("bounding-box"), "--bounding-box"
+        )
+        additional_params += _get_cli_param(fafnir_conf.get("nb_shards"), "--nb-shards")
+        additional_params += _get_cli_param(fafnir_conf.get("nb_replicas"), "--nb-replicas")
+
+        logging.info("importing poi with fafnir")
+        run_rust_binary(
+            ctx,
+            "",
+            "fafnir",
+            files,
+            "--es {ctx.es} \
+            {langs_params} \
+            {additional_params} \
+            --dataset {tile.dataset}\
+            --pg {pg}".format(
+                ctx=ctx,
+                tile=tile,
+                pg=fafnir_conf["pg"],
+                langs_params=langs_params,
+                additional_params=additional_params,
+            ),
+            # the pois are read from postgres, whose content is not known
+            checkpoint=False,
+        )
+
+
+# A part of the dataset imported on its own: the whole dataset or a tile
+# (`bbox` is its bounding box, `file` its osm extract).
+Tile = namedtuple("Tile", ["index", "bbox", "dataset", "file"])
+
+
+def _whole_dataset(ctx):
+    return Tile(None, None, ctx.dataset, ctx.get("osm", {}).get("file"))
 
-    logging.info("importing poi with fafnir")
-    run_rust_binary(
-        ctx,
-        "",
-        "fafnir",
-        files,
-        "--es {ctx.es} \
-        {langs_params} \
-        {additional_params} \
-        --dataset {ctx.dataset}\
-        --pg {pg}".format(
-            ctx=ctx,
-            pg=fafnir_conf["pg"],
-            langs_params=langs_params,
-            additional_params=additional_params,
-        ),
-    )
+
+def _tiling_conf(ctx):
+    conf = ctx.get("tiling") or {}
+    return conf if conf.get("enable") else None
+
+
+_osm_tiles_lock = threading.Lock()
+_osm_tiles = {}
+
+
+def _get_osm_tiles(ctx, files, extract):
+    """
+    Tiles of the osm extract imported by this host (`tiling.tiles`, all the
+    tiles by default). If `extract` is set, the osm extract of each tile is
+    written by the download image.
+    """
+    conf = _tiling_conf(ctx)
+    files_args = _build_docker_files_args(files)
+
+    key = (ctx.osm.file, ctx.dataset)
+    with _osm_tiles_lock:
+        if key not in _osm_tiles:
+            res = ctx.run(
+                "docker-compose {files} run --rm download compute-tiles"
+                " --osm-file={osm_file} --nb-tiles={nb_tiles}".format(
+                    files=files_args, osm_file=ctx.osm.file, nb_tiles=conf.get("nb_tiles") or 1
+                )
+            )
+            bboxes = json.loads(res.stdout.strip().splitlines()[-1])
+            name = re.sub(r"\.osm\.pbf$", "", os.path.basename(ctx.osm.file))
+            _osm_tiles[key] = {
+                "tiles": [
+                    Tile(
+                        i,
+                        bbox,
+                        "{}_tile{}".format(ctx.dataset, i),
+                        "/data/osm/tiles/{}_tile{}.osm.pbf".format(name, i),
+                    )
+                    for i, bbox in enumerate(bboxes)
+                    if not conf.get("tiles") or i in conf.get("tiles")
+                ],
+                "extracted": False,
+            }
+
+        tiles = _osm_tiles[key]
+        if extract and not tiles["extracted"]:
+            ctx.run(
+                "docker-compose {files} run --rm download extract-tiles --osm-file={osm_file}"
+                " --tiles='{tiles}' --output-dir=/data/osm/tiles".format(
+                    files=files_args,
+                    osm_file=ctx.osm.file,
+                    tiles=json.dumps({t.file: t.bbox for t in tiles["tiles"]}),
+                )
+            )
+            tiles["extracted"] = True
+
+        return tiles["tiles"]
+
+
+def _run_tiles(ctx, files, index_type, import_tile, extract=True):
+    """
+    Import the tiles of the dataset in parallel, `import_tile(tile, n)` is
+    called for each tile with `n` the number of tiles imported at the same
+    time. Each tile is imported in its own dataset.
+
+    The objects crossing the border of a tile are imported in all the tiles
+    they cross, they are then only kept in the tile containing their
+    coordinates. The indices of the tiles that are not part of the dataset
+    anymore (and the index of the dataset before it was tiled) are deleted.
+    """
+    conf = _tiling_conf(ctx)
+    tiles = _get_osm_tiles(ctx, files, extract)
+    nb_parallel = max(1, min(len(tiles), int(conf.get("max_parallel") or len(tiles))))
+    step = getattr(_current_step, "name", None)
+    url = _es_host_url(ctx, files)
+
+    def run(tile):
+        _current_step.name = "{}_tile{}".format(step, tile.index) if step else None
+        import_tile(tile, nb_parallel)
+        _es_delete_outside(url, _dataset_alias(index_type, tile.dataset), tile.bbox)
+
+    with ThreadPoolExecutor(max_workers=nb_parallel) as executor:
+        for _ in executor.map(run, tiles):
+            pass
+
+    _es_delete_stale_tiles(url, index_type, ctx.dataset, int(conf.get("nb_tiles") or 1))
 
 
 def _use_cosmogony(ctx):
@@ -392,42 +2161,375 @@ def _is_config_object(obj):
 
 
 def load_admins(ctx, files):
-    if _use_cosmogony(ctx):
-        logging.info("using cosmogony")
-        if not ctx.admin.cosmogony.get("file"):
-            generate_cosmogony(ctx, files)
-        load_cosmogony(ctx, files)
-    else:
-        load_osm_admins(ctx, files)
+    _run_steps(_admins_steps(ctx, files), available=["osm_file"])
+
+
+def _admins_steps(ctx, files):
+    if not _use_cosmogony(ctx):
+        return [
+            Step(
+                "load_osm_admins",
+                lambda: load_osm_admins(ctx, files),
+                inputs=["osm_file"],
+                outputs=["admin_index"],
+            )
+        ]
+
+    logging.info("using cosmogony")
+    # the cosmogony file is generated if it's not given
+    generate = not ctx.admin.cosmogony.get("file")
+    steps = [
+        Step(
+            "load_cosmogony",
+            lambda: load_cosmogony(ctx, files),
+            inputs=["cosmogony_file"] if generate else [],
+            outputs=["admin_index"],
+        )
+    ]
+
+    if generate:
+        steps.append(
+            Step(
+                "generate_cosmogony",
+                lambda: generate_cosmogony(ctx, files),
+                inputs=["osm_file"],
+                outputs=["cosmogony_file"],
+            )
+        )
+
+    return steps
 
 
 def load_pois(ctx, files):
+    _run_steps(_pois_steps(ctx, files), available=["osm_file", "admin_index"])
+
+
+def _pois_steps(ctx, files):
     poi_conf = ctx.get("poi")
     if not _is_config_object(poi_conf):
         logging.info("no poi to import")
-        return
+        return []
 
     if "fafnir" in poi_conf:
-        load_fafnir_pois(ctx, files)
+        # fafnir reads the pois from postgres, the osm file is only used to
+        # split it in tiles
+        return [
+            Step(
+                "load_fafnir_pois",
+                lambda: load_fafnir_pois(ctx, files),
+                inputs=["osm_file", "admin_index"] if _tiling_conf(ctx) else ["admin_index"],
+                outputs=["poi_index"],
+            )
+        ]
     elif "osm" in poi_conf:
-        load_osm_pois(ctx, files)
+        return [
+            Step(
+                "load_osm_pois",
+                lambda: load_osm_pois(ctx, files),
+                inputs=["osm_file", "admin_index"],
+                outputs=["poi_index"],
+            )
+        ]
+
+    return []
+
+
+def _load_all_steps(ctx, skip_deduplication, files):
+    return (
+        [
+            Step(
+                "download_osm",
+                lambda: download_osm(ctx, files),
+                inputs=[],
+                outputs=["osm_file"],
+            ),
+            Step(
+                "load_osm_streets",
+                lambda: load_osm_streets(ctx, files),
+                inputs=["osm_file", "admin_index"],
+                outputs=["street_index"],
+            ),
+        ]
+        + _admins_steps(ctx, files)
+        + _addresses_steps(ctx, skip_deduplication, files)
+        + _pois_steps(ctx, files)
+    )
+
+
+# Steps importing each kind of data read from the osm extract.
+OSM_UPDATE_STEPS = {
+    "admins": ["generate_cosmogony", "load_cosmogony", "load_osm_admins"],
+    "streets": ["load_osm_streets"],
+    "pois": ["load_osm_pois"],
+}
+
+
+def _update_steps(steps, changed):
+    """
+    Steps to run after an update of the osm extract: the steps importing the
+    kinds of data that `changed`, the steps using what they produce (eg. all
+    the imports depend on the admins) and the steps producing the files they
+    need.
+    """
+    selected = {n for kind in changed for n in OSM_UPDATE_STEPS.get(kind, [])}
+
+    def closure(names, linked):
+        while True:
+            new = {s.name for s in steps if s.name not in names and linked(s, names)}
+            if not new:
+                return names
+            names = names | new
+
+    def uses_outputs(step, names):
+        return any(set(s.outputs) & set(step.inputs) for s in steps if s.name in names)
+
+    def produces_files(step, names):
+        # the indexes that don't need an update are already in elasticsearch
+        return any(
+            i in step.outputs and not i.endswith("_index")
+            for s in steps
+            if s.name in names
+            for i in s.inputs
+        )
+
+    selected = closure(closure(selected, uses_outputs), produces_files)
+    return [s for s in steps if s.name in selected]
 
 
 @task(default=True)
-def load_all(ctx, skip_deduplication=True, files=[]):
+def load_all(
+    ctx,
+    skip_deduplication=True,
+    files=[],
+    max_parallel_steps=None,
+    resume=False,
+    update=False,
+):
     """
     default task called if `invoke` is run without args
     This is the main tasks that import all the datas into mimir
+
+    The independent steps of the import (like the download of the addresses
+    and the generation of cosmogony) are run concurrently, the number of
+    steps run at the same time can be limited with `--max-parallel-steps`
+    (or `max_parallel_steps` in the configuration).
+
+    With `--resume`, the steps that already succeeded with the same inputs,
+    parameters and docker image (eg. before a failure) are skipped, if their
+    index (or the file they write) still exists. The steps are recorded if `checkpoints_file` is set
+    or with `--resume`.
+
+    With `--update`, the osm extract is updated with its replication diffs
+    (`osm.replication_url`) instead of being downloaded again, and only the
+    steps affected by the changes are run. The addresses read from osm by the
+    deduplication are not updated.
+    """
+    try:
+        _load_all(ctx, skip_deduplication, files, max_parallel_steps, resume, update)
+    finally:
+        _stop_executors()
+
+
+def _load_all(ctx, skip_deduplication, files, max_parallel_steps, resume, update):
+    if resume:
+        ctx.resume = True
+
+    max_parallel_steps = int(max_parallel_steps or ctx.get("max_parallel_steps") or 1)
+    steps = _load_all_steps(ctx, skip_deduplication, files)
+    selected = {s.name for s in steps}
+
+    if update:
+        changed = _update_osm(ctx, files)
+        # the other steps are kept to produce the inputs, without being run
+        selected = {s.name for s in _update_steps(steps, changed)} - {"download_osm"}
+        steps = [s if s.name in selected else s._replace(run=lambda: None) for s in steps]
+
+    # The imports using the admins are all started once the admins are
+    # imported, the autotuning shares the resources of the host between them.
+    ctx.concurrent_imports = min(
+        max_parallel_steps,
+        len([s for s in steps if "admin_index" in s.inputs and s.name in selected]) or 1,
+    )
+
+    _run_steps(steps, max_parallel_steps)
+
+
+@task(iterable=["regions", "files"])
+def load_regions(
+    ctx,
+    regions,
+    skip_deduplication=True,
+    files=[],
+    max_parallel_regions=None,
+    resume=False,
+    update=False,
+):
+    """
+    Import several regions at the same time, each one is described by a
+    configuration file (like the ones given to `invoke -f`) given with
+    `--regions`, and must have its own dataset.
+
+    The files needed by several regions are downloaded (and extracted) once.
+    At most `--max-parallel-regions` (or `regions.max_parallel`) regions are
+    imported at the same time, each one reserving a part of the cpus and of
+    the memory of the host (see `regions` in the configuration).
     """
-    download_osm(ctx, files)
+    global _shared_downloads, _steps_budget
+
+    conf = ctx.get("regions") or {}
+    max_parallel = int(max_parallel_regions or conf.get("max_parallel") or len(regions))
+    max_parallel = max(1, min(max_parallel, len(regions)))
+    cpus, memory = _host_resources()
+    memory = _mega_bytes(conf.get("memory")) or memory
+
+    contexts = [_region_context(ctx, region) for region in regions]
+    _check_regions(regions, contexts)
+
+    budget = threading.Condition()
+    available_memory = [memory]
+
+    def load_region(region, region_ctx):
+        region_memory = _mega_bytes(region_ctx.get("region_memory")) or memory // max_parallel
+        if region_memory > memory:
+            raise Exception(
+                "{} needs {}MB but only {}MB are available".format(
+                    region, region_memory // 2 ** 20, memory // 2 ** 20
+                )
+            )
+
+        with budget:
+            budget.wait_for(lambda: available_memory[0] >= region_memory)
+            available_memory[0] -= region_memory
+
+        region_ctx.max_cpus = max(1, cpus // max_parallel)
+        region_ctx.max_memory = region_memory
+        try:
+            logging.info("importing region {} ({})".format(region_ctx.dataset, region))
+            _load_all(region_ctx, skip_deduplication, files, None, resume, update)
+            logging.info("region {} imported".format(region_ctx.dataset))
+        finally:
+            with budget:
+                available_memory[0] += region_memory
+                budget.notify_all()
+
+    _shared_downloads = {}
+    if conf.get("max_parallel_steps"):
+        _steps_budget = threading.BoundedSemaphore(int(conf["max_parallel_steps"]))
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+            futures = [executor.submit(load_region, r, c) for r, c in zip(regions, contexts)]
+
+        failures = []
+        for region, future in zip(regions, futures):
+            if future.exception() is not None:
+                logging.error("failed to import {}: {}".format(region, future.exception()))
+                failures.append(region)
 
-    load_admins(ctx, files)
+        if failures:
+            raise Exception("failed to import regions: {}".format(", ".join(failures)))
+    finally:
+        _shared_downloads = None
+        _steps_budget = None
+        _stop_executors()
 
-    load_addresses(ctx, skip_deduplication, files)
 
-    load_osm_streets(ctx, files)
+def _mega_bytes(value):
+    return int(value) * 2 ** 20 if value else None
 
-    load_pois(ctx, files)
+
+def _region_context(ctx, config_file):
+    """
+    Context of a region, with the configuration of `ctx` and the one of the
+    region (as if it was given to `invoke -f`).
+    """
+    config = ctx.config.clone()
+    config.set_runtime_path(config_file)
+    config.load_runtime()
+    return Context(config)
+
+
+def _check_regions(regions, contexts):
+    """
+    Check that the regions don't write different contents to the same files or
+    datasets, log the downloads shared by several regions.
+    """
+    outputs = defaultdict(set)
+    urls = defaultdict(set)
+
+    for region, ctx in zip(regions, contexts):
+
+        def output(kind, path, content=None):
+            # the regions writing the same content to a file share it
+            outputs[(kind, path)].add(content or region)
+
+        output("dataset", ctx.dataset)
+
+        osm = ctx.get("osm") or {}
+        addresses = ctx.get("addresses") or {}
+        cosmogony = (ctx.get("admin") or {}).get("cosmogony") or {}
+        bano = addresses.get("bano") or {}
+        oa = addresses.get("oa") or {}
+        deduplication = addresses.get("deduplication") or {}
+        street = ctx.get("street") or {}
+        stream = addresses.get("stream") and not deduplication.get("enable")
+
+        if osm.get("url"):
+            osm_file = os.path.join("/data/osm", os.path.basename(osm["url"]))
+            output("file", osm_file, osm["url"])
+            if _tiling_conf(ctx):
+                name = re.sub(r"\.osm\.pbf$", "", os.path.basename(osm_file))
+                nb_tiles = str(_tiling_conf(ctx).get("nb_tiles") or 1)
+                output("file", "/data/osm/tiles/{}_tile*".format(name), nb_tiles)
+        if (addresses.get("osm") or {}).get("url"):
+            url = addresses["osm"]["url"]
+            output("file", os.path.join("/data/osm", os.path.basename(url)), url)
+        if cosmogony.get("output_dir") and not cosmogony.get("file"):
+            output("file", cosmogony["output_dir"] + "/cosmogony.jsonl.gz")
+        if street.get("osm_db_file"):
+            output("file", street["osm_db_file"])
+
+        if bano.get("url"):
+            output("file", DOWNLOAD_CACHE_DIR + "/bano.csv.gz", bano["url"])
+            # the addresses are streamed from the cache to a fifo
+            output("file", "/data/addresses/bano.csv", None if stream else bano["url"])
+        # the regions extracting the same datasets share their extraction
+        if oa.get("datasets"):
+            output(
+                "directory",
+                oa.get("path") or "/data/addresses/oa",
+                json.dumps(oa["datasets"], sort_keys=True),
+            )
+            for dataset in oa["datasets"]:
+                src_file = os.path.join(DOWNLOAD_CACHE_DIR, dataset["filename"])
+                output("file", src_file, dataset["url"])
+        if deduplication.get("enable"):
+            output("file", deduplication["output"])
+            if addresses.get("stream") and deduplication["output"].endswith(".gz"):
+                fifo = os.path.basename(deduplication["output"])[: -len(".gz")]
+                output("file", os.path.join("/data/addresses", fifo))
+
+        region_urls = [
+            osm.get("url"),
+            bano.get("url"),
+            (addresses.get("osm") or {}).get("url"),
+        ] + [d["url"] for d in oa.get("datasets") or []]
+        for url in filter(None, region_urls):
+            urls[url].add(region)
+
+    conflicts = ["{} {}".format(*k) for k, v in outputs.items() if len(v) > 1]
+    if conflicts:
+        raise Exception(
+            "the regions can't be imported together, they use the same {}".format(
+                ", ".join(conflicts)
+            )
+        )
+
+    logging.info(
+        "{} regions, {} files to download ({} shared)".format(
+            len(regions), len(urls), len([u for u, r in urls.items() if len(r) > 1])
+        )
+    )
 
 
 @task(iterable=["files"])
@@ -440,10 +2542,36 @@ def compose_up(ctx, files=[]):
     logging.info("running in docker-compose mode")
     files_args = _build_docker_files_args(files)
 
-    ctx.run("docker-compose {files} pull".format(files=files_args))
-    ctx.run("docker-compose {files} up -d --build".format(files=files_args))
+    services = _needed_services(ctx, files)
+    _pull_images(ctx, files, services)
+    ctx.run(
+        "docker-compose {files} up -d --build {services}".format(
+            files=files_args, services=" ".join(services)
+        )
+    )
 
-    _wait_for_es(ctx, files)
+    start = time()
+    success = False
+    try:
+        _wait_for_es(ctx, files)
+        success = True
+    finally:
+        if _metrics_conf(ctx).get("enable"):
+            es_service = urlparse(ctx.es).hostname
+            _record_metrics(
+                ctx,
+                dict(
+                    dataset=ctx.get("dataset"),
+                    task="es_startup",
+                    image=(
+                        (_compose_config(ctx, files).get("services") or {}).get(es_service)
+                        or {}
+                    ).get("image", es_service),
+                    success=success,
+                    started_at=start,
+                    duration_seconds=time() - start,
+                ),
+            )
 
 
 @task(iterable=["files"])
@@ -466,16 +2594,20 @@ def test(ctx, files=None):
     """
     logging.info("running geocoder-tester")
 
-    # we update the images in tester_docker-compose
-    ctx.run("docker-compose -f tester_docker-compose.yml pull")
-    ctx.run("docker-compose -f tester_docker-compose.yml build")
+    # we update the images in tester_docker-compose, if it's not done yet
+    _prepare_tester(ctx, files).result()
     files_args = _build_docker_files_args(["tester_docker-compose.yml"] + files)
 
+    additional_args = ["run-all"]
     region = ctx.get("geocoder_tester_region")
     if region:
-        additional_args = "run-all --regions {}".format(region)
-    else:
-        additional_args = ""
+        additional_args.append("--regions {}".format(region))
+    fingerprint = _dataset_fingerprint(ctx, files)
+    if fingerprint:
+        additional_args.append("--fingerprint {}".format(fingerprint))
+    if ctx.get("geocoder_tester_changed_only"):
+        additional_args.append("--changed-only")
+    additional_args = " ".join(additional_args)
     ctx.run(
         "docker-compose {files} run --rm geocoder-tester-runner {args}".format(
             files=files_args, args=additional_args
@@ -483,26 +2615,242 @@ def test(ctx, files=None):
     )
 
 
-@retry(stop_max_delay=60000, wait_fixed=100)
-def _wait_for_es(ctx, files):
-    logging.info("waiting for es")
-    logging.info("waiting for es {}".format(ctx.es))
-    files_args = _build_docker_files_args(["tester_docker-compose.yml"] + files)
-    ctx.run(
-        "docker-compose {files_args} run --rm pinger {url}".format(
-            files_args=files_args, url=ctx.es
-        )
+def _dataset_fingerprint(ctx, files):
+    """
+    Identifier of the data imported in elasticsearch: the indices behind the
+    aliases of mimir, which are new indices after each import. None if
+    elasticsearch can't be reached.
+    """
+    try:
+        aliases = _es_request(_es_host_url(ctx, files), "GET", "/_aliases")
+    except Exception as e:
+        logging.warning("could not get the aliases of es: {}".format(e))
+        return None
+
+    indices = sorted(
+        "{}:{}".format(index, ",".join(sorted(conf.get("aliases") or {})))
+        for index, conf in aliases.items()
+        if index.startswith("munin")
     )
+    return hashlib.sha256("\n".join(indices).encode()).hexdigest()[:16]
+
+
+# Statuses of the cluster health, from the worst to the best.
+ES_HEALTH_STATUSES = ["red", "yellow", "green"]
+
+
+def _wait_for_es(ctx, files):
+    """
+    Wait for the cluster health of elasticsearch to be at least
+    `es_health.wait_for_status`, probing it with an exponential backoff, and
+    return the time waited.
+    """
+    conf = ctx.get("es_health") or {}
+    url = _es_host_url(ctx, files)
+    status = conf.get("wait_for_status") or "yellow"
+
+    timeout = float(conf.get("timeout") or 120)
+    delay = float(conf.get("initial_delay") or 0.1)
+    max_delay = float(conf.get("max_delay") or 5)
+
+    start = time()
+    while True:
+        remaining = timeout - (time() - start)
+        try:
+            health = _es_request(
+                url, "GET", "/_cluster/health", timeout=max(min(remaining, 10), 1)
+            )
+            error = "its status is {}".format(health.get("status"))
+            if ES_HEALTH_STATUSES.index(health.get("status", "red")) >= ES_HEALTH_STATUSES.index(
+                status
+            ):
+                break
+        except Exception as e:
+            error = e
+
+        if time() - start + delay > timeout:
+            raise Exception(
+                "es {} is not {} after {}s: {}".format(url, status, int(timeout), error)
+            )
+        logging.debug("es {} is not {} yet: {}".format(url, status, error))
+        sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+    waited = time() - start
+    logging.info("es {} is {} (waited {:.1f}s)".format(url, status, waited))
+    return waited
 
 
 @task(iterable=["files"])
 def load_in_docker_and_test(ctx, files=[]):
     compose_up(ctx, files)
-    load_all(ctx, files)
+    # the images of the tester are updated while the data is imported
+    _prepare_tester(ctx, files)
+    load_all(ctx, files=files)
     test(ctx, files)
     compose_down(ctx, files)
 
 
+# Services running the binaries of each step.
+STEP_SERVICES = {
+    "download_osm": ["download"],
+    "download_bano": ["download"],
+    "download_oa": ["download"],
+    "download_osm_addresses": ["download"],
+    "generate_cosmogony": ["cosmogony"],
+    "load_cosmogony": ["mimir"],
+    "load_osm_admins": ["mimir"],
+    "load_osm_streets": ["mimir"],
+    "load_osm_pois": ["mimir"],
+    "load_bano_addresses": ["mimir"],
+    "load_oa_addresses": ["mimir"],
+    "dedupe_addresses": ["addresses-importer"],
+    "load_fafnir_pois": ["fafnir"],
+}
+
+
+def _needed_services(ctx, files):
+    """
+    Services of docker-compose needed by the configured import: the services
+    running its steps (unless their binaries are run on the host) and all the
+    services that are not running any step (like elasticsearch and bragi).
+    """
+    services = list(_compose_config(ctx, files).get("services") or {})
+    conf = ctx.get("executors") or {}
+    used = {
+        service
+        for step in _load_all_steps(ctx, False, files)
+        for service in STEP_SERVICES.get(step.name, [])
+        if (conf.get(service) or conf.get("default")) != "local"
+    }
+    unused = {s for services in STEP_SERVICES.values() for s in services} - used
+    return [s for s in services if s not in unused]
+
+
+def _pull_images(ctx, files, services):
+    """
+    Pull the images of `services` concurrently (at most `pull.max_parallel` at
+    the same time), skipping the images that are built and, if
+    `pull.check_digests` is set, the ones whose local version is the one of
+    the registry.
+    """
+    conf = ctx.get("pull") or {}
+    compose_services = _compose_config(ctx, files).get("services") or {}
+    images = {
+        service: compose_services[service]["image"]
+        for service in services
+        if "image" in compose_services.get(service, {})
+        and "build" not in compose_services[service]
+    }
+
+    def pull(service):
+        if conf.get("check_digests", True):
+            local_digests = _image_property(ctx, files, service, ".RepoDigests") or []
+            digest = _registry_digest(images[service]) if local_digests else None
+            if digest and any(d.endswith("@" + digest) for d in local_digests):
+                logging.info("{} is up to date".format(images[service]))
+                return
+        ctx.run(
+            "docker-compose {} pull {}".format(_build_docker_files_args(files), service)
+        )
+
+    if not images:
+        return
+    with ThreadPoolExecutor(max_workers=int(conf.get("max_parallel") or 4)) as pool:
+        for future in [pool.submit(pull, service) for service in images]:
+            future.result()
+
+
+# Types of manifests accepted from the registries, the manifest lists (of
+# multi-architecture images) are the ones referenced in the local digests.
+REGISTRY_MANIFEST_TYPES = [
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.oci.image.manifest.v1+json",
+]
+
+
+def _registry_digest(image):
+    """
+    Digest of the current manifest of an image in its registry (the docker hub
+    by default), None if it can't be found.
+    """
+    name, _, digest = image.partition("@")
+    if digest:
+        return digest
+
+    registry, _, repository = name.partition("/")
+    if not repository or not ("." in registry or ":" in registry or registry == "localhost"):
+        registry, repository = "registry-1.docker.io", name
+        if "/" not in repository:
+            repository = "library/" + repository
+    tag = "latest"
+    if ":" in repository:
+        repository, tag = repository.rsplit(":", 1)
+
+    url = "https://{}/v2/{}/manifests/{}".format(registry, repository, tag)
+    headers = {"Accept": ", ".join(REGISTRY_MANIFEST_TYPES)}
+    try:
+        try:
+            return _registry_manifest_digest(url, headers)
+        except urllib.error.HTTPError as e:
+            challenge = e.headers.get("WWW-Authenticate") or ""
+            if e.code != 401 or not challenge.startswith("Bearer "):
+                raise
+        # anonymous token for the scope requested by the registry
+        params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        token_url = "{}?{}".format(params.pop("realm"), urlencode(params))
+        with urllib.request.urlopen(token_url, timeout=30) as response:
+            token = json.loads(response.read().decode())
+        headers["Authorization"] = "Bearer {}".format(
+            token.get("token") or token.get("access_token")
+        )
+        return _registry_manifest_digest(url, headers)
+    except Exception as e:
+        logging.warning("could not get the digest of {}: {}".format(image, e))
+        return None
+
+
+def _registry_manifest_digest(url, headers):
+    request = urllib.request.Request(url, method="HEAD", headers=headers)
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return response.headers.get("Docker-Content-Digest")
+
+
+_tester_lock = threading.Lock()
+_tester_images = {}
+
+
+def _prepare_tester(ctx, files):
+    """
+    Update the images of the geocoder tester in the background (once per
+    compose files), return the future of the update.
+    """
+    tester_files = ["tester_docker-compose.yml"] + files
+    key = _build_docker_files_args(tester_files)
+
+    def update():
+        with open("tester_docker-compose.yml") as f:
+            services = list(yaml.safe_load(f).get("services") or {})
+        _pull_images(ctx, tester_files, services)
+        ctx.run("docker-compose {} build {}".format(key, " ".join(services)), hide=True)
+
+    with _tester_lock:
+        if key not in _tester_images:
+            future = Future()
+            _tester_images[key] = future
+
+            def run():
+                try:
+                    future.set_result(update())
+                except Exception as e:
+                    future.set_exception(e)
+
+            threading.Thread(target=run, daemon=True).start()
+        return _tester_images[key]
+
+
 def _build_docker_files_args(files):
     compose_files = ["docker-compose.yml"] + files
     return "".join([" -f {}".format(f) for f in compose_files])
@@ -0,0 +1,1308 @@
+"""
+Tests of the import tasks against local stand-ins of their services, run with
+`python -m pytest test_tasks.py` from this directory.
+"""
+import fnmatch
+import itertools
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+import yaml
+from invoke import Config, Context
+from invoke.exceptions import UnexpectedExit
+from invoke.runners import Result
+
+from conftest import load_module
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+tasks = load_module("docker_mimir_tasks", os.path.join(HERE, "tasks.py"))
+
+EXISTING_INDEX = "munin_addr_test_20200101_000000_000000"
+NEW_INDEX = "munin_addr_test_20200102_000000_000000"
+
+
+class FakeElasticsearch:
+    """
+    The part of the elasticsearch api used by the import mode: the templates,
+    the settings of the indices, their aliases and their health (`health` is
+    the status code and the body of its response).
+    """
+
+    def __init__(self):
+        self.templates = {}
+        self.indices = {}
+        self.aliases = set()
+        self.requests = []
+        self.health = (200, {"status": "yellow", "timed_out": False})
+
+    def handle(self, method, path, query, body):
+        self.requests.append((method, path, query, body))
+        parts = path.strip("/").split("/")
+
+        if parts[0] == "_template":
+            if method == "PUT":
+                self.templates[parts[1]] = body
+            else:
+                self.templates.pop(parts[1])
+            return 200, {"acknowledged": True}
+
+        if parts[0] == "_cluster":
+            return self.health
+
+        indices = [
+            index
+            for pattern in parts[0].split(",")
+            for index in sorted(self.indices)
+            if fnmatch.fnmatch(index, pattern)
+        ]
+        if not parts[1:] and method == "HEAD":
+            return (200 if indices or parts[0] in self.aliases else 404), {}
+        if parts[1:] == ["_settings"] and method == "GET":
+            return 200, {index: {"settings": self.indices[index]} for index in indices}
+        if parts[1:] == ["_settings"] and method == "PUT":
+            for index in indices:
+                self.indices[index].update(body["index"])
+            return 200, {"acknowledged": True}
+        if not parts[1:] and method == "DELETE":
+            for index in indices:
+                del self.indices[index]
+            return 200, {"acknowledged": True}
+        return 200, {}
+
+    def handler(self):
+        es = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _handle(self):
+                url = urlparse(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length).decode()) if length else None
+                status, response = es.handle(self.command, url.path, parse_qs(url.query), body)
+                content = json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(content)
+
+            do_GET = do_HEAD = do_PUT = do_POST = do_DELETE = _handle
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class FakeDocker:
+    """
+    Answer the commands run by the tasks (`ctx.run`) and record them. The
+    commands matching a regex of `outputs` print its value (they fail if it
+    is None, it's called with the command if it's a function), the other
+    ones print nothing.
+    """
+
+    def __init__(self, compose_config):
+        self.commands = []
+        self.outputs = {}
+        self.set_compose_config(compose_config)
+
+    def set_compose_config(self, compose_config):
+        self.outputs[r"^docker-compose .* config$"] = yaml.safe_dump(
+            compose_config, sort_keys=False
+        )
+
+    def run(self, command, warn=False, **kwargs):
+        self.commands.append(command)
+        for pattern, output in self.outputs.items():
+            if re.search(pattern, command):
+                break
+        else:
+            output = ""
+        if callable(output):
+            output = output(command)
+
+        result = Result(stdout=output or "", command=command, exited=0 if output is not None else 1)
+        if not result.ok and not warn:
+            raise UnexpectedExit(result)
+        return result
+
+
+COMPOSE = " -f docker-compose.yml"
+
+COMPOSE_CONFIG = {
+    "name": "docker_mimir",
+    "services": {
+        "mimir": {
+            "image": "navitia/mimirsbrunn",
+            "volumes": [
+                "/srv/osm:/data/osm:ro",
+                {"type": "volume", "source": "addresses", "target": "/data/addresses"},
+            ],
+        },
+        "cosmogony": {
+            "image": "osmwithoutborders/cosmogony",
+            "volumes": ["/srv/osm:/data/osm", "cosmogony:/data/cosmogony"],
+        },
+    },
+    "volumes": {"addresses": {}, "cosmogony": {"external": True}},
+}
+
+
+@pytest.fixture
+def docker(ctx, monkeypatch):
+    # the configuration of docker-compose and the executors are cached
+    monkeypatch.setattr(tasks, "_compose_configs", {})
+    monkeypatch.setattr(tasks, "_services_mounts", {})
+    monkeypatch.setattr(tasks, "_executors", {})
+    monkeypatch.setattr(tasks, "_run_counter", itertools.count())
+    monkeypatch.setattr(os, "getpid", lambda: 42)
+
+    docker = FakeDocker(COMPOSE_CONFIG)
+    ctx.run = docker.run
+    return docker
+
+
+@pytest.fixture
+def es(http_server):
+    es = FakeElasticsearch()
+    es.indices[EXISTING_INDEX] = {"number_of_replicas": 1}
+    es.url = http_server(es.handler())
+    return es
+
+
+@pytest.fixture
+def ctx(es):
+    config = Config(
+        overrides={
+            "dataset": "test",
+            "es": "http://es:9200",
+            "es_health": {"before_steps": False},
+            "es_import": {
+                "enable": True,
+                "url": es.url,
+                "refresh_interval": "1s",
+                "timeout": 10,
+            },
+        }
+    )
+    return Context(config)
+
+
+def _settings_updates(es):
+    return [
+        (path, body)
+        for method, path, _, body in es.requests
+        if method == "PUT" and path.endswith("/_settings")
+    ]
+
+
+def _health_requests(es):
+    return [query for _, path, query, _ in es.requests if path.startswith("/_cluster/health")]
+
+
+def test_import_mode_with_replicas(ctx, es, caplog):
+    caplog.set_level(logging.INFO)
+    with tasks._es_import_mode(ctx, [], "addr", {"nb_replicas": 2}) as conf:
+        template = es.templates["docker_mimir_import_addr_test"]
+        assert template["template"] == "munin_addr_test_*"
+        assert template["settings"]["index"] == {
+            "number_of_replicas": 0,
+            "refresh_interval": "-1",
+            "translog": {"durability": "async"},
+        }
+        # the importer creates the index without replicas
+        assert conf == {"nb_replicas": 0}
+        es.indices[NEW_INDEX] = {"number_of_replicas": 0, "refresh_interval": "-1"}
+
+    assert es.templates == {}
+    # only the index created by the import is restored
+    assert _settings_updates(es) == [
+        (
+            "/{}/_settings".format(NEW_INDEX),
+            {
+                "index": {
+                    "number_of_replicas": 2,
+                    "refresh_interval": "1s",
+                    "translog": {"durability": "request"},
+                }
+            },
+        )
+    ]
+    assert es.indices[EXISTING_INDEX] == {"number_of_replicas": 1}
+    # the replicas can't be allocated on a single node
+    assert _health_requests(es) == [{"wait_for_status": ["yellow"], "timeout": ["10s"]}]
+    assert "yellow rather than green" in caplog.text
+
+
+def test_import_mode_of_a_prefix_dataset(ctx, es):
+    # the indices of `test_2` match the pattern of the indices of `test`
+    other = "munin_addr_test_2_20200102_000000_000000"
+
+    with tasks._es_import_mode(ctx, [], "addr", {}):
+        es.indices[NEW_INDEX] = {}
+        es.indices[other] = {}
+
+    assert [path for path, _ in _settings_updates(es)] == ["/{}/_settings".format(NEW_INDEX)]
+
+
+def test_import_mode_without_replicas(ctx, es):
+    with tasks._es_import_mode(ctx, [], "addr", {}) as conf:
+        template = es.templates["docker_mimir_import_addr_test"]
+        # the replicas are left to elasticsearch
+        assert "number_of_replicas" not in template["settings"]["index"]
+        assert conf == {}
+        es.indices[NEW_INDEX] = {"refresh_interval": "-1"}
+
+    assert es.templates == {}
+    assert _settings_updates(es) == [
+        (
+            "/{}/_settings".format(NEW_INDEX),
+            {"index": {"refresh_interval": "1s", "translog": {"durability": "request"}}},
+        )
+    ]
+    assert _health_requests(es) == [{"wait_for_status": ["green"], "timeout": ["10s"]}]
+
+
+def test_import_mode_with_the_status_to_wait_for(ctx, es):
+    ctx.es_import.wait_for_status = "green"
+
+    with tasks._es_import_mode(ctx, [], "addr", {"nb_replicas": 1}):
+        es.indices[NEW_INDEX] = {}
+
+    assert _health_requests(es) == [{"wait_for_status": ["green"], "timeout": ["10s"]}]
+
+
+def test_import_mode_shared_by_the_imports(ctx, es):
+    with tasks._es_import_mode(ctx, [], "addr", {"nb_replicas": 1}):
+        with tasks._es_import_mode(ctx, [], "addr", {}) as conf:
+            assert conf == {"nb_replicas": 0}
+            es.indices[NEW_INDEX] = {"number_of_replicas": 0}
+        # the template is kept until the last import is over
+        assert "docker_mimir_import_addr_test" in es.templates
+        assert _settings_updates(es) == []
+
+    assert es.templates == {}
+    assert len(_settings_updates(es)) == 1
+
+
+def test_import_mode_timed_out(ctx, es):
+    es.health = (408, {"status": "red", "timed_out": True})
+
+    with pytest.raises(Exception, match="are not green after 10s: red"):
+        with tasks._es_import_mode(ctx, [], "addr", {}):
+            es.indices[NEW_INDEX] = {}
+
+    assert es.templates == {}
+
+
+def test_failed_import(ctx, es):
+    with pytest.raises(RuntimeError):
+        with tasks._es_import_mode(ctx, [], "addr", {"nb_replicas": 1}):
+            es.indices[NEW_INDEX] = {}
+            raise RuntimeError()
+
+    # the template is removed, the indices of the failed import are not restored
+    assert es.templates == {}
+    assert _settings_updates(es) == []
+
+
+def test_import_mode_disabled(ctx, es):
+    ctx.es_import.enable = False
+
+    with tasks._es_import_mode(ctx, [], "addr", {"nb_replicas": 1}) as conf:
+        assert conf == {"nb_replicas": 1}
+
+    assert es.requests == []
+
+
+def test_delete_stale_tiles(es):
+    indices = [
+        "munin_street_test_20200101_000000_000000",
+        "munin_street_test_tile0_20200101_000000_000000",
+        "munin_street_test_tile1_20200101_000000_000000",
+        "munin_street_test_tile2_20200101_000000_000000",
+        "munin_street_test_tile10_20200101_000000_000000",
+        "munin_street_test_2_20200101_000000_000000",
+        "munin_street_test_2_tile3_20200101_000000_000000",
+    ]
+    es.indices = {index: {} for index in indices}
+
+    tasks._es_delete_stale_tiles(es.url, "street", "test", 2)
+
+    # the untiled index and the tiles above 2 of the dataset are deleted,
+    # not the ones of `test_2`
+    assert sorted(es.indices) == [
+        "munin_street_test_2_20200101_000000_000000",
+        "munin_street_test_2_tile3_20200101_000000_000000",
+        "munin_street_test_tile0_20200101_000000_000000",
+        "munin_street_test_tile1_20200101_000000_000000",
+    ]
+
+
+def _region(dataset, **conf):
+    return Context(Config(overrides=dict(dataset=dataset, **conf)))
+
+
+def test_regions_sharing_their_downloads():
+    osm = {"url": "http://osm/france.osm.pbf"}
+    bano = {"bano": {"url": "http://bano/full.csv.gz"}}
+    regions = [_region("fr", osm=osm, addresses=bano), _region("fr2", osm=osm, addresses=bano)]
+
+    tasks._check_regions(["fr", "fr2"], regions)
+
+
+@pytest.mark.parametrize(
+    "conf, other_conf, conflict",
+    [
+        (
+            {"osm": {"url": "http://osm/france.osm.pbf"}},
+            {"osm": {"url": "http://mirror/france.osm.pbf"}},
+            "file /data/osm/france.osm.pbf",
+        ),
+        (
+            {"street": {"osm_db_file": "/data/osm/streets.db"}},
+            {"street": {"osm_db_file": "/data/osm/streets.db"}},
+            "file /data/osm/streets.db",
+        ),
+        (
+            {"addresses": {"bano": {"url": "http://bano/full.csv.gz"}, "stream": True}},
+            {"addresses": {"bano": {"url": "http://bano/full.csv.gz"}}},
+            "file /data/addresses/bano.csv",
+        ),
+        (
+            {"osm": {"url": "http://osm/fr.osm.pbf"}, "tiling": {"enable": True, "nb_tiles": 2}},
+            {"osm": {"url": "http://osm/fr.osm.pbf"}, "tiling": {"enable": True, "nb_tiles": 4}},
+            "file /data/osm/tiles/fr_tile*",
+        ),
+    ],
+)
+def test_regions_writing_the_same_files(conf, other_conf, conflict):
+    regions = [_region("fr", **conf), _region("fr2", **other_conf)]
+
+    with pytest.raises(Exception, match="use the same {}".format(re.escape(conflict))):
+        tasks._check_regions(["fr", "fr2"], regions)
+
+
+def test_wait_for_es(ctx, es):
+    ctx.es_health = {"wait_for_status": "green", "initial_delay": 0.01, "timeout": 5}
+    es.health = (200, {"status": "yellow"})
+    threading.Timer(0.2, lambda: setattr(es, "health", (200, {"status": "green"}))).start()
+
+    assert 0.2 <= tasks._wait_for_es(ctx, []) < 5
+
+
+def test_wait_for_es_timed_out(ctx, es):
+    ctx.es_health = {"wait_for_status": "green", "initial_delay": 0.01, "timeout": 1}
+
+    with pytest.raises(Exception, match="is not green after 1s: its status is yellow"):
+        tasks._wait_for_es(ctx, [])
+
+
+class StepsRecorder:
+    """
+    Build steps recording when they start and end, the steps of `failing`
+    raise an error, the steps last 50ms unless given in `durations`.
+    """
+
+    def __init__(self, durations={}, failing=()):
+        self.durations = durations
+        self.failing = set(failing)
+        self.times = {}
+        self.lock = threading.Lock()
+
+    def step(self, name, inputs=(), outputs=()):
+        def run():
+            start = time.monotonic()
+            time.sleep(self.durations.get(name, 0.05))
+            with self.lock:
+                self.times[name] = (start, time.monotonic())
+            if name in self.failing:
+                raise RuntimeError("{} failed".format(name))
+
+        return tasks.Step(name, run, inputs=list(inputs), outputs=list(outputs))
+
+    def running_at_most(self):
+        bounds = [t for times in self.times.values() for t in times]
+        return max(
+            len([1 for start, end in self.times.values() if start <= t < end]) for t in bounds
+        )
+
+
+def test_steps_waiting_for_their_inputs():
+    recorder = StepsRecorder()
+    steps = [
+        recorder.step("load", inputs=["file", "index"], outputs=["other_index"]),
+        recorder.step("download", outputs=["file"]),
+        recorder.step("import", inputs=["given"], outputs=["index"]),
+    ]
+
+    tasks._run_steps(steps, max_parallel_steps=3, available=["given"])
+
+    times = recorder.times
+    assert times["load"][0] >= max(times["download"][1], times["import"][1])
+    # the independent steps are run at the same time
+    assert times["download"][0] < times["import"][1]
+
+
+def test_steps_run_at_the_same_time():
+    recorder = StepsRecorder()
+    steps = [recorder.step("step{}".format(i), outputs=["file{}".format(i)]) for i in range(6)]
+
+    tasks._run_steps(steps, max_parallel_steps=2)
+
+    assert len(recorder.times) == 6
+    assert recorder.running_at_most() == 2
+
+
+def test_failed_step():
+    recorder = StepsRecorder(durations={"import": 0.3}, failing=["download"])
+    steps = [
+        recorder.step("download", outputs=["file"]),
+        recorder.step("import", outputs=["index"]),
+        recorder.step("load", inputs=["file"], outputs=["other_index"]),
+        recorder.step("other", outputs=["other_file"]),
+    ]
+
+    with pytest.raises(RuntimeError, match="download failed"):
+        tasks._run_steps(steps, max_parallel_steps=2)
+
+    # the running step is over, no step is started after the failure
+    assert sorted(recorder.times) == ["download", "import"]
+    assert recorder.times["import"][1] > recorder.times["download"][1]
+
+
+def test_steps_with_inputs_produced_by_no_step():
+    recorder = StepsRecorder()
+    steps = [
+        recorder.step("download", outputs=["file"]),
+        recorder.step("load", inputs=["file", "index"], outputs=["other_index"]),
+    ]
+
+    with pytest.raises(Exception, match="impossible to run steps load: their inputs are produced"):
+        tasks._run_steps(steps, max_parallel_steps=2)
+
+    assert recorder.times == {}
+
+
+def test_steps_depending_on_themselves():
+    recorder = StepsRecorder()
+    steps = [
+        recorder.step("download", outputs=["file"]),
+        recorder.step("load", inputs=["file", "other_index"], outputs=["index"]),
+        recorder.step("other", inputs=["index"], outputs=["other_index"]),
+    ]
+
+    with pytest.raises(Exception, match="steps load, other: their inputs depend on themselves"):
+        tasks._run_steps(steps)
+
+    assert list(recorder.times) == ["download"]
+
+
+def _run_mimir(ctx, params="--input /data/osm/france.osm.pbf"):
+    return tasks.run_rust_binary(ctx, "mimir", "osm2mimir", [], params)
+
+
+def _run_cosmogony(ctx, params="--input /data/osm/france.osm.pbf"):
+    return tasks.run_rust_binary(ctx, None, "cosmogony", [], params)
+
+
+def test_compose_executor(ctx, docker):
+    assert _run_mimir(ctx)
+    _run_cosmogony(ctx)
+
+    assert docker.commands == [
+        "docker-compose {} run --rm --name docker_mimir_mimir_42_0 mimir"
+        " osm2mimir --input /data/osm/france.osm.pbf".format(COMPOSE),
+        # the binary is the entrypoint of the image
+        "docker-compose {} run --rm --name docker_mimir_cosmogony_42_1 cosmogony"
+        "  --input /data/osm/france.osm.pbf".format(COMPOSE),
+    ]
+
+
+def test_recording_executor(ctx, docker):
+    ctx.executors = {"default": "recording"}
+
+    _run_mimir(ctx)
+
+    assert docker.commands == []
+    assert tasks._get_executor(ctx, [], "mimir").commands == [
+        "docker-compose {} run --rm --name docker_mimir_mimir_42_0 mimir"
+        " osm2mimir --input /data/osm/france.osm.pbf".format(COMPOSE)
+    ]
+
+
+def test_worker_executor(ctx, docker):
+    ctx.executors = {"default": "worker"}
+    docker.outputs[r"^docker image inspect .* navitia/mimirsbrunn$"] = "null"
+    docker.outputs[r"^docker image inspect .* osmwithoutborders/cosmogony$"] = '["cosmogony"]'
+
+    _run_mimir(ctx)
+    _run_mimir(ctx, "--input /data/osm/other.osm.pbf")
+    _run_cosmogony(ctx)
+    tasks._stop_executors()
+
+    worker = "docker_mimir_mimir_test_worker"
+    inspect = "docker image inspect --format '{{json .Config.Entrypoint}}' "
+    assert docker.commands[1:] == [
+        inspect + "navitia/mimirsbrunn",
+        # a worker remaining from a previous run is removed
+        "docker rm -f " + worker,
+        "docker-compose {} run -d --name {} --entrypoint sh mimir"
+        " -c 'trap exit TERM; while true; do sleep 1; done'".format(COMPOSE, worker),
+        "docker exec {} osm2mimir --input /data/osm/france.osm.pbf".format(worker),
+        # the worker is started once
+        inspect + "navitia/mimirsbrunn",
+        "docker exec {} osm2mimir --input /data/osm/other.osm.pbf".format(worker),
+        inspect + "osmwithoutborders/cosmogony",
+        "docker rm -f docker_mimir_cosmogony_test_worker",
+        "docker-compose {} run -d --name docker_mimir_cosmogony_test_worker --entrypoint sh"
+        " cosmogony -c 'trap exit TERM; while true; do sleep 1; done'".format(COMPOSE),
+        "docker exec docker_mimir_cosmogony_test_worker cosmogony  --input"
+        " /data/osm/france.osm.pbf",
+        "docker rm -f " + worker,
+        "docker rm -f docker_mimir_cosmogony_test_worker",
+    ]
+
+
+def test_local_executor(ctx, docker, tmpdir):
+    ctx.executors = {"default": "local"}
+    docker.outputs[r"^docker volume inspect .* docker_mimir_addresses$"] = str(tmpdir)
+    docker.outputs[r"^docker volume inspect .* cosmogony$"] = None
+
+    _run_mimir(
+        ctx,
+        "--input /data/osm/france.osm.pbf --output '/data/addresses' --tmp /data/osmosis",
+    )
+    _run_cosmogony(ctx, "--input /data/osm/france.osm.pbf")
+
+    # the paths of the volumes are replaced by their path on the host
+    assert [c for c in docker.commands if not c.startswith("docker")] == [
+        "osm2mimir --input /srv/osm/france.osm.pbf --output '{}' --tmp /data/osmosis".format(
+            tmpdir
+        ),
+        "cosmogony --input /srv/osm/france.osm.pbf",
+    ]
+
+    with pytest.raises(Exception, match="volume /data/cosmogony of cosmogony can't be accessed"):
+        _run_cosmogony(ctx, "--output /data/cosmogony/france.json")
+
+
+def test_executors_by_service(ctx, docker):
+    ctx.executors = {"default": "recording", "cosmogony": "local", "mimir": "worker"}
+
+    assert type(tasks._get_executor(ctx, [], "mimir")) is tasks.WorkerExecutor
+    assert type(tasks._get_executor(ctx, [], "cosmogony")) is tasks.LocalExecutor
+    assert type(tasks._get_executor(ctx, [], "bragi")) is tasks.RecordingExecutor
+    # each service has its own executor
+    assert tasks._get_executor(ctx, [], "mimir") is tasks._get_executor(ctx, [], "mimir")
+
+    ctx.executors = {"default": "kubernetes"}
+    with pytest.raises(Exception, match="unknown executor 'kubernetes' for bragi"):
+        tasks._get_executor(ctx, [], "bragi")
+
+
+@pytest.fixture
+def data(ctx, docker, es, tmpdir):
+    """
+    Directory of the docker volume mounted at /data, with an osm extract. The
+    import is resumed and the binaries are only recorded.
+    """
+    data = tmpdir.mkdir("data")
+    data.mkdir("osm").join("france.osm.pbf").write("osm")
+    volumes = ["{}:/data".format(data)]
+    docker.set_compose_config(
+        {"services": {"download": {"volumes": volumes}, "mimir": {"volumes": volumes}}}
+    )
+
+    ctx.executors = {"default": "recording"}
+    ctx.resume = True
+    ctx.checkpoints_file = str(tmpdir.join("checkpoints.json"))
+    es.aliases.add("munin_street_test")
+    return data
+
+
+def _import_streets(ctx, params="--import-way", **kwargs):
+    kwargs.setdefault("index", "munin_street_test")
+    return tasks.run_rust_binary(
+        ctx,
+        "mimir",
+        "osm2mimir",
+        [],
+        "--input /data/osm/france.osm.pbf " + params,
+        inputs=["/data/osm/france.osm.pbf"],
+        **kwargs
+    )
+
+
+def _runs(ctx):
+    return len(tasks._get_executor(ctx, [], "mimir").commands)
+
+
+def _set_downloaded(data, md5):
+    # the status of the files kept by the download image
+    conn = sqlite3.connect(str(data.ensure_dir("cache").join("_files_status.sqlite")))
+    with conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS files_status (filename TEXT PRIMARY KEY, status TEXT)"
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO files_status VALUES (?, ?)",
+            ("/data/osm/france.osm.pbf", json.dumps({"md5": md5, "last_update": 2e9})),
+        )
+    conn.close()
+
+
+def test_resume_the_steps_that_succeeded(ctx, data):
+    assert _import_streets(ctx)
+    assert not _import_streets(ctx)
+    assert _runs(ctx) == 1
+
+    ctx.resume = False
+    assert _import_streets(ctx)
+    assert _runs(ctx) == 2
+
+
+def _change_size(ctx, data):
+    data.join("osm", "france.osm.pbf").write("new osm")
+
+
+def _change_mtime(ctx, data):
+    # the file is modified after it was downloaded, its md5 is not used
+    data.join("osm", "france.osm.pbf").setmtime(3e9)
+
+
+def _change_md5(ctx, data):
+    _set_downloaded(data, "new md5")
+
+
+def _change_image(ctx, data):
+    tasks._get_executor(ctx, [], "mimir").version = lambda container, bin: "new image"
+
+
+@pytest.mark.parametrize(
+    "change, params",
+    [
+        (_change_size, "--import-way"),
+        (_change_mtime, "--import-way"),
+        (_change_md5, "--import-way"),
+        (_change_image, "--import-way"),
+        (lambda ctx, data: None, "--import-way --nb-street-shards=2"),
+    ],
+)
+def test_resume_the_steps_that_changed(ctx, data, change, params):
+    _set_downloaded(data, "md5")
+
+    assert _import_streets(ctx)
+    change(ctx, data)
+    assert _import_streets(ctx, params)
+    assert _runs(ctx) == 2
+
+
+def test_resume_a_failed_step(ctx, data):
+    executor = tasks._get_executor(ctx, [], "mimir")
+    executor.run = lambda cmd: 1 / 0
+
+    with pytest.raises(ZeroDivisionError):
+        _import_streets(ctx)
+    assert not os.path.exists(ctx.checkpoints_file)
+
+    del executor.run
+    assert _import_streets(ctx)
+
+
+def test_resume_a_deleted_index(ctx, data, es):
+    assert _import_streets(ctx)
+
+    es.aliases.clear()
+    assert _import_streets(ctx)
+    assert _runs(ctx) == 2
+
+
+def test_resume_a_deleted_output(ctx, data):
+    # like the generation of cosmogony, no index is imported
+    output = data.mkdir("cosmogony").join("cosmogony.jsonl.gz")
+    kwargs = dict(index=None, output="/data/cosmogony/cosmogony.jsonl.gz")
+
+    assert _import_streets(ctx, **kwargs)
+    output.write("cosmogony")
+    assert not _import_streets(ctx, **kwargs)
+
+    output.remove()
+    assert _import_streets(ctx, **kwargs)
+    assert _runs(ctx) == 2
+
+
+@pytest.mark.parametrize(
+    "changed, updated",
+    [
+        ([], []),
+        (["addresses"], []),
+        (["streets"], ["download_osm", "load_osm_streets"]),
+        (["pois", "streets"], ["download_osm", "load_osm_streets", "load_osm_pois"]),
+        # all the imports use the admins
+        (
+            ["admins"],
+            [
+                "download_osm",
+                "load_osm_streets",
+                "load_cosmogony",
+                "generate_cosmogony",
+                "download_bano",
+                "load_bano_addresses",
+                "load_osm_pois",
+            ],
+        ),
+    ],
+)
+def test_update_steps(changed, updated):
+    ctx = _region(
+        "fr",
+        osm={"url": "http://osm/france.osm.pbf"},
+        admin={"cosmogony": {"output_dir": "/data/cosmogony"}},
+        addresses={"bano": {"url": "http://bano/full.csv.gz"}, "deduplication": {"enable": False}},
+        poi={"osm": {}},
+    )
+    steps = tasks._load_all_steps(ctx, True, [])
+
+    assert [s.name for s in tasks._update_steps(steps, changed)] == updated
+
+
+GIB = 2 ** 30
+
+
+@pytest.mark.parametrize(
+    "cgroup, resources",
+    [
+        ({}, (8, 16 * GIB)),
+        # cgroup v2
+        ({"cpu.max": "max 100000", "memory.max": "max"}, (8, 16 * GIB)),
+        ({"cpu.max": "200000 100000", "memory.max": str(4 * GIB)}, (2, 4 * GIB)),
+        ({"cpu.max": "50000 100000", "memory.max": str(32 * GIB)}, (1, 16 * GIB)),
+        # cgroup v1
+        (
+            {
+                "cpu/cpu.cfs_quota_us": "-1",
+                "cpu/cpu.cfs_period_us": "100000",
+                "memory/memory.limit_in_bytes": "9223372036854771712",
+            },
+            (8, 16 * GIB),
+        ),
+        (
+            {
+                "cpu/cpu.cfs_quota_us": "350000",
+                "cpu/cpu.cfs_period_us": "100000",
+                "memory/memory.limit_in_bytes": str(2 * GIB),
+            },
+            (3, 2 * GIB),
+        ),
+    ],
+)
+def test_host_resources(tmpdir, cgroup, resources):
+    for filename, content in cgroup.items():
+        tmpdir.join(filename).write(content + "\n", ensure=True)
+
+    assert tasks._host_resources(str(tmpdir), cpus=8, memory=16 * GIB) == resources
+
+
+THREADS = ["nb_threads", "nb_insert_threads"]
+
+
+@pytest.mark.parametrize(
+    "conf, keys, input_size, options, tuned",
+    [
+        ({}, THREADS, None, {}, {"nb_threads": 8, "nb_insert_threads": 4}),
+        # the resources are shared by the imports and the runs of the importer
+        ({}, THREADS, None, {"concurrent_imports": 2}, {"nb_threads": 4, "nb_insert_threads": 2}),
+        (
+            {},
+            ["nb_threads"],
+            None,
+            {"concurrent_imports": 3, "parallel_runs": 2},
+            {"nb_threads": 1},
+        ),
+        ({}, ["nb_threads"], None, {"max_cpus": 2}, {"nb_threads": 2}),
+        # 512MB per thread
+        ({}, ["nb_threads"], None, {"max_memory": 2 * GIB}, {"nb_threads": 4}),
+        # 256MB of input per thread
+        ({}, ["nb_threads"], 600 * 2 ** 20, {}, {"nb_threads": 3}),
+        # 4GB of input per shard, at most a shard per cpu
+        ({}, ["nb_shards"], None, {}, {"nb_shards": None}),
+        ({}, ["nb_shards"], 2 ** 20, {}, {"nb_shards": 1}),
+        ({}, ["nb_shards"], 10 * GIB, {}, {"nb_shards": 3}),
+        ({}, ["nb_shards"], 100 * GIB, {}, {"nb_shards": 8}),
+        # the values that are set are kept
+        (
+            {"nb_shards": 5, "nb_threads": "", "langs": "fr"},
+            ["nb_shards", "nb_threads"],
+            10 * GIB,
+            {},
+            {"nb_shards": 5, "nb_threads": 8, "langs": "fr"},
+        ),
+        ({"nb_threads": 2}, ["nb_threads"], None, {}, {"nb_threads": 2}),
+        ({"nb_threads": 2}, ["nb_threads"], None, {"autotune": False}, {"nb_threads": 2}),
+        ({}, ["nb_threads"], None, {"autotune": False}, {}),
+    ],
+)
+def test_autotune(monkeypatch, conf, keys, input_size, options, tuned):
+    options = dict(options)
+    parallel_runs = options.pop("parallel_runs", 1)
+    ctx = Context(Config(overrides=dict({"autotune": True}, **options)))
+    monkeypatch.setattr(tasks, "_input_size", lambda ctx, files, path: input_size)
+
+    inputs = ["/data/osm/france.osm.pbf"]
+    conf = tasks._autotune(ctx, [], conf, inputs, keys, parallel_runs, (8, 16 * GIB))
+
+    assert conf == tuned
+
+
+def _stats(cpu, memory, net, block):
+    # a line printed by `docker stats --format '{{json .}}'`
+    return json.dumps(
+        {
+            "BlockIO": block,
+            "CPUPerc": cpu,
+            "Container": "docker_mimir_mimir_42_0",
+            "ID": "2f6a3c9b1e0d",
+            "MemPerc": "9.68%",
+            "MemUsage": memory,
+            "Name": "docker_mimir_mimir_42_0",
+            "NetIO": net,
+            "PIDs": "12",
+        }
+    )
+
+
+@pytest.mark.parametrize(
+    "line, stats",
+    [
+        (
+            _stats("105.25%", "1.5GiB / 15.5GiB", "12.3kB / 0B", "1.2GB / 512MiB"),
+            {
+                "cpu_percent": 105.25,
+                "memory_bytes": int(1.5 * GIB),
+                "network_receive_bytes": 12300,
+                "network_transmit_bytes": 0,
+                "block_read_bytes": 1200000000,
+                "block_write_bytes": 512 * 2 ** 20,
+            },
+        ),
+        (
+            _stats("0.00%", "--", "648B / 1.1MB", "--"),
+            {
+                "cpu_percent": 0.0,
+                "memory_bytes": None,
+                "network_receive_bytes": 648,
+                "network_transmit_bytes": 1100000,
+                "block_read_bytes": None,
+                "block_write_bytes": None,
+            },
+        ),
+    ],
+)
+def test_parse_stats(line, stats):
+    assert tasks._parse_stats(line) == stats
+
+
+def test_parse_stats_of_a_stopped_container():
+    # the sampler drops these lines
+    with pytest.raises(ValueError):
+        tasks._parse_stats(_stats("--", "-- / --", "-- / --", "-- / --"))
+
+
+def _record(task, **values):
+    record = dict(dataset="fr", task=task, image="sha256:42", success=True, started_at=1.5)
+    record.update(values)
+    return record
+
+
+def test_metrics_textfile():
+    textfile = tasks._metrics_textfile(
+        [
+            _record("load_osm_streets", duration_seconds=20),
+            _record('load "bano"\\\n', duration_seconds=5, image=None, success=False),
+            _record("load_osm_streets", duration_seconds=10, memory_peak_bytes=2 ** 30),
+        ]
+    )
+    lines = textfile.splitlines()
+
+    for name, _, _ in tasks._TEXTFILE_METRICS:
+        assert lines.count("# TYPE docker_mimir_{} gauge".format(name)) == 1
+        help = "# HELP docker_mimir_{} ".format(name)
+        assert len([l for l in lines if l.startswith(help)]) == 1
+
+    streets = 'dataset="fr",task="load_osm_streets",image="sha256:42"'
+    # the image of the binary is unknown, the special characters are escaped
+    bano = 'dataset="fr",task="load \\"bano\\"\\\\\\n"'
+    assert [l for l in lines if not l.startswith("#")] == [
+        "docker_mimir_step_success{%s} 1.0" % streets,
+        "docker_mimir_step_success{%s} 0.0" % bano,
+        "docker_mimir_step_start_time_seconds{%s} 1.5" % streets,
+        "docker_mimir_step_start_time_seconds{%s} 1.5" % bano,
+        # only the last run of a task is kept
+        "docker_mimir_step_duration_seconds{%s} 10.0" % streets,
+        "docker_mimir_step_duration_seconds{%s} 5.0" % bano,
+        "docker_mimir_step_memory_peak_bytes{%s} 1073741824.0" % streets,
+    ]
+
+
+def test_record_metrics(ctx, tmpdir, monkeypatch):
+    ctx.metrics = {"output_dir": str(tmpdir.join("json")), "textfile_dir": str(tmpdir)}
+    monkeypatch.setattr(tasks, "_metrics", {})
+    replaced = []
+    replace = os.replace
+
+    def spy(src, dst):
+        replaced.append((src, dst))
+        replace(src, dst)
+
+    monkeypatch.setattr(os, "replace", spy)
+
+    tasks._record_metrics(ctx, _record("load_osm_streets", duration_seconds=20))
+
+    textfile = str(tmpdir.join("docker_mimir_test.prom"))
+    # the textfile is never read while it's written
+    assert (textfile + ".tmp", textfile) in replaced
+    assert sorted(os.listdir(str(tmpdir))) == ["docker_mimir_test.prom", "json"]
+    with open(textfile) as f:
+        assert f.read() == tasks._metrics_textfile(
+            [_record("load_osm_streets", duration_seconds=20)]
+        )
+
+
+@pytest.fixture
+def volumes(docker, tmpdir, monkeypatch):
+    """
+    Volumes of the download service: a bind mount, a named volume readable
+    from the host and another one whose mountpoint can't be read.
+    """
+    bind = tmpdir.mkdir("bind")
+    addresses = tmpdir.mkdir("addresses")
+    docker.set_compose_config(
+        {
+            "services": {
+                "download": {
+                    "volumes": [
+                        "{}:/data".format(bind),
+                        "addresses:/data/addresses:rw",
+                        {"type": "volume", "source": "cache", "target": "/data/cache"},
+                        "/tmp/anonymous",
+                    ]
+                }
+            },
+            "volumes": {"addresses": {}, "cache": {"name": "download_cache"}},
+        }
+    )
+    docker.outputs[r"^docker volume inspect .* docker_mimir_test_addresses$"] = str(addresses)
+    docker.outputs[r"^docker volume inspect .* download_cache$"] = "/var/lib/docker/volumes/_data"
+    monkeypatch.setenv("COMPOSE_PROJECT_NAME", "docker_mimir_test")
+    return bind, addresses
+
+
+def test_service_mounts(ctx, volumes):
+    bind, addresses = volumes
+
+    # the most specific mount points first, the anonymous volume is ignored
+    assert tasks._service_mounts(ctx, [], "download") == [
+        (str(addresses), "/data/addresses"),
+        ("/var/lib/docker/volumes/_data", "/data/cache"),
+        (str(bind), "/data"),
+    ]
+    assert tasks._service_mounts(ctx, [], "mimir") == []
+
+
+@pytest.mark.parametrize(
+    "path, host_path",
+    [
+        ("/data", "bind"),
+        ("/data/osm/france.osm.pbf", "bind/osm/france.osm.pbf"),
+        ("/data/addresses_2/bano.csv", "bind/addresses_2/bano.csv"),
+        ("/data/addresses/bano.csv", "addresses/bano.csv"),
+        # the mountpoint of the volume can't be read from the host
+        ("/data/cache/_files_status.sqlite", None),
+        ("/srv/osm/france.osm.pbf", None),
+    ],
+)
+def test_host_path(ctx, volumes, tmpdir, path, host_path):
+    if host_path is not None:
+        host_path = str(tmpdir.join(host_path))
+
+    assert tasks._host_path(ctx, [], path) == host_path
+
+
+def test_file_exists(ctx, volumes, docker):
+    bind, _ = volumes
+    bind.mkdir("osm").join("france.osm.pbf").write("osm")
+
+    assert tasks.file_exists(ctx, [], "/data/osm/france.osm.pbf")
+    assert not tasks.file_exists(ctx, [], "/data/osm/other.osm.pbf")
+    assert not [c for c in docker.commands if "file-exists" in c]
+
+    # the files of the volumes that can't be read are checked in a container
+    docker.outputs[r"file-exists"] = None
+    assert not tasks.file_exists(ctx, [], "/data/cache/_files_status.sqlite")
+    assert docker.commands[-1] == (
+        "docker-compose {} run --rm download file-exists"
+        " --path=/data/cache/_files_status.sqlite".format(COMPOSE)
+    )
+
+
+IMPORT_SERVICES = ["es", "bragi", "download", "cosmogony", "mimir", "addresses-importer", "fafnir"]
+
+
+@pytest.mark.parametrize(
+    "conf, services",
+    [
+        (
+            {"admin": {"osm": True}, "addresses": {"deduplication": {"enable": False}}},
+            ["es", "bragi", "download", "mimir"],
+        ),
+        (
+            {
+                "admin": {"cosmogony": {"output_dir": "/data/cosmogony"}},
+                "addresses": {
+                    "bano": {"url": "http://bano/full.csv.gz"},
+                    "deduplication": {"enable": False},
+                },
+                "poi": {"osm": {}},
+            },
+            ["es", "bragi", "download", "cosmogony", "mimir"],
+        ),
+        # the binaries of cosmogony are run on the host
+        (
+            {
+                "admin": {"cosmogony": {"output_dir": "/data/cosmogony"}},
+                "addresses": {"deduplication": {"enable": False}},
+                "executors": {"default": "worker", "cosmogony": "local"},
+            },
+            ["es", "bragi", "download", "mimir"],
+        ),
+        # the cosmogony file is given
+        (
+            {
+                "admin": {"cosmogony": {"file": "/data/cosmogony/fr.jsonl.gz"}},
+                "addresses": {"deduplication": {"enable": False}},
+            },
+            ["es", "bragi", "download", "mimir"],
+        ),
+        (
+            {
+                "admin": {"osm": True},
+                "addresses": {
+                    "oa": {"datasets": ["fr/countrywide"]},
+                    "deduplication": {"enable": True, "output": "/data/addresses/all.csv.gz"},
+                },
+                "poi": {"fafnir": {"pg": "postgres://pg"}},
+            },
+            ["es", "bragi", "download", "mimir", "addresses-importer", "fafnir"],
+        ),
+    ],
+)
+def test_needed_services(ctx, docker, conf, services):
+    docker.set_compose_config({"services": {s: {"image": s} for s in IMPORT_SERVICES}})
+    ctx.osm = {"url": "http://osm/france.osm.pbf"}
+    ctx.config.load_overrides(conf)
+
+    assert tasks._needed_services(ctx, []) == services
+
+
+@pytest.fixture
+def registry(docker, monkeypatch):
+    """
+    Digests of the images in the registry, and of the local images.
+    """
+    docker.set_compose_config(
+        {
+            "services": {
+                "es": {"image": "elasticsearch:7.10"},
+                "mimir": {"image": "navitia/mimirsbrunn"},
+                "cosmogony": {"image": "osmwithoutborders/cosmogony"},
+                "bragi": {"image": "navitia/bragi"},
+                "tester": {"image": "tester", "build": "."},
+            }
+        }
+    )
+    docker.outputs[r"^docker image inspect .* elasticsearch:7.10$"] = json.dumps(
+        ["elasticsearch@sha256:es"]
+    )
+    docker.outputs[r"^docker image inspect .* navitia/mimirsbrunn$"] = json.dumps(
+        ["navitia/mimirsbrunn@sha256:old", "registry/mimirsbrunn@sha256:mimir"]
+    )
+    docker.outputs[r"^docker image inspect .* osmwithoutborders/cosmogony$"] = json.dumps(
+        ["osmwithoutborders/cosmogony@sha256:old"]
+    )
+    # the image of bragi is not available locally
+    docker.outputs[r"^docker image inspect .* navitia/bragi$"] = None
+
+    digests = {
+        "elasticsearch:7.10": "sha256:es",
+        "navitia/mimirsbrunn": "sha256:mimir",
+        "osmwithoutborders/cosmogony": "sha256:cosmogony",
+    }
+    requested = []
+
+    def registry_digest(image):
+        requested.append(image)
+        return digests.get(image)
+
+    monkeypatch.setattr(tasks, "_registry_digest", registry_digest)
+    return requested
+
+
+def _pulled(docker):
+    return sorted(c.split()[-1] for c in docker.commands if re.search(r" pull \S+$", c))
+
+
+def test_pull_images(ctx, docker, registry):
+    tasks._pull_images(ctx, [], ["es", "mimir", "cosmogony", "bragi", "tester"])
+
+    # the images that are up to date and the ones that are built are not pulled
+    assert _pulled(docker) == ["bragi", "cosmogony"]
+    assert sorted(registry) == [
+        "elasticsearch:7.10",
+        "navitia/mimirsbrunn",
+        "osmwithoutborders/cosmogony",
+    ]
+
+
+def test_pull_images_without_checking_the_digests(ctx, docker, registry):
+    ctx.pull = {"check_digests": False}
+
+    tasks._pull_images(ctx, [], ["es", "mimir", "cosmogony", "bragi", "tester"])
+
+    assert _pulled(docker) == ["bragi", "cosmogony", "es", "mimir"]
+    assert registry == []
+
+
+DOCKER_HUB = "https://registry-1.docker.io/v2/"
+
+
+@pytest.mark.parametrize(
+    "image, url",
+    [
+        ("elasticsearch:7.10", DOCKER_HUB + "library/elasticsearch/manifests/7.10"),
+        ("navitia/mimirsbrunn", DOCKER_HUB + "navitia/mimirsbrunn/manifests/latest"),
+        ("localhost:5000/mimir:dev", "https://localhost:5000/v2/mimir/manifests/dev"),
+        ("quay.io/navitia/bragi:v2", "https://quay.io/v2/navitia/bragi/manifests/v2"),
+    ],
+)
+def test_registry_digest(monkeypatch, image, url):
+    requested = []
+
+    def manifest_digest(url, headers):
+        requested.append(url)
+        return "sha256:42"
+
+    monkeypatch.setattr(tasks, "_registry_manifest_digest", manifest_digest)
+
+    assert tasks._registry_digest(image) == "sha256:42"
+    assert requested == [url]
+
+
+def test_registry_digest_of_a_pinned_image(monkeypatch):
+    monkeypatch.setattr(tasks, "_registry_manifest_digest", lambda url, headers: 1 / 0)
+
+    assert tasks._registry_digest("navitia/mimirsbrunn@sha256:42") == "sha256:42"
+    # the errors of the registry are ignored, the image is pulled
+    assert tasks._registry_digest("navitia/mimirsbrunn") is None
+
+
+@pytest.fixture
+def streaming(ctx, docker):
+    """
+    Stream the addresses to the importer, run by the recording executor. The
+    streaming container stops once the importer is over, or once removed.
+    The commands of the importer are recorded with the other ones.
+    """
+    ctx.executors = {"default": "recording"}
+    ctx.addresses = {"stream": True}
+    executor = tasks._get_executor(ctx, [], "mimir")
+    executor.commands = docker.commands
+    importer_done = threading.Event()
+    streaming = {"done": False}
+
+    def stream(command):
+        importer_done.wait(5)
+        time.sleep(0.1)
+        streaming["done"] = True
+        return streaming.get("output", "")
+
+    def remove(command):
+        importer_done.set()
+        return ""
+
+    record = executor.run
+
+    def run(cmd):
+        record(cmd)
+        importer_done.set()
+        if streaming.get("fail"):
+            raise RuntimeError("import failed")
+
+    docker.outputs[r"stream-gzip"] = stream
+    docker.outputs[r"^docker rm -f"] = remove
+    executor.run = run
+    return streaming
+
+
+FIFO_COMMANDS = [
+    "docker-compose {} run --rm download make-fifo --fifo=/data/addresses/oa.csv".format(COMPOSE),
+    "docker-compose {} run --rm --name docker_mimir_stream_42_0 download stream-gzip"
+    " --input-file=/data/addresses/oa.csv.gz"
+    " --output-fifo=/data/addresses/oa.csv".format(COMPOSE),
+    "docker-compose {} run --rm --name docker_mimir_mimir_42_1 mimir openaddresses2mimir"
+    ' --connection-string="http://es:9200" --dataset="test"'
+    ' --input="/data/addresses/oa.csv"'.format(COMPOSE),
+]
+
+
+def _normalized(commands):
+    return [" ".join(c.split()) for c in commands]
+
+
+def _import_addresses(ctx):
+    tasks._run_addresses_importer(ctx, "openaddresses2mimir", {}, "/data/addresses/oa.csv.gz", [])
+
+
+def test_streamed_addresses(ctx, docker, streaming):
+    _import_addresses(ctx)
+
+    # the streaming container is started once the fifo is created, the
+    # import waits for the end of the streaming
+    assert streaming["done"]
+    assert sorted(_normalized(docker.commands)) == sorted(_normalized(FIFO_COMMANDS))
+    assert docker.commands[0] == FIFO_COMMANDS[0]
+
+
+def test_failed_import_of_streamed_addresses(ctx, docker, streaming):
+    streaming["fail"] = True
+
+    with pytest.raises(RuntimeError, match="import failed"):
+        _import_addresses(ctx)
+
+    # the streaming container is removed, it would wait for a reader
+    assert streaming["done"]
+    remove = "docker rm -f docker_mimir_stream_42_0"
+    commands = _normalized(docker.commands)
+    make_fifo, _, importer = _normalized(FIFO_COMMANDS)
+    assert sorted(commands) == sorted(_normalized(FIFO_COMMANDS + [remove]))
+    assert commands[0] == make_fifo
+    assert commands.index(importer) < commands.index(remove)
+
+
+def test_failed_streaming_of_addresses(ctx, docker, streaming):
+    streaming["output"] = None
+
+    with pytest.raises(UnexpectedExit):
+        _import_addresses(ctx)
+
+    assert sorted(_normalized(docker.commands)) == sorted(_normalized(FIFO_COMMANDS))